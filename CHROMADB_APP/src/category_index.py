@@ -0,0 +1,314 @@
+"""
+Busqueda por categoria: filtros de metadata (```where```) e indice categoria -> ids.
+
+Los filtros se envian a chroma (```collection.query(where=...)```), que descarta los documentos fuera de la categoria
+durante la busqueda. Para categorias chicas el indice HNSW filtrado pierde eficiencia (y recall): si el indice de
+categorias indica que el filtro selecciona a lo sumo ```brute_force_threshold``` documentos, la consulta se resuelve
+con un motor de busqueda exacta en memoria con los embeddings de la categoria. El motor de cada filtro se construye
+en la primera consulta (un unico llamado a ```collection.get```) y se reutiliza hasta la proxima escritura a la coleccion.
+
+```python
+where = build_where({'categoria_principal': 'Recategorizacion', 'subcategoria_1': 'Fechas'})
+# {'$and': [{'categoria_principal': 'Recategorizacion'}, {'subcategoria_1': 'Fechas'}]}
+```
+"""
+
+import json
+import threading
+from typing import Optional
+from collections import OrderedDict
+
+import chromadb
+
+from metrics import FILTERED_QUERIES
+from exact_search import ExactSearchEngine
+
+
+# campos de metadata categoricos de los datasets (MONOTRIBUTO y CRM)
+CATEGORY_FIELDS = ('categoria_principal', 'subcategoria_1', 'subcategoria_2', 'subcategoria_3', 'tipificacion')
+
+
+def build_where(filtros:dict=None) -> Optional[dict]:
+    """
+    Convierte un diccionario de filtros por igualdad ```{campo: valor, ...}``` al formato de ```where``` de chroma
+    (que admite un unico operador por nivel). Los filtros que ya tienen ese formato se devuelven sin cambios.
+    """
+    if not filtros:
+        return None
+
+    if len(filtros) == 1:
+        return dict(filtros)
+
+    return {'$and': [{campo: valor} for campo, valor in filtros.items()]}
+
+
+class CategoryIndex:
+    """
+    Indice campo -> valor -> ids de una coleccion, con la cantidad de documentos de cada categoria.
+    """
+
+    def __init__(self, fields:tuple[str, ...]=CATEGORY_FIELDS) -> None:
+        self.fields = fields
+
+        self._postings:dict[str, dict[str, set[str]]] = {field: {} for field in fields}
+        self._values:dict[str, dict[str, str]] = {}
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._values)
+
+    def add(self, ids:list[str], metadatas:list[dict]) -> None:
+        """ Agrega documentos al indice. Los ids existentes se reemplazan. """
+        with self._lock:
+            for id, metadata in zip(ids, metadatas or [None] * len(ids)):
+                self._remove(id)
+
+                values = {field: metadata[field] for field in self.fields if metadata and metadata.get(field) is not None}
+                self._values[id] = values
+
+                for field, value in values.items():
+                    self._postings[field].setdefault(value, set()).add(id)
+
+    def remove(self, ids:list[str]) -> None:
+        with self._lock:
+            for id in ids:
+                self._remove(id)
+
+    def ids(self, where:dict) -> Optional[set[str]]:
+        """
+        Devuelve los ids que cumplen el filtro, o None si el filtro no se puede resolver con el indice (campos no
+        indexados u operadores distintos de igualdad, ```$eq```, ```$in```, ```$and``` y ```$or```).
+        """
+        if not isinstance(where, dict) or len(where) != 1:
+            return None
+
+        key, value = next(iter(where.items()))
+
+        if key in ('$and', '$or'):
+            partes = [self.ids(expresion) for expresion in value]
+
+            if any(parte is None for parte in partes):
+                return None
+
+            return set.intersection(*partes) if key == '$and' else set.union(*partes)
+
+        if key not in self._postings:
+            return None
+
+        if isinstance(value, dict):
+            if len(value) != 1:
+                return None
+
+            operador, operando = next(iter(value.items()))
+
+            if operador == '$eq':
+                value = operando
+            elif operador == '$in':
+                return set().union(*(self._postings[key].get(valor, ()) for valor in operando))
+            else:
+                return None
+
+        return set(self._postings[key].get(value, ()))
+
+    def stats(self) -> dict:
+        """ Cantidad de documentos por valor de cada campo: ```{'total': int, 'categoria_principal': {valor: int}, ...}```. """
+        stats = {'total': len(self._values)}
+
+        for field, postings in self._postings.items():
+            if postings:
+                stats[field] = dict(sorted(((value, len(ids)) for value, ids in postings.items()), key=lambda item: -item[1]))
+
+        return stats
+
+    def _remove(self, id:str) -> None:
+        for field, value in self._values.pop(id, {}).items():
+            ids = self._postings[field][value]
+            ids.discard(id)
+
+            if not ids:
+                del self._postings[field][value]
+
+
+class CategoryIndexes:
+    """
+    Indices de categorias por coleccion. Cada indice se construye la primera vez que se consulta la coleccion con un
+    filtro, leyendo su metadata en paginas. Las escrituras realizadas a traves de ```Database``` y ```Client``` lo
+    mantienen sincronizado (```add```, ```refresh```, ```remove```) o lo descartan para reconstruirlo (```invalidate```).
+
+    Los motores de busqueda exacta de las categorias chicas se guardan por ```(coleccion, filtro)``` y se descartan
+    con cualquier escritura a la coleccion (```add```, ```refresh```, ```remove```, ```invalidate```).
+
+    Cada coleccion tiene su propio lock de construccion: mientras se construye el indice de una coleccion, las
+    consultas a las demas no se bloquean.
+
+    - brute_force_threshold: tamaño maximo de una categoria para resolver la consulta por fuerza bruta
+    - max_cached_vectors: cantidad maxima de vectores de los motores en memoria (se descartan los menos usados)
+    """
+
+    def __init__(self, fields:tuple[str, ...]=CATEGORY_FIELDS, brute_force_threshold:int=2000, page_size:int=1000,
+                 max_cached_vectors:int=50_000) -> None:
+        self.fields = fields
+        self.brute_force_threshold = brute_force_threshold
+        self.page_size = page_size
+        self.max_cached_vectors = max_cached_vectors
+
+        self._indexes:dict[str, CategoryIndex] = {}
+        self._engines:OrderedDict[tuple[str, str], ExactSearchEngine] = OrderedDict()
+        self._generation = 0
+        self._build_locks:dict[str, threading.Lock] = {}
+        self._generations:dict[str, int] = {}
+        self._lock = threading.Lock()
+
+    def get(self, collection:chromadb.Collection) -> CategoryIndex:
+        index = self._indexes.get(collection.name)
+
+        if index is None:
+            with self._lock:
+                build_lock = self._build_locks.setdefault(collection.name, threading.Lock())
+
+            with build_lock:
+                index = self._indexes.get(collection.name)
+
+                if index is None:
+                    generation = self._generations.get(collection.name, 0)
+                    index = self._build(collection)
+
+                    # una escritura durante la construccion pudo no quedar en el indice: se usa pero no se guarda
+                    with self._lock:
+                        if self._generations.get(collection.name, 0) == generation:
+                            self._indexes[collection.name] = index
+
+        return index
+
+    def query(self, collection:chromadb.Collection, query_embeddings:list, n_results:int=5, include:list[str]=['documents', 'metadatas', 'distances'],
+              where:dict=None, query_function=None) -> chromadb.QueryResult:
+        """
+        Consulta filtrada con el mismo formato que ```collection.query()```. Si el filtro selecciona a lo sumo
+        ```brute_force_threshold``` documentos la busqueda es exacta (fuerza bruta); si no, o si el filtro no se puede
+        resolver con el indice, se delega en chroma con ```where```.
+
+        - query_function: funcion que ejecuta la consulta por embeddings (por defecto ```collection.query```), por
+          ejemplo con reintentos.
+        """
+        query_function = query_function or collection.query
+        ids = self.get(collection).ids(where) if where else None
+
+        if ids is None or len(ids) > self.brute_force_threshold:
+            FILTERED_QUERIES.inc(collection=collection.name, plan='ann')
+            return query_function(query_embeddings=query_embeddings, n_results=n_results, include=include, where=where)
+
+        FILTERED_QUERIES.inc(collection=collection.name, plan='brute_force')
+        return self.engine(collection, where, ids).query(collection, query_embeddings, n_results, include)
+
+    def engine(self, collection:chromadb.Collection, where:dict, ids:set[str]) -> ExactSearchEngine:
+        """
+        Devuelve el motor de busqueda exacta de los documentos ```ids``` que selecciona el filtro. Se construye la
+        primera vez y se reutiliza mientras la coleccion no se modifique.
+        """
+        key = (collection.name, json.dumps(where, sort_keys=True))
+
+        with self._lock:
+            engine = self._engines.get(key)
+
+            if engine is not None:
+                self._engines.move_to_end(key)
+                return engine
+
+            generation = self._generation
+
+        engine = load_engine(collection, sorted(ids), self.page_size)
+
+        # si la coleccion se modifico mientras se leian los embeddings, el motor se usa pero no se guarda
+        with self._lock:
+            if self._generation == generation:
+                self._engines[key] = engine
+                self._trim()
+
+        return engine
+
+    def query_function(self, collection:chromadb.Collection, query_function=None):
+        """ Devuelve una funcion con la firma de ```collection.query``` que utiliza ```query``` (ver ```hybrid_query```). """
+        def consultar(query_embeddings:list, n_results:int=5, include:list[str]=['documents', 'metadatas', 'distances'], where:dict=None):
+            return self.query(collection, query_embeddings, n_results, include, where, query_function)
+
+        return consultar
+
+    def add(self, collection_name:str, ids:list[str], metadatas:list[dict]) -> None:
+        """ Agrega documentos al indice de la coleccion (si ya fue construido). """
+        self._drop_engines(collection_name)
+        index = self._indexes.get(collection_name)
+
+        if index is not None:
+            index.add(ids, metadatas)
+
+    def refresh(self, collection:chromadb.Collection, ids:list[str]) -> None:
+        """ Vuelve a leer la metadata de la coleccion (por ejemplo luego de una actualizacion parcial). """
+        self._drop_engines(collection.name)
+        index = self._indexes.get(collection.name)
+
+        if index is not None:
+            stored = collection.get(ids=ids, include=['metadatas'])
+            index.remove([id for id in ids if id not in set(stored['ids'])])
+            index.add(stored['ids'], stored['metadatas'])
+
+    def remove(self, collection_name:str, ids:list[str]) -> None:
+        self._drop_engines(collection_name)
+        index = self._indexes.get(collection_name)
+
+        if index is not None:
+            index.remove(ids)
+
+    def invalidate(self, collection_name:str=None) -> None:
+        self._drop_engines(collection_name)
+
+        with self._lock:
+            if collection_name:
+                self._indexes.pop(collection_name, None)
+            else:
+                self._indexes.clear()
+
+    def stats(self, collection:chromadb.Collection) -> dict:
+        """ Cantidad de documentos por categoria de la coleccion (ver ```CategoryIndex.stats```). """
+        return self.get(collection).stats()
+
+    def _drop_engines(self, collection_name:str=None) -> None:
+        # los motores se construyen con los embeddings de la categoria: cualquier escritura los descarta y cambia la
+        # generacion de la coleccion (ver get)
+        with self._lock:
+            self._generation += 1
+
+            for name in [collection_name] if collection_name else set(self._generations) | set(self._build_locks):
+                self._generations[name] = self._generations.get(name, 0) + 1
+
+            for key in [key for key in self._engines if collection_name is None or key[0] == collection_name]:
+                del self._engines[key]
+
+    def _trim(self) -> None:
+        while len(self._engines) > 1 and sum(len(engine) for engine in self._engines.values()) > self.max_cached_vectors:
+            self._engines.popitem(last=False)
+
+    def _build(self, collection:chromadb.Collection) -> CategoryIndex:
+        index = CategoryIndex(self.fields)
+        offset = 0
+
+        while True:
+            page = collection.get(include=['metadatas'], limit=self.page_size, offset=offset)
+
+            if not page['ids']:
+                break
+
+            index.add(page['ids'], page['metadatas'])
+            offset += len(page['ids'])
+
+        return index
+
+
+def load_engine(collection:chromadb.Collection, ids:list[str], page_size:int=1000) -> ExactSearchEngine:
+    """ Motor de busqueda exacta con los embeddings de los documentos ```ids``` de la coleccion, leidos en bloques. """
+    engine = ExactSearchEngine((collection.metadata or {}).get('hnsw:space', 'l2'), capacity=max(len(ids), 1))
+
+    for start in range(0, len(ids), page_size):
+        stored = collection.get(ids=ids[start:start + page_size], include=['embeddings'])
+        engine.add(stored['ids'], stored['embeddings'])
+
+    return engine
@@ -2,46 +2,263 @@
 Modulo para conexion remota a base de datos chroma.
 """
 
+import time
+import random
+import weakref
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
 import chromadb
+import requests
+from requests.adapters import HTTPAdapter
 from chromadb.config import Settings
+from chromadb.errors import InvalidCollectionException
 import pandas as pd
 from typing import Sequence, Optional
 
+from embedding_cache import EmbeddingCache
+from embeddings import get_embedding_backend
+from query_cache import QueryCache
+from collection_registry import CollectionRegistry
+from collection_versions import CollectionVersions
+from utilities import query_in_batches
+from metrics import track, logger, QUERY_CACHE
+from lexical_index import LexicalIndexes, hybrid_query
+from exact_index import ExactMatchIndexes, merge_results
+from category_index import CategoryIndexes, build_where
+
+
+def _as_list(value) -> Optional[list]:
+    if value is None or isinstance(value, list):
+        return value
+    return [value]
+
+
+def _collection_missing(error:Exception) -> bool:
+    # la coleccion fue eliminada o recreada en el servidor: las versiones sin un error especifico responden 'does not exist'
+    return isinstance(error, InvalidCollectionException) or 'does not exist' in str(error)
+
+
+# sesion HTTP -> Client que la configuro (ver Client._configure_transport)
+_SESSION_OWNERS = weakref.WeakKeyDictionary()
+
+
+class _PoolAdapter(HTTPAdapter):
+    """ Adaptador HTTP con pool de conexiones configurable y timeout por defecto. """
+    
+    def __init__(self, timeout:float=None, **kwargs) -> None:
+        self.timeout = timeout
+        super().__init__(**kwargs)
+    
+    def send(self, request, **kwargs):
+        if kwargs.get('timeout') is None:
+            kwargs['timeout'] = self.timeout
+        return super().send(request, **kwargs)
+
 
 class Client:
     """
     Establece una interfaz para conectarse al servidor de base de datos de chroma
+    
+    Los embeddings de las consultas se calculan con ```embedding_function``` (por defecto la de chroma) a traves de
+    un cache LRU en memoria. Si se indica ```embedding_cache_path``` el cache tambien se persiste en disco.
+    ```embedding_function``` tambien puede ser el nombre de un backend local ('onnx', 'hashing'), construido con
+    ```embedding_options``` (ver ```embeddings.get_embedding_backend```).
+    
+    Si se indica un ```query_cache``` los resultados de las consultas se cachean, y se invalidan con cada escritura
+    realizada a traves de ```insert_data```, ```update_data``` y ```delete_data```.
+    
+    Con ```hybrid=True``` las consultas de ```execute_query``` y ```query_collection``` combinan los resultados por
+    embeddings con un indice BM25 en memoria (ver ```lexical_index```). Los resultados quedan ordenados por reciprocal
+    rank fusion, por lo que las distancias no son necesariamente crecientes. Por defecto se utiliza solo la busqueda por
+    embeddings. El indice de cada coleccion se construye en la primera consulta y se mantiene sincronizado con las
+    escrituras realizadas a traves del cliente.
+    
+    En las colecciones de ```exact_match``` las consultas identicas a una pregunta de la coleccion (salvo mayusculas,
+    acentos, espacios y signos) se resuelven con un indice hash, sin calcular el embedding (ver ```exact_index```).
+    
+    Las consultas aceptan un filtro de metadata ```where``` (por ejemplo ```{'categoria_principal': 'Recategorizacion'}```)
+    que se aplica en chroma. Si la categoria tiene a lo sumo ```brute_force_threshold``` documentos la busqueda es
+    exacta, calculada localmente (ver ```category_index```); con ```brute_force_threshold=0``` siempre se usa chroma.
+    
+    Con ```version_check_interval``` (segundos) las escrituras se propagan a otros procesos con su propio cliente
+    (por ejemplo los workers de la API): cada escritura registra una nueva version de la coleccion en chroma y cada
+    cliente compara la version antes de consultar, a lo sumo una vez por intervalo, descartando su cache e indices
+    si cambio (ver ```collection_versions```). Sin este parametro las escrituras solo invalidan el cliente que las realiza.
+    
+    Transporte HTTP:
+        - pool_connections / pool_maxsize: cantidad de pools (hosts) y de conexiones por pool
+        - pool_block: si es True, al agotarse el pool se espera una conexion libre en lugar de abrir una nueva
+        - keep_alive: reutiliza las conexiones TCP entre pedidos
+        - timeout: timeout en segundos de cada pedido (conexion y lectura)
+        - retries / backoff_factor: reintentos con backoff exponencial y jitter, solo para lecturas (consultas)
+    
+    La configuracion del transporte y ```disconnect()``` solo afectan la sesion HTTP del propio cliente. Si chroma
+    comparte la sesion entre clientes del mismo host, solo la configura (y la cierra) el primero.
+    
+    ```python
+    with Client(pool_maxsize=32, timeout=5, retries=3) as client:
+        client.set_cursor('abc_collection')
+        client.execute_query('Que es la recategorizacion?')
+        client.pool_stats()
+    ```
     """
     
-    def __init__(self, host:str='localhost', port:int=8000, **kwargs) -> None:
+    def __init__(self, host:str='localhost', port:int=8000, embedding_function=None, embedding_cache_path:str=None, query_cache:QueryCache=None,
+                 pool_connections:int=10, pool_maxsize:int=10, pool_block:bool=False, keep_alive:bool=True, timeout:float=30, retries:int=3, backoff_factor:float=0.2,
+                 embedding_options:dict=None, hybrid:bool=False, exact_match:list[str]=None, brute_force_threshold:int=2000, version_check_interval:float=None,
+                 **kwargs) -> None:
         
         self.database = kwargs.get('database')
         self.database_info = None 
+        
+        self.embedding_function = EmbeddingCache(
+            get_embedding_backend(embedding_function, **(embedding_options or {})),
+            cache_path=embedding_cache_path
+        )
+        self.query_cache = query_cache
+        self.lexical = LexicalIndexes() if hybrid else None
+        self.exact = ExactMatchIndexes(exact_match) if exact_match else None
+        self.categories = CategoryIndexes(brute_force_threshold=brute_force_threshold) if brute_force_threshold else None
+        self.versions = CollectionVersions(check_interval=version_check_interval) if version_check_interval is not None else None
               
         self._port = port
         self._host = host
         
         self.connection_settings = {
             'port': port,
-            'host': host
+            'host': host,
+            'pool_connections': pool_connections,
+            'pool_maxsize': pool_maxsize,
+            'pool_block': pool_block,
+            'keep_alive': keep_alive,
+            'timeout': timeout,
+            'retries': retries,
+            'backoff_factor': backoff_factor,
         }
         
         self.client = None
         self.cursor = None
+        self.registry = None
+        self._session:requests.Session = None
+        self._adapter:_PoolAdapter = None
+        self._executor:ThreadPoolExecutor = None
+        self._executor_lock = threading.Lock()
         
         try:
             self.connect()
         except Exception as e:
-            print(e)
+            logger.error('No se ha podido conectar al servidor de chroma: %s', e)
         
     def connect(self) -> None:
+        """
+        Se conecta al servidor. Si el servidor no responde lanza una excepcion y ```client``` queda en None, por lo que
+        se puede volver a llamar hasta lograr la conexion.
+        """
         self.__settings = Settings(anonymized_telemetry=False)
         
         if self.database:
-            self.client = chromadb.HttpClient(host=self._host, port=self._port, settings=self.__settings, database=self.database)
+            client = chromadb.HttpClient(host=self._host, port=self._port, settings=self.__settings, database=self.database)
         else:
-            self.client = chromadb.HttpClient(host=self._host, port=self._port, settings=self.__settings)
-
+            client = chromadb.HttpClient(host=self._host, port=self._port, settings=self.__settings)
+        
+        self._configure_transport(client)
+        
+        # registro nombre -> coleccion: cada coleccion se pide al servidor una unica vez
+        self.registry = CollectionRegistry(client, self.embedding_function)
+        
+        if self.versions:
+            self.versions.connect(client)
+        
+        # el cliente se asigna al final: otros hilos lo consideran conectado solo cuando todo esta inicializado
+        self.client = client
+    
+    def _configure_transport(self, client) -> None:
+        # chromadb.HttpClient utiliza internamente una requests.Session: se reemplaza su adaptador por uno con
+        # pool configurable y timeout por defecto. Los reintentos se manejan en _with_retry (solo lecturas).
+        #
+        # En chromadb 0.4.x cada HttpClient tiene su propio servidor y sesion, pero otras versiones comparten el
+        # servidor (SharedSystemClient) entre los clientes de un mismo host. Cada sesion se configura y se cierra solo
+        # por el Client que la configuro primero: si ya pertenece a otro Client se usa tal cual, sin modificarla ni
+        # cerrarla en disconnect().
+        session = getattr(getattr(client, '_server', None), '_session', None)
+        
+        if session is None:
+            return
+        
+        owner = _SESSION_OWNERS.get(session)
+        
+        if owner is not None and owner() not in (None, self):
+            logger.warning('La sesion HTTP de chroma es compartida con otro Client: se utiliza sin modificar su pool de conexiones.')
+            return
+        
+        _SESSION_OWNERS[session] = weakref.ref(self)
+        self._session = session
+        
+        self._adapter = _PoolAdapter(
+            timeout=self.connection_settings['timeout'],
+            pool_connections=self.connection_settings['pool_connections'],
+            pool_maxsize=self.connection_settings['pool_maxsize'],
+            pool_block=self.connection_settings['pool_block'],
+            max_retries=0
+        )
+        self._session.mount('http://', self._adapter)
+        self._session.mount('https://', self._adapter)
+        
+        if not self.connection_settings['keep_alive']:
+            self._session.headers['Connection'] = 'close'
+    
+    def _with_retry(self, function, *args, **kwargs):
+        # reintentos con backoff exponencial y jitter completo para operaciones idempotentes
+        retries = self.connection_settings['retries']
+        backoff_factor = self.connection_settings['backoff_factor']
+        
+        for attempt in range(retries + 1):
+            try:
+                return function(*args, **kwargs)
+            
+            except (requests.ConnectionError, requests.Timeout):
+                if attempt == retries:
+                    raise
+                
+                time.sleep(random.uniform(0, backoff_factor * 2 ** attempt))
+    
+    def pool_stats(self) -> dict:
+        """
+        Devuelve el estado del pool de conexiones HTTP, para detectar si esta saturado.
+        
+        ```python
+        {'pools': [{'host': 'localhost', 'port': 8000, 'maxsize': 10, 'in_use': 3, 'available': 7,
+                    'connections_opened': 4, 'requests': 1520}],
+         'saturated': False}
+        ```
+        """
+        pools = []
+        
+        if self._adapter:
+            manager = self._adapter.poolmanager
+            
+            for key in list(manager.pools.keys()):
+                pool = manager.pools.get(key)
+                if pool is None:
+                    continue
+                
+                # la cola del pool contiene las conexiones libres (o lugares libres sin conexion abierta)
+                available = pool.pool.qsize() if pool.pool else 0
+                pools.append({
+                    'host': pool.host,
+                    'port': pool.port,
+                    'maxsize': pool.pool.maxsize if pool.pool else 0,
+                    'in_use': (pool.pool.maxsize - available) if pool.pool else 0,
+                    'available': available,
+                    'connections_opened': pool.num_connections,
+                    'requests': pool.num_requests,
+                })
+        
+        return {
+            'pools': pools,
+            'saturated': any(pool['available'] == 0 for pool in pools),
+        }
         
     def get_database_collections(self) -> Sequence[chromadb.Collection]:
         """
@@ -62,7 +279,7 @@ class Client:
         
         ```
         """
-        return self.client.list_collections()
+        return self._with_retry(self.client.list_collections)
     
     def get_cursor_info(self, ignore_embeddings:bool=True, n_rows:int=5) -> pd.DataFrame:
         """
@@ -71,7 +288,7 @@ class Client:
         Por defecto ignora la columna de embeddings para una mejor representacion visual.
         """
         if self.cursor:
-            dataframe = pd.DataFrame(self.cursor.peek())
+            dataframe = pd.DataFrame(self._with_retry(self.cursor.peek))
             
             if ignore_embeddings:
                 dataframe = dataframe.drop('embeddings', axis=1)
@@ -84,21 +301,32 @@ class Client:
         
         Este cursor se utiliza para realizar llamados de ```GET, POST, UPDATE, DELETE``` a la coleccion seleccionada
         """
-        for collection in self.get_database_collections():
-
-            if collection_name in getattr(collection, 'name'):
-                self.cursor = self.client.get_collection(collection_name)
-                break
+        collection = self._with_retry(self.registry.get, collection_name)
+        
+        if collection:
+            self.cursor = collection
             
         else:
-            print('No se ha encontrado al coleccion solicitada.')
+            logger.warning('No se ha encontrado al coleccion solicitada.')
+        
+    def embed_query(self, query_text:str) -> list:
+        """
+        Calcula localmente el embedding de una consulta (una lista con un vector por texto).
         
-    def execute_query(self, query_text:str, n_results:int= 5, include:list[str]=['documents', 'metadatas', 'distances']) -> chromadb.QueryResult:
+        El resultado se puede reutilizar en varias colecciones y reintentos a traves del parametro ```query_embeddings```
+        de ```execute_query```, ```query_collection``` y ```execute_queries```, evitando volver a pasar por el modelo.
+        """
+        return self.embedding_function([query_text] if isinstance(query_text, str) else list(query_text))
+    
+    def execute_query(self, query_text:str, n_results:int= 5, include:list[str]=['documents', 'metadatas', 'distances'], query_embeddings:list=None, where:dict=None) -> chromadb.QueryResult:
         """
         Ejecuta una query a la coleccion establecida en el cursor.
         Necesita de un cursor.
         Si no existe un cursor, este metodo retornara None
         
+        Si no se indica ```query_embeddings``` el embedding de la consulta se calcula localmente (ver ```embed_query```).
+        ```where``` filtra los resultados por metadata, por ejemplo ```{'tipificacion': 'Clave fiscal'}```.
+        
         Devuelve:
         ```python
             {'documents': list[str],
@@ -109,15 +337,246 @@ class Client:
         """
         if self.cursor:
 
-            return self.cursor.query(
-                query_texts= query_text,
+            return self._query(self.cursor, query_text, n_results, include, query_embeddings, where)
+    
+    def execute_queries(self, query_texts:list[str]=None, query_embeddings:list=None, n_results:int= 5, include:list[str]=['documents', 'metadatas', 'distances'], batch_size:int=100, workers:int=1, where:dict=None) -> chromadb.QueryResult:
+        """
+        Ejecuta muchas queries a la coleccion establecida en el cursor, enviando ```batch_size``` consultas por llamado al servidor.
+        Necesita de un cursor.
+        
+        Se indican los textos (```query_texts```) o los embeddings ya calculados (```query_embeddings```).
+        Con ```workers``` > 1 los bloques se envian en paralelo. ```where``` se aplica a todas las consultas.
+        
+        El resultado esta alineado con las consultas de entrada:
+        ```python
+        response = client.execute_queries(['pregunta 1', 'pregunta 2', ...], batch_size=200, workers=4)
+        response['documents'][1] # resultados de 'pregunta 2'
+        ```
+        """
+        if self.cursor:
+            
+            return query_in_batches(
+                self.cursor,
+                query_texts= query_texts,
+                query_embeddings= query_embeddings,
                 n_results= n_results,
-                include=include
+                include= include,
+                batch_size= batch_size,
+                workers= workers,
+                where= build_where(where)
             )
+    
+    def query_collection(self, collection_name:str, query_text:str, n_results:int= 5, include:list[str]=['documents', 'metadatas', 'distances'], query_embeddings:list=None, where:dict=None) -> chromadb.QueryResult:
+        """
+        Ejecuta una query a la coleccion indicada, sin utilizar ni modificar el cursor.
+        Es el metodo a utilizar cuando el cliente se comparte entre varios hilos (por ejemplo en la API de Flask).
+        
+        La coleccion se obtiene del registro, por lo que cada consulta es un unico llamado al servidor.
+        Si no se indica ```query_embeddings``` el embedding de la consulta se calcula localmente (ver ```embed_query```).
+        ```where``` filtra los resultados por metadata (ver ```execute_query```).
+        """
+        collection = self._with_retry(self.registry.get, collection_name)
+        
+        if not collection:
+            logger.warning('No se ha encontrado al coleccion solicitada.')
+            return None
+        
+        try:
+            return self._query(collection, query_text, n_results, include, query_embeddings, where)
+        
+        except Exception as e:
+            # la coleccion pudo haber sido eliminada o recreada: se vuelve a resolver una vez. Los demas errores
+            # (filtros invalidos, servidor caido, timeouts ya reintentados) se propagan sin cambios
+            if not _collection_missing(e):
+                raise
+            
+            self.registry.invalidate(collection_name)
+            self._invalidate_indexes(collection_name)
+            collection = self._with_retry(self.registry.get, collection_name)
+            
+            if not collection:
+                raise
             
-    def insert_data(self, data:dict) -> None:
+            # el embedding de la consulta ya esta en el cache de embeddings: no vuelve a pasar por el modelo
+            return self._query(collection, query_text, n_results, include, query_embeddings, where)
+    
+    def category_stats(self, collection_name:str) -> dict:
+        """
+        Devuelve la cantidad de documentos por categoria de la coleccion (ver ```category_index.CategoryIndex.stats```).
+        """
+        collection = self._with_retry(self.registry.get, collection_name)
+        
+        if collection and self.categories:
+            self.check_version(collection_name)
+            return self.categories.stats(collection)
+    
+    def check_version(self, collection_name:str, force:bool=False) -> None:
+        """
+        Descarta los resultados cacheados y los indices en memoria de la coleccion si otro proceso escribio en ella
+        (ver ```version_check_interval```).
+        """
+        if self.versions and self._with_retry(self.versions.changed, collection_name, force):
+            logger.info('La coleccion %s fue modificada por otro proceso: se descartan su cache e indices', collection_name)
+            
+            if self.query_cache:
+                self.query_cache.invalidate(collection_name)
+            
+            self._invalidate_indexes(collection_name)
+    
+    def _query(self, collection:chromadb.Collection, query_text:str, n_results:int, include:list[str], query_embeddings:list=None, where:dict=None) -> chromadb.QueryResult:
+        where = build_where(where)
+        self.check_version(collection.name)
+        
+        # atajo: preguntas frecuentes identicas a un documento de la coleccion (sin filtros)
+        exact = None
+        
+        if self.exact and not where:
+            with track('exact_match', collection=collection.name, batch_size=1) as op:
+                exact = self.exact.query(collection, query_text, n_results, include)
+                if exact is not None:
+                    op.results = len(exact['ids'][0])
+            
+            # con n_results coincidencias no hace falta la busqueda por embeddings
+            if exact is not None and len(exact['ids'][0]) >= n_results:
+                return exact
+        
+        response = self._vector_query(collection, query_text, n_results, include, query_embeddings, where)
+        
+        # las coincidencias exactas van primero y el resto se completa con la busqueda por embeddings
+        return merge_results(exact, response, n_results) if exact is not None else response
+    
+    def _vector_query(self, collection:chromadb.Collection, query_text:str, n_results:int, include:list[str], query_embeddings:list=None, where:dict=None) -> chromadb.QueryResult:
+        if self.query_cache:
+            # version previa a la consulta: si una escritura la invalida mientras tanto, el resultado no se cachea
+            version = self.query_cache.version(collection.name)
+            response = self.query_cache.get(collection.name, query_text, n_results, include, where)
+            QUERY_CACHE.inc(collection=collection.name, result='miss' if response is None else 'hit')
+            if response is not None:
+                return response
+        
+        # el embedding se calcula una sola vez aca y no dentro de collection.query()
+        if query_embeddings is None:
+            query_embeddings = self.embed_query(query_text)
+        
+        query_function = self._query_function(collection, where)
+        
+        with track('query', collection=collection.name, batch_size=len(query_embeddings)) as op:
+            if self.lexical:
+                response = hybrid_query(
+                    collection,
+                    self.lexical.get(collection),
+                    [query_text] if isinstance(query_text, str) else list(query_text),
+                    query_embeddings,
+                    n_results= n_results,
+                    include= include,
+                    query_function= query_function,
+                    where= where
+                )
+            else:
+                response = query_function(
+                    query_embeddings= query_embeddings,
+                    n_results= n_results,
+                    include=include,
+                    where= where
+                )
+            op.results = sum(len(ids) for ids in response['ids'])
+        
+        if self.query_cache:
+            self.query_cache.set(collection.name, query_text, n_results, include, response, version, where)
+        
+        return response
+    
+    def _query_function(self, collection:chromadb.Collection, where:dict=None):
+        # consulta por embeddings con reintentos; las consultas filtradas por categorias chicas se resuelven localmente
+        query_function = lambda **kwargs: self._with_retry(collection.query, **kwargs)
+        
+        if where and self.categories:
+            return self.categories.query_function(collection, query_function)
+        
+        return query_function
+    
+    def search(self, query_text:str, collection_names:list[str], n_results:int=5, include:list[str]=['documents', 'metadatas', 'distances'], limit:int=None, query_embeddings:list=None, where:dict=None) -> list[dict]:
+        """
+        Busca en varias colecciones a la vez y devuelve una unica lista de resultados ordenada por distancia.
+        
+        La consulta se embebe una sola vez y las colecciones se consultan en paralelo con el mismo vector, por lo
+        que la latencia es la de la coleccion mas lenta y no la suma de todas.
+        
+        ```python
+        client.search('Que es la recategorizacion?', ['abc_collection', 'crm_collection', 'monotributo_collection'])
+        # [{'collection': 'monotributo_collection', 'id': ..., 'document': ..., 'metadata': {...}, 'distance': 0.21}, ...]
+        ```
+        
+        - n_results: cantidad de resultados por coleccion
+        - limit: cantidad maxima de resultados de la lista final (por defecto todos)
+        - where: filtro de metadata, aplicado en todas las colecciones
+        """
+        include = list(dict.fromkeys([*include, 'distances']))
+        where = build_where(where)
+        
+        if query_embeddings is None:
+            query_embeddings = self.embed_query(query_text)
+        
+        def consultar(collection_name:str) -> list[dict]:
+            collection = self._with_retry(self.registry.get, collection_name)
+            
+            if not collection:
+                return []
+            
+            self.check_version(collection_name)
+            
+            with track('query', collection=collection_name, batch_size=len(query_embeddings)) as op:
+                response = self._query_function(collection, where)(query_embeddings= query_embeddings, n_results= n_results, include= include, where= where)
+                op.results = len(response['ids'][0])
+            
+            return [
+                {
+                    'collection': collection_name,
+                    'id': id,
+                    'document': response['documents'][0][i] if response.get('documents') else None,
+                    'metadata': response['metadatas'][0][i] if response.get('metadatas') else None,
+                    'distance': response['distances'][0][i],
+                }
+                for i, id in enumerate(response['ids'][0])
+            ]
+        
+        hits = [hit for resultados in self._get_executor().map(consultar, collection_names) for hit in resultados]
+        hits.sort(key=lambda hit: hit['distance'])
+        
+        return hits[:limit] if limit else hits
+    
+    def _get_executor(self) -> ThreadPoolExecutor:
+        # pool de hilos de search: se crea una unica vez aunque varios hilos busquen a la vez
+        with self._executor_lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.connection_settings['pool_maxsize'])
+            
+            return self._executor
+    
+    def _get_target(self, collection_name:str=None) -> chromadb.Collection:
+        # coleccion sobre la que se escribe: la indicada o la del cursor
+        if collection_name:
+            return self.registry.get(collection_name)
+        
+        return self.cursor
+    
+    def _invalidate(self, collection:chromadb.Collection) -> None:
+        if self.query_cache:
+            self.query_cache.invalidate(collection.name)
+        
+        # los demas procesos detectan la nueva version en su proxima consulta a la coleccion
+        if self.versions:
+            self._with_retry(self.versions.bump, collection.name)
+    
+    def _invalidate_indexes(self, collection_name:str) -> None:
+        # los indices en memoria se vuelven a construir a partir de la coleccion en la proxima consulta
+        for indexes in (self.lexical, self.exact, self.categories):
+            if indexes:
+                indexes.invalidate(collection_name)
+            
+    def insert_data(self, data:dict, collection_name:str=None) -> None:
         """
-        Inserta un nuevo valor dentro de una coleccion. Necesita de un cursor.
+        Inserta un nuevo valor dentro de una coleccion. Necesita de un cursor, o del nombre de la coleccion en ```collection_name```.
         
         El formato de ```data``` debera ser:
         
@@ -131,23 +590,36 @@ class Client:
         """
         
         try:
-            if self.cursor:
+            collection = self._get_target(collection_name)
+            
+            if collection:
                 document = data['document']
                 metadata = data['metadata']
                 id = data['id']
                 
-                self.cursor.add(
-                    documents= document,
-                    metadatas= metadata,
-                    ids= id
-                )
+                with track('add', collection=collection.name, batch_size=len(id) if isinstance(id, list) else 1):
+                    collection.add(
+                        documents= document,
+                        metadatas= metadata,
+                        ids= id
+                    )
+                self._invalidate(collection)
+                
+                if self.lexical:
+                    self.lexical.add(collection.name, _as_list(id), _as_list(document), _as_list(metadata))
+                
+                if self.exact:
+                    self.exact.add(collection.name, _as_list(id), _as_list(document), _as_list(metadata))
+                
+                if self.categories:
+                    self.categories.add(collection.name, _as_list(id), _as_list(metadata))
             
         except Exception as e:
-            print('No se ha podido agregar el dato a la coleccion.', e)
+            logger.error('No se ha podido agregar el dato a la coleccion. %s', e)
     
-    def update_data(self, data:dict):
+    def update_data(self, data:dict, collection_name:str=None):
         """
-        Actualiza un valor dentro de una coleccion. Necesita de un cursor.
+        Actualiza un valor dentro de una coleccion. Necesita de un cursor, o del nombre de la coleccion en ```collection_name```.
         
         El formato de ```data``` debera ser:
         
@@ -159,22 +631,37 @@ class Client:
         }
         """
         
-        if self.cursor:      
-            document = data['document']
-            metadata = data['metadata']
+        collection = self._get_target(collection_name)
+        
+        if collection:
+            # 'document' y 'metadata' son opcionales: solo se actualiza lo indicado
+            document = data.get('document')
+            metadata = data.get('metadata')
             id = data['id']            
             
-            self.cursor.update(
-                ids= id,
-                documents= document,
-                metadatas= metadata
-            )
+            with track('update', collection=collection.name, batch_size=len(id) if isinstance(id, list) else 1):
+                collection.update(
+                    ids= id,
+                    documents= document,
+                    metadatas= metadata
+                )
+            self._invalidate(collection)
+            
+            # la actualizacion puede ser parcial: el indice lexico vuelve a leer los documentos actualizados
+            if self.lexical:
+                self.lexical.refresh(collection, _as_list(id))
+            
+            if self.exact:
+                self.exact.refresh(collection, _as_list(id))
+            
+            if self.categories and metadata is not None:
+                self.categories.refresh(collection, _as_list(id))
         
         pass
     
-    def delete_data(self, data:dict):
+    def delete_data(self, data:dict, collection_name:str=None):
         """
-        Elimina un valor dentro de una coleccion. Necesita de un cursor.
+        Elimina un valor dentro de una coleccion. Necesita de un cursor, o del nombre de la coleccion en ```collection_name```.
         
         El formato de ```data``` debera ser:
         
@@ -186,17 +673,57 @@ class Client:
         }
         """
         
-        if self.cursor:
+        collection = self._get_target(collection_name)
+        
+        if collection:
             id = data['id']
             
-            self.cursor.delete(
-                ids = id
-                )
+            with track('delete', collection=collection.name, batch_size=len(id) if isinstance(id, list) else 1):
+                collection.delete(
+                    ids = id
+                    )
+            self._invalidate(collection)
+            
+            if self.lexical:
+                self.lexical.remove(collection.name, _as_list(id))
+            
+            if self.exact:
+                self.exact.remove(collection.name, _as_list(id))
+            
+            if self.categories:
+                self.categories.remove(collection.name, _as_list(id))
     
     def disconnect(self):
-        """ Desconecta el cliente de la base de datos."""
-        # la libreria no provee ningun metodo particular para terminar la conexion a la base de datos
+        """
+        Desconecta el cliente de la base de datos y cierra las conexiones del pool. Una sesion HTTP compartida con otro
+        Client (ver ```_configure_transport```) no se cierra.
+        """
+        if self._session is not None:
+            _SESSION_OWNERS.pop(self._session, None)
+            self._session.close()
+        
+        with self._executor_lock:
+            if self._executor is not None:
+                self._executor.shutdown(wait=False)
+                self._executor = None
+        
+        self._session = None
+        self._adapter = None
         self.client = None
+        self.registry = None
+        self.cursor = None
+    
+    def close(self) -> None:
+        """ Equivalente a ```disconnect()```. """
+        self.disconnect()
+    
+    def __enter__(self) -> 'Client':
+        if self.client is None:
+            self.connect()
+        return self
+    
+    def __exit__(self, *exc) -> None:
+        self.close()
     
 
 if __name__ == '__main__':
@@ -0,0 +1,312 @@
+"""
+Modulo para conexion remota asincronica a base de datos chroma.
+
+Contraparte de ```cliente.Client``` basada en asyncio: las consultas no bloquean un hilo, por lo que un unico proceso
+(por ejemplo un frontend ASGI) puede atender miles de busquedas concurrentes.
+"""
+
+import asyncio
+import json
+from typing import Optional
+
+import httpx
+import chromadb
+
+from embedding_cache import EmbeddingCache
+from embeddings import get_embedding_backend
+from query_cache import QueryCache
+from category_index import build_where
+from metrics import track, logger, QUERY_CACHE
+
+
+DEFAULT_TENANT = 'default_tenant'
+DEFAULT_DATABASE = 'default_database'
+
+
+def _as_list(value) -> Optional[list]:
+    if value is None or isinstance(value, list):
+        return value
+    return [value]
+
+
+class ChromaError(Exception):
+    """ Respuesta de error del servidor de chroma. ```status_code``` es el codigo HTTP de la respuesta. """
+
+    def __init__(self, status_code:int, message:str) -> None:
+        self.status_code = status_code
+        super().__init__(message)
+
+    @property
+    def not_found(self) -> bool:
+        # chroma 0.4.x responde 500 con 'does not exist'; las versiones posteriores responden 404
+        return self.status_code == 404 or 'does not exist' in str(self)
+
+
+class AsyncClient:
+    """
+    Establece una interfaz asincronica para conectarse al servidor de base de datos de chroma.
+
+    Utiliza un pool de conexiones HTTP con keep-alive (httpx) y limita la cantidad de pedidos simultaneos
+    al servidor con ```max_concurrency```. Los embeddings se calculan localmente, fuera del event loop.
+
+    ```python
+    async with AsyncClient() as client:
+        await client.set_cursor('abc_collection')
+        results = await client.execute_query('Que es la recategorizacion?', n_results=2)
+    ```
+    """
+
+    def __init__(self, host:str='localhost', port:int=8000, embedding_function=None, embedding_cache_path:str=None, query_cache:QueryCache=None,
+                 max_connections:int=100, max_keepalive_connections:int=20, keepalive_expiry:float=30, timeout:float=30, max_concurrency:int=64,
+                 embedding_options:dict=None, **kwargs) -> None:
+
+        self.database = kwargs.get('database') or DEFAULT_DATABASE
+        self.tenant = kwargs.get('tenant') or DEFAULT_TENANT
+
+        self._port = port
+        self._host = host
+        self._api_url = f'http://{host}:{port}/api/v1'
+
+        self.connection_settings = {
+            'port': port,
+            'host': host,
+            'max_connections': max_connections,
+            'max_keepalive_connections': max_keepalive_connections,
+            'keepalive_expiry': keepalive_expiry,
+            'timeout': timeout,
+            'max_concurrency': max_concurrency,
+        }
+
+        self.embedding_function = EmbeddingCache(
+            get_embedding_backend(embedding_function, **(embedding_options or {})),
+            cache_path=embedding_cache_path
+        )
+        self.query_cache = query_cache
+
+        self.client:httpx.AsyncClient = None
+        self.cursor:dict = None
+
+        # registro nombre -> coleccion ({'name', 'id', 'metadata'})
+        self._collections:dict[str, dict] = {}
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+
+    async def connect(self) -> None:
+        self.client = httpx.AsyncClient(
+            base_url=self._api_url,
+            timeout=self.connection_settings['timeout'],
+            limits=httpx.Limits(
+                max_connections=self.connection_settings['max_connections'],
+                max_keepalive_connections=self.connection_settings['max_keepalive_connections'],
+                keepalive_expiry=self.connection_settings['keepalive_expiry'],
+            ),
+            headers={'Content-Type': 'application/json'},
+        )
+
+    async def __aenter__(self) -> 'AsyncClient':
+        await self.connect()
+        return self
+
+    async def __aexit__(self, *exc) -> None:
+        await self.disconnect()
+
+    async def heartbeat(self) -> int:
+        """ Devuelve la hora del servidor en nanosegundos. Sirve para verificar que el servidor este disponible. """
+        body = await self._request('GET', '')
+        return int(body['nanosecond heartbeat'])
+
+    async def get_database_collections(self) -> list[dict]:
+        """ Devuelve informacion de las colecciones que contiene la base de datos. """
+        return await self._request('GET', '/collections', params={'tenant': self.tenant, 'database': self.database})
+
+    async def get_collection(self, collection_name:str) -> Optional[dict]:
+        """
+        Devuelve la coleccion solicitada (```{'name', 'id', 'metadata'}```). Cada coleccion se pide al servidor una unica vez.
+        Si la coleccion no existe, devuelve None. Los demas errores (servidor caido, timeout, etc.) se propagan.
+        """
+        collection = self._collections.get(collection_name)
+
+        if collection is None:
+            try:
+                collection = await self._request('GET', f'/collections/{collection_name}', params={'tenant': self.tenant, 'database': self.database})
+            except ChromaError as e:
+                if e.not_found:
+                    return None
+                raise
+
+            self._collections[collection_name] = collection
+
+        return collection
+
+    async def set_cursor(self, collection_name:str) -> None:
+        """
+        Establece un cursor a una collecion dentro de la base de datos.
+
+        Este cursor se utiliza para realizar llamados de ```GET, POST, UPDATE, DELETE``` a la coleccion seleccionada
+        """
+        collection = await self.get_collection(collection_name)
+
+        if collection:
+            self.cursor = collection
+
+        else:
+            logger.warning('No se ha encontrado al coleccion solicitada.')
+
+    async def execute_query(self, query_text:str, n_results:int= 5, include:list[str]=['documents', 'metadatas', 'distances'], where:dict=None) -> chromadb.QueryResult:
+        """
+        Ejecuta una query a la coleccion establecida en el cursor.
+        Necesita de un cursor.
+        Si no existe un cursor, este metodo retornara None
+
+        ```where``` filtra los resultados por metadata y se aplica en el servidor (ver ```Client.execute_query```).
+        """
+        if self.cursor:
+
+            return await self._query(self.cursor, query_text, n_results, include, where)
+
+    async def query_collection(self, collection_name:str, query_text:str, n_results:int= 5, include:list[str]=['documents', 'metadatas', 'distances'], where:dict=None) -> chromadb.QueryResult:
+        """
+        Ejecuta una query a la coleccion indicada, sin utilizar ni modificar el cursor.
+        """
+        collection = await self.get_collection(collection_name)
+
+        if collection:
+
+            return await self._query(collection, query_text, n_results, include, where)
+
+    async def insert_data(self, data:dict, collection_name:str=None) -> None:
+        """
+        Inserta un nuevo valor dentro de una coleccion. Necesita de un cursor, o del nombre de la coleccion en ```collection_name```.
+        El formato de ```data``` es el mismo que en ```Client.insert_data```.
+        """
+        try:
+            collection = await self._get_target(collection_name)
+
+            if collection:
+                documents = _as_list(data['document'])
+
+                await self._write('add', collection, {
+                    'ids': _as_list(data['id']),
+                    'embeddings': await self._embed(documents),
+                    'metadatas': _as_list(data['metadata']),
+                    'documents': documents,
+                    'uris': None,
+                })
+                self._invalidate(collection)
+
+        except Exception as e:
+            logger.error('No se ha podido agregar el dato a la coleccion. %s', e)
+
+    async def update_data(self, data:dict, collection_name:str=None) -> None:
+        """
+        Actualiza un valor dentro de una coleccion. Necesita de un cursor, o del nombre de la coleccion en ```collection_name```.
+        'document' y 'metadata' son opcionales: solo se actualiza lo indicado.
+        """
+        collection = await self._get_target(collection_name)
+
+        if collection:
+            documents = _as_list(data.get('document'))
+
+            await self._write('update', collection, {
+                'ids': _as_list(data['id']),
+                'embeddings': await self._embed(documents) if documents else None,
+                'metadatas': _as_list(data.get('metadata')),
+                'documents': documents,
+                'uris': None,
+            })
+            self._invalidate(collection)
+
+    async def delete_data(self, data:dict, collection_name:str=None) -> None:
+        """
+        Elimina un valor dentro de una coleccion. Necesita de un cursor, o del nombre de la coleccion en ```collection_name```.
+        """
+        collection = await self._get_target(collection_name)
+
+        if collection:
+            await self._write('delete', collection, {
+                'ids': _as_list(data['id']),
+                'where': {},
+                'where_document': {},
+            })
+            self._invalidate(collection)
+
+    async def disconnect(self) -> None:
+        """ Cierra las conexiones del pool. """
+        if self.client:
+            await self.client.aclose()
+            self.client = None
+
+    async def _query(self, collection:dict, query_text:str, n_results:int, include:list[str], where:dict=None) -> chromadb.QueryResult:
+        where = build_where(where)
+
+        if self.query_cache:
+            # version previa a la consulta: si una escritura la invalida mientras tanto, el resultado no se cachea
+            version = self.query_cache.version(collection['name'])
+            response = self.query_cache.get(collection['name'], query_text, n_results, include, where)
+            QUERY_CACHE.inc(collection=collection['name'], result='miss' if response is None else 'hit')
+            if response is not None:
+                return response
+
+        query_embeddings = await self._embed(_as_list(query_text))
+
+        with track('query', collection=collection['name'], batch_size=len(query_embeddings)) as op:
+            response = await self._request('POST', f'/collections/{collection["id"]}/query', body={
+                'query_embeddings': query_embeddings,
+                'n_results': n_results,
+                'where': where or {},
+                'where_document': {},
+                'include': include,
+            })
+            op.results = sum(len(ids) for ids in response['ids'])
+
+        # mismo formato que collection.query()
+        response = {key: response.get(key) for key in ('ids', 'distances', 'embeddings', 'metadatas', 'documents', 'uris')}
+        response['data'] = None
+
+        if self.query_cache:
+            self.query_cache.set(collection['name'], query_text, n_results, include, response, version, where)
+
+        return response
+
+    async def _write(self, operation:str, collection:dict, body:dict) -> None:
+        with track(operation, collection=collection['name'], batch_size=len(body['ids'])):
+            await self._request('POST', f'/collections/{collection["id"]}/{operation}', body=body)
+
+    async def _embed(self, documents:list[str]) -> list:
+        # el modelo de embeddings es bloqueante: se ejecuta fuera del event loop
+        return await asyncio.to_thread(self.embedding_function, documents)
+
+    async def _get_target(self, collection_name:str=None) -> dict:
+        if collection_name:
+            return await self.get_collection(collection_name)
+
+        return self.cursor
+
+    def _invalidate(self, collection:dict) -> None:
+        if self.query_cache:
+            self.query_cache.invalidate(collection['name'])
+
+    async def _request(self, method:str, path:str, params:dict=None, body:dict=None):
+        if not self.client:
+            await self.connect()
+
+        async with self._semaphore:
+            response = await self.client.request(method, path, params=params, content=json.dumps(body) if body is not None else None)
+
+        if response.is_error:
+            raise ChromaError(response.status_code, response.text)
+
+        return response.json()
+
+
+if __name__ == '__main__':
+
+    async def main():
+        async with AsyncClient() as cliente:
+            await cliente.set_cursor('monotributo_collection')
+
+            consultas = ['Que es la recategorizacion?', 'Como me doy de baja?', 'Que categoria me corresponde?']
+            results = await asyncio.gather(*(cliente.execute_query(consulta, n_results=2) for consulta in consultas))
+
+            print(results)
+
+    asyncio.run(main())
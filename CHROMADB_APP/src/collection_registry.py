@@ -0,0 +1,85 @@
+"""
+Registro de colecciones (nombre -> chromadb.Collection).
+
+Evita recorrer ```list_collections()``` y volver a pedir la coleccion al servidor en cada consulta: cada coleccion
+se resuelve una sola vez y luego se reutiliza. Lo comparten ```Database```, ```Client``` y la API de Flask.
+"""
+
+import threading
+
+import chromadb
+from chromadb.api import ClientAPI
+
+
+class CollectionRegistry:
+    """
+    Mapa nombre -> coleccion que se completa de manera perezosa.
+
+    ```python
+    registry = CollectionRegistry(chromadb.HttpClient(), embedding_function)
+    collection = registry.get('abc_collection')   # un unico llamado al servidor
+    collection = registry.get('abc_collection')   # sin llamados al servidor
+    ```
+
+    - get: devuelve la coleccion. Si no esta registrada la pide al servidor (un llamado). Si no existe devuelve None.
+    - invalidate: descarta una coleccion (o todas). Se debe llamar al eliminar o recrear una coleccion.
+    - refresh: sincroniza el registro con las colecciones existentes en el servidor.
+    """
+
+    def __init__(self, client:ClientAPI, embedding_function=None) -> None:
+        self.client = client
+        self.embedding_function = embedding_function
+
+        self._collections:dict[str, chromadb.Collection] = {}
+        self._lock = threading.Lock()
+
+    def get(self, collection_name:str) -> chromadb.Collection:
+        collection = self._collections.get(collection_name)
+
+        if collection is None:
+            try:
+                collection = self.client.get_collection(collection_name, embedding_function=self.embedding_function)
+            except Exception as e:
+                # en modo local chroma lanza ValueError, y a traves de HTTP una Exception con el mismo mensaje
+                if 'does not exist' in str(e):
+                    return None
+                raise
+
+            self.register(collection)
+
+        return collection
+
+    def create(self, collection_name:str, **kwargs) -> chromadb.Collection:
+        """ Crea una coleccion en el servidor y la registra. """
+        collection = self.client.create_collection(collection_name, embedding_function=self.embedding_function, **kwargs)
+        self.register(collection)
+
+        return collection
+
+    def register(self, collection:chromadb.Collection) -> None:
+        with self._lock:
+            self._collections[collection.name] = collection
+
+    def invalidate(self, collection_name:str=None) -> None:
+        with self._lock:
+            if collection_name:
+                self._collections.pop(collection_name, None)
+            else:
+                self._collections.clear()
+
+    def refresh(self) -> list[str]:
+        """
+        Descarta las colecciones registradas que ya no existen en el servidor (o fueron recreadas) y devuelve
+        los nombres de las colecciones existentes.
+        """
+        existentes = {collection.name: collection.id for collection in self.client.list_collections()}
+
+        with self._lock:
+            for name, collection in list(self._collections.items()):
+                if existentes.get(name) != collection.id:
+                    del self._collections[name]
+
+        return list(existentes)
+
+    def __contains__(self, collection_name:str) -> bool:
+        return collection_name in self._collections
@@ -0,0 +1,100 @@
+"""
+Versiones de colecciones compartidas entre procesos.
+
+El cache de consultas y los indices en memoria (BM25, preguntas exactas y categorias) son propios de cada proceso.
+Con varios workers (gunicorn) una escritura solo los invalida en el worker que la atendio. Para propagarla, cada
+escritura registra una nueva version de la coleccion en una coleccion auxiliar de chroma (```versiones_colecciones```)
+y cada worker compara la version de las colecciones que consulta, a lo sumo una vez cada ```check_interval``` segundos.
+Si cambio, el worker descarta sus resultados cacheados e indices de esa coleccion.
+
+Las consultas de los demas workers pueden devolver datos anteriores a una escritura durante a lo sumo
+```check_interval``` segundos.
+
+```python
+versions = CollectionVersions(check_interval=1.0)
+versions.connect(chromadb.HttpClient())
+versions.bump('crm_collection')        # luego de escribir
+versions.changed('crm_collection')     # en otro proceso: True una vez, cuando detecta la nueva version
+```
+"""
+
+import time
+import uuid
+import threading
+
+import chromadb
+from chromadb.api import ClientAPI
+
+
+# version de una coleccion que todavia no se consulto en este proceso
+_UNKNOWN = object()
+
+
+class CollectionVersions:
+    """
+    Registro de versiones de colecciones en chroma.
+
+    - collection_name: coleccion auxiliar donde se guarda la version de cada coleccion (un registro por coleccion)
+    - check_interval: segundos entre dos lecturas de la version de una misma coleccion (0: en cada consulta)
+    """
+
+    def __init__(self, collection_name:str='versiones_colecciones', check_interval:float=1.0) -> None:
+        self.collection_name = collection_name
+        self.check_interval = check_interval
+
+        self.client:ClientAPI = None
+
+        self._collection:chromadb.Collection = None
+        self._versions:dict[str, str] = {}
+        self._checked:dict[str, float] = {}
+        self._lock = threading.Lock()
+
+    def connect(self, client:ClientAPI) -> None:
+        """ Utiliza ```client``` para leer y escribir las versiones. Las versiones ya vistas se conservan. """
+        with self._lock:
+            self.client = client
+            self._collection = None
+
+    def bump(self, collection_name:str) -> None:
+        """ Registra una nueva version de la coleccion. Se debe llamar luego de cada escritura. """
+        version = uuid.uuid4().hex
+
+        # la coleccion auxiliar no tiene funcion de embeddings: cada registro lleva un vector de relleno
+        self._get_collection().upsert(ids=[collection_name], embeddings=[[0.0]], metadatas=[{'version': version}])
+
+        with self._lock:
+            self._versions[collection_name] = version
+            self._checked[collection_name] = time.monotonic()
+
+    def changed(self, collection_name:str, force:bool=False) -> bool:
+        """
+        Devuelve True si la coleccion tiene una version distinta de la ultima vista por este proceso (otro proceso
+        escribio en ella). Lee la version a lo sumo una vez cada ```check_interval``` segundos, salvo con ```force```.
+        La primera lectura de una coleccion solo registra su version.
+        """
+        now = time.monotonic()
+
+        with self._lock:
+            checked = self._checked.get(collection_name)
+
+            if not force and checked is not None and now - checked < self.check_interval:
+                return False
+
+            self._checked[collection_name] = now
+
+        stored = self._get_collection().get(ids=[collection_name], include=['metadatas'])
+        version = stored['metadatas'][0]['version'] if stored['ids'] else None
+
+        with self._lock:
+            previous = self._versions.get(collection_name, _UNKNOWN)
+            self._versions[collection_name] = version
+
+        return previous is not _UNKNOWN and previous != version
+
+    def _get_collection(self) -> chromadb.Collection:
+        collection = self._collection
+
+        if collection is None:
+            collection = self._collection = self.client.get_or_create_collection(self.collection_name, embedding_function=None)
+
+        return collection
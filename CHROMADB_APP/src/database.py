@@ -5,23 +5,76 @@ Permite la creacion, actualizacion, eliminacion y retribucion de colecciones y b
 """
 
 import chromadb
+import os
 import importlib
+import time
 import pandas as pd 
-from typing import Sequence
+from typing import Sequence, Optional
 
 from local_datasets import ABC, CRM, MONOTRIBUTO
+from ingestion import IngestionPipeline, chunk_data
+from embedding_cache import EmbeddingCache
+from embeddings import get_embedding_backend
+from collection_registry import CollectionRegistry
+from quantized_store import QuantizedStore, mark_stale
+from index_profiles import get_index_metadata, tune_index
+from metrics import track
+from lexical_index import LexicalIndexes, hybrid_query
+from exact_index import ExactMatchIndexes, merge_results
+from category_index import CategoryIndexes, build_where
+from exact_search import ExactSearchEngine
+from utilities import progress_bar, query_in_batches, content_hash, recall_at_k
+import snapshots
+
+
+def _as_list(value) -> Optional[list]:
+    if value is None or isinstance(value, list):
+        return value
+    return [value]
 
 
 class Database():
     """
     Interfaz de administracion de la base de datos
+    
+    ```embedding_function``` puede ser una funcion de embeddings o el nombre de un backend de ```embeddings```
+    ('default', 'onnx', 'hashing'), construido con ```embedding_options```:
+    
+    ```python
+    database = Database(embedding_function='onnx', embedding_options={'model_path': './models/all-MiniLM-L6-v2', 'intra_op_threads': 4})
+    ```
+    
+    Con ```hybrid=True``` ```query_collection``` combina los resultados por embeddings con un indice BM25 en memoria
+    de cada coleccion (ver ```lexical_index```). Los resultados quedan ordenados por reciprocal rank fusion, por lo que
+    las distancias no son necesariamente crecientes. Por defecto se utiliza solo la busqueda por embeddings.
+    
+    En las colecciones de ```exact_match``` las consultas identicas a una pregunta de la coleccion se resuelven sin
+    calcular el embedding (ver ```exact_index```). El indice se carga con los datos del dataset en ```build_collection```.
+    
+    Las consultas filtradas por una categoria con a lo sumo ```brute_force_threshold``` documentos se resuelven por
+    fuerza bruta (ver ```category_index```).
+    
+    Con ```exact_engine=True``` las consultas sin filtro se resuelven con un motor de busqueda exacta en memoria
+    (ver ```exact_search```) en lugar del indice HNSW. El motor tambien es la referencia de ```evaluate_recall```.
     """
-    def __init__(self, database_path:str='./database', persistent=True) -> None:
+    def __init__(self, database_path:str='./database', persistent=True, embedding_function=None, cache_embeddings:bool=True, embedding_options:dict=None,
+                 hybrid:bool=False, exact_match:list[str]=None, brute_force_threshold:int=2000, exact_engine:bool=False) -> None:
         
         self.database_path = database_path
+        self.persistent = persistent
         self.collections = []
         self.collections_names = []
         
+        # funcion de embeddings de las colecciones y del pipeline de ingesta en paralelo
+        self.embedding_function = get_embedding_backend(embedding_function, **(embedding_options or {}))
+        
+        # cache de embeddings: las reconstrucciones y consultas repetidas no vuelven a pasar por el modelo
+        if cache_embeddings:
+            self.embedding_function = EmbeddingCache(
+                self.embedding_function,
+                cache_path=os.path.join(database_path, 'embedding_cache.sqlite3') if persistent else None
+            )
+        
         self.__package = importlib.import_module('chromadb.config')
         self.__settings = getattr(self.__package, 'Settings')
         
@@ -30,7 +83,28 @@ class Database():
             self.collections = self.client.list_collections()
             
         else:
-            self.client = chromadb.Client(database_path, self.__settings(anonymized_telemetry=False))
+            # base de datos en memoria (database_path no se utiliza). Misma configuracion que index_profiles.tune_index:
+            # chroma comparte una unica instancia en memoria por proceso y exige que la configuracion coincida
+            self.client = chromadb.EphemeralClient(self.__settings(anonymized_telemetry=False))
+        
+        # registro nombre -> coleccion: evita recorrer list_collections() en cada llamado
+        self.registry = CollectionRegistry(self.client, self.embedding_function)
+        
+        # almacenes de vectores comprimidos por coleccion (ver build_quantized_store)
+        self.quantized_stores:dict[str, QuantizedStore] = {}
+        
+        # indices lexicos por coleccion (modo hibrido): se construyen en la primera consulta y se descartan al modificar la coleccion
+        self.lexical = LexicalIndexes() if hybrid else None
+        
+        # indices de preguntas exactas por coleccion (atajo sin embeddings)
+        self.exact = ExactMatchIndexes(exact_match) if exact_match else None
+        
+        # indices categoria -> ids por coleccion (consultas filtradas)
+        self.categories = CategoryIndexes(brute_force_threshold=brute_force_threshold) if brute_force_threshold else None
+        
+        # motores de busqueda exacta por coleccion: se cargan en la primera consulta (ver get_exact_engine)
+        self.exact_engine = exact_engine
+        self.exact_engines:dict[str, ExactSearchEngine] = {}
          
     def get_database_collections(self) -> dict[Sequence[chromadb.Collection], list[str]]:
         """
@@ -46,14 +120,12 @@ class Database():
         """
         Devuelve la coleccion solicitada. Si la coleccion no existe, devuelve None.
         """
-        for collection in self.client.list_collections():
-
-            if collection_name in getattr(collection, 'name'):
-                return collection
+        collection = self.registry.get(collection_name)
         
-        else:
+        if not collection:
             print('No se ha encontrado la coleccion solicitada.')
-            return None
+            
+        return collection
 
     
     def get_collection_info(self, collection_name:str, skip_embeddings=True) -> pd.DataFrame:
@@ -76,48 +148,156 @@ class Database():
             return df
                 
     
-    def query_collection(self, collection_name:str, query_text:str, n_results:int=5) -> chromadb.QueryResult:
+    def query_collection(self, collection_name:str, query_text:str, n_results:int=5, query_embeddings:list=None, where:dict=None) -> chromadb.QueryResult:
         """
         Realiza una consulta a la coleccion solicitada.
             - collection_name: nombre de la coleccion que se quiere consultar
             - query_text: consulta
             - n_results: cantidad de resultados a retribuir
+            - query_embeddings: embedding de la consulta ya calculado (ver ```embed_query```). Si no se indica, se
+              calcula una sola vez localmente
+            - where: filtro de metadata, por ejemplo ```{'categoria_principal': 'Recategorizacion'}```. Varios campos
+              se combinan con ```$and```
+        
+        En modo hibrido los resultados por embeddings y por BM25 se combinan con reciprocal rank fusion.
+        """
+        collection = self.get_collection(collection_name)
+        where = build_where(where)
+        
+        if collection:
+            exact = None
+            
+            if self.exact and not where:
+                with track('exact_match', collection=collection_name, batch_size=1) as op:
+                    exact = self.exact.query(collection, query_text, n_results, ['documents', 'metadatas', 'distances'])
+                    if exact is not None:
+                        op.results = len(exact['ids'][0])
+                
+                # con n_results coincidencias no hace falta la busqueda por embeddings
+                if exact is not None and len(exact['ids'][0]) >= n_results:
+                    return exact
+            
+            if query_embeddings is None:
+                query_embeddings = self.embed_query(query_text)
+            
+            # las consultas filtradas por categorias chicas se resuelven por fuerza bruta
+            if where and self.categories:
+                query_function = self.categories.query_function(collection)
+            elif self.exact_engine:
+                query_function = self.get_exact_engine(collection_name).query_function(collection)
+            else:
+                query_function = collection.query
+            
+            with track('query', collection=collection_name, batch_size=len(query_embeddings)) as op:
+                if self.lexical:
+                    response = hybrid_query(
+                        collection,
+                        self.lexical.get(collection),
+                        [query_text] if isinstance(query_text, str) else list(query_text),
+                        query_embeddings,
+                        n_results= n_results,
+                        query_function= query_function,
+                        where= where
+                    )
+                else:
+                    response = query_function(
+                        query_embeddings = query_embeddings,
+                        n_results= n_results,
+                        where= where
+                    )
+                op.results = sum(len(ids) for ids in response['ids'])
+            
+            # las coincidencias exactas van primero y el resto se completa con la busqueda por embeddings
+            return merge_results(exact, response, n_results) if exact is not None else response
+        
+        else:
+            # error handling
+            return None
+    
+    def embed_query(self, query_text:str) -> list:
+        """
+        Calcula el embedding de una consulta (una lista con un vector por texto), para reutilizarlo en varias colecciones.
+        """
+        return self.embedding_function([query_text] if isinstance(query_text, str) else list(query_text))
+     
+    def query_collection_batch(self, collection_name:str, query_texts:list[str]=None, query_embeddings:list=None, n_results:int=5, batch_size:int=100, workers:int=1,
+                               where:dict=None) -> chromadb.QueryResult:
+        """
+        Realiza muchas consultas a la coleccion solicitada, en bloques de ```batch_size``` consultas por llamado.
+            - query_texts: lista de consultas, o bien
+            - query_embeddings: lista de embeddings de consultas ya calculados
+            - workers: cantidad de bloques que se consultan en paralelo
+            - where: filtro de metadata aplicado a todas las consultas
+        
+        El resultado esta alineado con las consultas: ```response['ids'][i]``` corresponde a la consulta ```i```.
         """
         collection = self.get_collection(collection_name)
         
         if collection:
-            response = collection.query(
-                query_texts = query_text,
-                n_results= n_results
+            return query_in_batches(
+                collection,
+                query_texts= query_texts,
+                query_embeddings= query_embeddings,
+                n_results= n_results,
+                include= ['documents', 'metadatas', 'distances'],
+                batch_size= batch_size,
+                workers= workers,
+                where= build_where(where)
             )
-            return response
         
         else:
             # error handling
             return None
      
-    def create_collection(self, collection_name:str) -> chromadb.Collection:
-        """Metodo simple para crear una coleccion vacia. Si la coleccion ya existe, devuelve None"""
+    def category_stats(self, collection_name:str) -> dict:
+        """
+        Devuelve la cantidad de documentos por categoria de la coleccion:
+        
+        ```python
+        database.category_stats('monotributo_collection')
+        # {'total': 1830, 'categoria_principal': {'Recategorizacion': 212, ...}, 'subcategoria_1': {...}, ...}
+        ```
+        """
+        collection = self.get_collection(collection_name)
+        
+        if collection and self.categories:
+            return self.categories.stats(collection)
+     
+    def create_collection(self, collection_name:str, profile:str=None, metadata:dict=None) -> chromadb.Collection:
+        """
+        Metodo simple para crear una coleccion vacia. Si la coleccion ya existe, devuelve None
+        
+        ```profile``` selecciona los parametros del indice HNSW ('default', 'latency', 'recall' o 'memory', ver
+        ```index_profiles.INDEX_PROFILES```). ```metadata``` se combina con el perfil y tiene prioridad.
+        """
 
-        for collection in self.client.list_collections():
-            if collection_name in getattr(collection, 'name'):
-                print('No es posible crear la coleccion. Coleccion ya existente dentro de la base de datos.')
-                return None
-        else:
-            nueva_coleccion = self.client.create_collection(collection_name)
-            print(f'Coleccion "{collection_name}" creada exitosamente')
+        if self.registry.get(collection_name):
+            print('No es posible crear la coleccion. Coleccion ya existente dentro de la base de datos.')
+            return None
+        
+        nueva_coleccion = self.registry.create(collection_name, metadata=get_index_metadata(profile, metadata))
+        self._invalidate_indexes(collection_name)
+        print(f'Coleccion "{collection_name}" creada exitosamente')
 
-            return nueva_coleccion
+        return nueva_coleccion
    
-    def build_collection(self, dataset_data:dict) -> chromadb.Collection:
+    def build_collection(self, dataset_data:dict, batch_size:int=None, quantization:str=None, profile:str=None) -> chromadb.Collection:
         """
         Crea una coleccion a partir de un diccionario de datos proveniente de un dataset.
         
         Si la coleccion ya existe, devuelve None.
+        
+        Si se especifica ```batch_size``` los documentos se añaden en bloques (modo de carga masiva): cada bloque
+        se embebe y se inserta con un unico llamado a ```collection.add()```. El tamaño de bloque se limita al
+        maximo soportado por el cliente (```client.max_batch_size```). Sin ```batch_size``` se mantiene la carga
+        documento a documento.
+        
+        Si se especifica ```quantization``` ('float16' o 'int8') al finalizar se construye un almacen de vectores
+        comprimidos de la coleccion, consultable con ```query_quantized``` (ver ```build_quantized_store```).
+        
+        ```profile``` selecciona los parametros del indice HNSW de la coleccion (ver ```create_collection```).
         """
 
-        progress_bar = getattr(importlib.import_module('utilities'), 'progress_bar')
-
         try:
             collection_name:str = dataset_data['collection_name']
             documents:list = dataset_data['documents']
@@ -126,19 +306,42 @@ class Database():
             total_docs = dataset_data['count']
             count = 0
             
-            collection = self.create_collection(collection_name)
+            collection = self.create_collection(collection_name, profile=profile)
 
             if collection:
                 print(f'\nSe añadiran {total_docs} documentos a la coleccion {collection_name}')
-                print('Añadiendo documentos a la coleccion... ')   
+                print('Añadiendo documentos a la coleccion... ')
+
+                if batch_size:
+                    batch_size = self.get_batch_size(batch_size)
+                    t_i = time.perf_counter()
+
+                    for start in range(0, total_docs, batch_size):
+                        end = start + batch_size
+
+                        with track('add', collection=collection_name, batch_size=len(ids[start:end])):
+                            collection.add(
+                                documents= documents[start:end],
+                                metadatas= metadatas[start:end],
+                                ids= ids[start:end]
+                            )
+                        count = min(end, total_docs)
+                        progress_bar(count, total_docs)
+
+                    t_total = time.perf_counter() - t_i
+                    print(f'\nSe han añadido {count} documentos en {t_total:.2f} segundos ({count / t_total if t_total else 0:.2f} docs/seg)')
+                    print('Documentos añadidos a la coleccion exitosamente\n')
+                    
+                    return self._finish_collection(collection, dataset_data, quantization)
                     
                 for document, metadata, id in zip(documents, metadatas, ids):
                 
-                    collection.add(
-                        documents= document,
-                        metadatas= metadata,
-                        ids= id
-                    )
+                    with track('add', collection=collection_name, batch_size=1):
+                        collection.add(
+                            documents= document,
+                            metadatas= metadata,
+                            ids= id
+                        )
                     progress_bar(count, total_docs)
                     count += 1
 
@@ -147,13 +350,472 @@ class Database():
                     progress_bar(count, total_docs)
 
                     print('Documentos añadidos a la coleccion exitosamente\n')
-
-                    return collection
+                    
+                    return self._finish_collection(collection, dataset_data, quantization)
                 
         except Exception as e:
             print('No se ha podido crear la coleccion. ', e)
             input(' ** ENTER TO CONTINUE **')
     
+    def _finish_collection(self, collection:chromadb.Collection, dataset_data:dict, quantization:str=None) -> chromadb.Collection:
+        # pasos posteriores a la carga de build_collection, comunes a la carga en bloques y documento a documento
+        if quantization:
+            self.build_quantized_store(collection.name, dtype=quantization)
+        
+        if self.exact:
+            self.exact.load(collection.name, dataset_data['ids'], dataset_data['documents'], dataset_data['metadatas'])
+        
+        return collection
+    
+    def build_quantized_store(self, collection_name:str, dtype:str='int8') -> QuantizedStore:
+        """
+        Construye un almacen lateral con los vectores de la coleccion comprimidos a ```dtype``` ('float16' o 'int8').
+        
+        Los vectores float32 utilizados para reordenar los candidatos se guardan en
+        ```<database_path>/quantized/<coleccion>``` y se leen de disco bajo demanda (en modo no persistente quedan en
+        memoria). El almacen no reemplaza al indice HNSW de chroma, que sigue en memoria sin cambios: la memoria total
+        es la del indice HNSW mas los vectores comprimidos y la lista de ids (ver ```QuantizedStore.memory```).
+        
+        Las escrituras realizadas a traves de la clase marcan el almacen como desactualizado y se vuelve a construir en
+        la proxima consulta (ver ```get_quantized_store```).
+        """
+        collection = self.get_collection(collection_name)
+        
+        if collection:
+            path = os.path.join(self.database_path, 'quantized', collection_name) if self.persistent else None
+            
+            t_i = time.perf_counter()
+            store = QuantizedStore.from_collection(collection, dtype=dtype, path=path)
+            self.quantized_stores[collection_name] = store
+            
+            memory = store.memory()
+            print(f'Almacen {dtype} de {collection_name}: {memory["count"]} vectores en {time.perf_counter() - t_i:.2f} segundos. '
+                  f'Memoria: HNSW {memory["hnsw_bytes"] / 2**20:.2f} MB (sin cambios) + almacen {memory["store_bytes"] / 2**20:.2f} MB '
+                  f'= {memory["total_bytes"] / 2**20:.2f} MB')
+            
+            return store
+    
+    def get_quantized_store(self, collection_name:str) -> QuantizedStore:
+        """
+        Devuelve el almacen comprimido de la coleccion, cargandolo de disco si fue construido previamente. Si no existe, devuelve None.
+        
+        Si la coleccion cambio desde que se construyo el almacen (ver ```QuantizedStore.is_current```), el almacen se
+        vuelve a construir con el mismo tipo de compresion.
+        """
+        store = self.quantized_stores.get(collection_name)
+        path = os.path.join(self.database_path, 'quantized', collection_name)
+        
+        if store is None and self.persistent and os.path.isfile(os.path.join(path, 'store.json')):
+            store = self.quantized_stores[collection_name] = QuantizedStore.load(path)
+        
+        collection = self.get_collection(collection_name)
+        
+        if store is not None and collection is not None and not store.is_current(collection):
+            print(f'El almacen comprimido de {collection_name} esta desactualizado. Reconstruyendo...')
+            store = self.build_quantized_store(collection_name, dtype=store.dtype)
+        
+        return store
+    
+    def query_quantized(self, collection_name:str, query_text:str, n_results:int=5, oversample:int=4, query_embeddings:list=None) -> chromadb.QueryResult:
+        """
+        Consulta la coleccion a traves de su almacen comprimido: primera pasada sobre los vectores comprimidos y
+        reordenamiento exacto de los ```n_results * oversample``` mejores candidatos.
+        
+        Devuelve el mismo formato que ```query_collection``` (ids, distances, documents y metadatas).
+        """
+        store = self.get_quantized_store(collection_name)
+        collection = self.get_collection(collection_name)
+        
+        if store is None or collection is None:
+            print('No existe un almacen comprimido para la coleccion solicitada. Ver build_quantized_store.')
+            return None
+        
+        if query_embeddings is None:
+            query_embeddings = self.embed_query(query_text)
+        
+        ids, distances = store.search(query_embeddings, n_results=n_results, oversample=oversample)
+        
+        # documentos y metadatos de todos los resultados en un unico llamado
+        found = collection.get(ids=list({id for row in ids for id in row}), include=['documents', 'metadatas'])
+        records = {id: (document, metadata) for id, document, metadata in zip(found['ids'], found['documents'], found['metadatas'])}
+        
+        return {
+            'ids': ids,
+            'distances': distances,
+            'documents': [[records[id][0] for id in row] for row in ids],
+            'metadatas': [[records[id][1] for id in row] for row in ids],
+            'embeddings': None,
+            'uris': None,
+            'data': None,
+        }
+    
+    def evaluate_quantized(self, collection_name:str, query_texts:list[str], k:int=10, oversample:int=4) -> dict:
+        """
+        Reporta el recall@k del almacen comprimido frente a la busqueda exacta sin compresion, y su uso de memoria.
+        """
+        store = self.get_quantized_store(collection_name)
+        
+        if store is None:
+            print('No existe un almacen comprimido para la coleccion solicitada. Ver build_quantized_store.')
+            return None
+        
+        reporte = store.recall_at_k(self.embed_query(query_texts), k=k, oversample=oversample)
+        print(f'Recall@{k} {collection_name} ({store.dtype}): primera pasada {reporte["recall_first_pass"]:.3f}, '
+              f'reordenado {reporte["recall_reranked"]:.3f}, memoria total {reporte["total_bytes"] / 2**20:.2f} MB '
+              f'(HNSW {reporte["hnsw_bytes"] / 2**20:.2f} MB + almacen {reporte["store_bytes"] / 2**20:.2f} MB)')
+        
+        return reporte
+    
+    def get_exact_engine(self, collection_name:str) -> ExactSearchEngine:
+        """
+        Devuelve el motor de busqueda exacta de la coleccion. La primera vez carga sus embeddings en memoria; luego se
+        mantiene sincronizado con ```sync_collection``` y se descarta al crear o eliminar la coleccion.
+        """
+        engine = self.exact_engines.get(collection_name)
+        
+        if engine is None:
+            collection = self.get_collection(collection_name)
+            
+            if collection is None:
+                return None
+            
+            engine = self.exact_engines[collection_name] = ExactSearchEngine.from_collection(collection)
+        
+        return engine
+    
+    def query_exact(self, collection_name:str, query_text:str, n_results:int=5, query_embeddings:list=None) -> chromadb.QueryResult:
+        """
+        Consulta exacta (fuerza bruta en memoria) con el mismo formato que ```query_collection```.
+        """
+        engine = self.get_exact_engine(collection_name)
+        
+        if engine is None:
+            return None
+        
+        if query_embeddings is None:
+            query_embeddings = self.embed_query(query_text)
+        
+        with track('exact_query', collection=collection_name, batch_size=len(query_embeddings)) as op:
+            response = engine.query(self.get_collection(collection_name), query_embeddings, n_results=n_results)
+            op.results = sum(len(ids) for ids in response['ids'])
+        
+        return response
+    
+    def evaluate_recall(self, collection_name:str, query_texts:list[str]=None, k:int=10, query_embeddings:list=None) -> dict:
+        """
+        Mide el recall@k del indice HNSW de la coleccion frente a la busqueda exacta, y la latencia media de cada una.
+        
+        ```python
+        database.evaluate_recall('abc_collection', consultas, k=10)
+        # {'k': 10, 'queries': 200, 'vectors': 18000, 'recall': 0.987, 'hnsw_ms': 1.9, 'exact_ms': 0.6}
+        ```
+        """
+        collection = self.get_collection(collection_name)
+        engine = self.get_exact_engine(collection_name)
+        
+        if collection is None:
+            return None
+        
+        if query_embeddings is None:
+            query_embeddings = self.embed_query(query_texts)
+        
+        t_i = time.perf_counter()
+        found = [collection.query(query_embeddings=[query], n_results=k, include=[])['ids'][0] for query in query_embeddings]
+        hnsw_seconds = time.perf_counter() - t_i
+        
+        t_i = time.perf_counter()
+        expected = [engine.search([query], n_results=k)[0][0] for query in query_embeddings]
+        exact_seconds = time.perf_counter() - t_i
+        
+        reporte = {
+            'k': k,
+            'queries': len(query_embeddings),
+            'vectors': len(engine),
+            'recall': recall_at_k(expected, found),
+            'hnsw_ms': hnsw_seconds * 1000 / len(query_embeddings),
+            'exact_ms': exact_seconds * 1000 / len(query_embeddings),
+        }
+        print(f'Recall@{k} {collection_name} (HNSW): {reporte["recall"]:.3f}, latencia HNSW {reporte["hnsw_ms"]:.2f} ms, '
+              f'exacta {reporte["exact_ms"]:.2f} ms')
+        
+        return reporte
+    
+    def tune_index(self, collection_name:str, query_texts:list[str], profiles:list[str]=None, grid:dict=None, k:int=10) -> pd.DataFrame:
+        """
+        Compara perfiles (o una grilla de parametros) del indice HNSW sobre los vectores de la coleccion y un conjunto
+        de consultas reservado. Reporta tiempo de construccion, latencia p50/p99, memoria estimada y recall@k.
+        La coleccion no se modifica: cada configuracion se construye en memoria (ver ```index_profiles.tune_index```).
+        
+        ```python
+        database.tune_index('crm_collection', consultas, grid={'hnsw:M': [8, 16, 32], 'hnsw:search_ef': [10, 50, 100]})
+        ```
+        """
+        collection = self.get_collection(collection_name)
+        
+        if collection:
+            return tune_index(collection, self.embed_query(query_texts), profiles=profiles, grid=grid, k=k)
+    
+    def get_batch_size(self, batch_size:int) -> int:
+        """
+        Devuelve el tamaño de bloque a utilizar en cargas masivas, limitado al maximo soportado por el cliente.
+        """
+        max_batch_size = getattr(self.client, 'max_batch_size', None)
+        
+        if max_batch_size and batch_size > max_batch_size:
+            print(f'El tamaño de bloque {batch_size} supera el maximo del cliente. Se utilizara {max_batch_size}')
+            return max_batch_size
+        
+        return batch_size
+    
+    def ingest_collection(self, dataset_data:dict, batch_size:int=256, workers:int=None, use_processes:bool=False, profile:str=None) -> chromadb.Collection:
+        """
+        Crea una coleccion a partir de un diccionario de datos utilizando el pipeline de ingesta en paralelo.
+        
+        Los embeddings se calculan en bloques de ```batch_size``` documentos en un pool de ```workers``` hilos
+        (o procesos si ```use_processes=True```) y un unico hilo escribe los bloques en la coleccion.
+        
+        Si la coleccion ya existe, devuelve None.
+        """
+        
+        try:
+            collection_name:str = dataset_data['collection_name']
+            total_docs = dataset_data['count']
+            
+            collection = self.create_collection(collection_name, profile=profile)
+            
+            if collection:
+                print(f'\nSe añadiran {total_docs} documentos a la coleccion {collection_name}')
+                print('Añadiendo documentos a la coleccion... ')
+                
+                pipeline = IngestionPipeline(
+                    collection,
+                    self.embedding_function,
+                    workers=workers,
+                    use_processes=use_processes
+                )
+                pipeline.run(chunk_data(dataset_data, self.get_batch_size(batch_size)), total=total_docs)
+                
+                print('Documentos añadidos a la coleccion exitosamente\n')
+                
+                return collection
+            
+        except Exception as e:
+            print('No se ha podido crear la coleccion. ', e)
+    
+    def stream_collection(self, dataset, batch_size:int=256, workers:int=None, use_processes:bool=False, profile:str=None) -> chromadb.Collection:
+        """
+        Crea una coleccion leyendo el dataset en bloques mediante ```dataset.iter_batches()```, sin construir el
+        dataset completo en memoria. Los bloques se procesan con el pipeline de ingesta en paralelo.
+        
+        ```python
+        database.stream_collection(CRM(auto_build=False), batch_size=500)
+        ```
+        
+        Si la coleccion ya existe, devuelve None.
+        """
+        
+        try:
+            collection = self.create_collection(dataset.collection_name, profile=profile)
+            
+            if collection:
+                print(f'\nAñadiendo documentos a la coleccion {dataset.collection_name}... ')
+                
+                pipeline = IngestionPipeline(
+                    collection,
+                    self.embedding_function,
+                    workers=workers,
+                    use_processes=use_processes
+                )
+                pipeline.run(dataset.iter_batches(self.get_batch_size(batch_size)))
+                
+                print('Documentos añadidos a la coleccion exitosamente\n')
+                
+                return collection
+            
+        except Exception as e:
+            print('No se ha podido crear la coleccion. ', e)
+    
+    def insert_data(self, collection_name:str, data:dict) -> None:
+        """
+        Inserta uno o varios registros en la coleccion y actualiza sus indices en memoria. El formato de ```data``` es
+        el mismo que en ```Client.insert_data```: ```{'id': id, 'document': document, 'metadata': metadata}```.
+        """
+        collection = self.get_collection(collection_name)
+        
+        if collection:
+            with track('add', collection=collection_name, batch_size=len(_as_list(data['id']))):
+                collection.add(ids= data['id'], documents= data['document'], metadatas= data.get('metadata'))
+            
+            self._refresh_indexes(collection, _as_list(data['id']))
+    
+    def update_data(self, collection_name:str, data:dict) -> None:
+        """
+        Actualiza uno o varios registros de la coleccion. 'document' y 'metadata' son opcionales: solo se actualiza lo indicado.
+        """
+        collection = self.get_collection(collection_name)
+        
+        if collection:
+            with track('update', collection=collection_name, batch_size=len(_as_list(data['id']))):
+                collection.update(ids= data['id'], documents= data.get('document'), metadatas= data.get('metadata'))
+            
+            self._refresh_indexes(collection, _as_list(data['id']))
+    
+    def delete_data(self, collection_name:str, data:dict) -> None:
+        """ Elimina uno o varios registros (```data['id']```) de la coleccion. """
+        collection = self.get_collection(collection_name)
+        
+        if collection:
+            with track('delete', collection=collection_name, batch_size=len(_as_list(data['id']))):
+                collection.delete(ids= data['id'])
+            
+            self._refresh_indexes(collection, _as_list(data['id']))
+    
+    def sync_collection(self, dataset, batch_size:int=256, page_size:int=1000) -> dict[str, int]:
+        """
+        Sincroniza de manera incremental una coleccion con su archivo de datos csv.
+        
+        Compara el dataset (leido en bloques con ```dataset.iter_batches()```) contra lo almacenado en la coleccion
+        y solo:
+            - añade (upsert) las filas nuevas o modificadas
+            - elimina las filas que ya no estan en el csv
+        
+        Las filas sin cambios no se vuelven a embeber. Requiere ids deterministicos (ver ```local_datasets```).
+        Si la coleccion no existe, se crea.
+        
+        Devuelve la cantidad de filas nuevas, modificadas, eliminadas y sin cambios:
+        
+        ```python
+        database.sync_collection(CRM(auto_build=False))
+        # {'nuevos': 120, 'modificados': 4, 'eliminados': 2, 'sin_cambios': 198000}
+        ```
+        """
+        
+        collection = self.registry.get(dataset.collection_name) or self.create_collection(dataset.collection_name)
+        batch_size = self.get_batch_size(batch_size)
+        
+        # hash del contenido almacenado por id, leido por paginas
+        almacenados = {}
+        offset = 0
+        while True:
+            page = collection.get(include=['documents', 'metadatas'], limit=page_size, offset=offset)
+            
+            for id, document, metadata in zip(page['ids'], page['documents'], page['metadatas']):
+                almacenados[id] = content_hash(document, metadata)
+            
+            if len(page['ids']) < page_size:
+                break
+            offset += page_size
+        
+        resumen = {'nuevos': 0, 'modificados': 0, 'eliminados': 0, 'sin_cambios': 0}
+        documents, metadatas, ids = [], [], []
+        
+        # el motor de busqueda exacta (si ya fue cargado) se actualiza con los mismos cambios
+        engine = self.exact_engines.get(dataset.collection_name)
+        
+        for batch in dataset.iter_batches(batch_size):
+            for document, metadata, id in zip(*batch):
+                stored_hash = almacenados.pop(id, None)
+                
+                if stored_hash is None:
+                    resumen['nuevos'] += 1
+                elif stored_hash != content_hash(document, metadata):
+                    resumen['modificados'] += 1
+                else:
+                    resumen['sin_cambios'] += 1
+                    continue
+                
+                documents.append(document)
+                metadatas.append(metadata)
+                ids.append(id)
+                
+                if len(ids) == batch_size:
+                    collection.upsert(documents= documents, metadatas= metadatas, ids= ids)
+                    if engine:
+                        engine.refresh(collection, ids)
+                    documents, metadatas, ids = [], [], []
+        
+        if ids:
+            collection.upsert(documents= documents, metadatas= metadatas, ids= ids)
+            if engine:
+                engine.refresh(collection, ids)
+        
+        # los ids que quedan almacenados ya no existen en el csv
+        eliminados = list(almacenados)
+        for start in range(0, len(eliminados), batch_size):
+            collection.delete(ids= eliminados[start:start + batch_size])
+        resumen['eliminados'] = len(eliminados)
+        
+        if engine:
+            engine.remove(eliminados)
+        
+        print(f'Coleccion {dataset.collection_name} sincronizada: {resumen}')
+        
+        self._invalidate_indexes(dataset.collection_name, exact_engine=False)
+        
+        return resumen
+    
+    def export_collection(self, collection_name:str, path:str=None, page_size:int=1000) -> dict:
+        """
+        Exporta una coleccion (ids, documentos, metadata y embeddings) a un snapshot en ```path``` (por defecto
+        ```{database_path}/snapshots/{collection_name}```) y devuelve su manifiesto (ver ```snapshots```).
+        
+        ```python
+        database.export_collection('abc_collection', 'snapshots/abc_collection')
+        database.import_collection('snapshots/abc_collection')
+        ```
+        
+        La coleccion se lee en paginas de ```page_size```. Si la coleccion no existe, devuelve None.
+        """
+        
+        collection = self.get_collection(collection_name)
+        
+        if collection:
+            path = path or os.path.join(self.database_path, 'snapshots', collection_name)
+            
+            print(f'\nExportando la coleccion {collection_name} a {path}... ')
+            t_i = time.perf_counter()
+            
+            manifest = snapshots.export_collection(collection, path, page_size=page_size, model_name=self._model_name(), progress=progress_bar)
+            
+            print(f'\nSe han exportado {manifest["count"]} documentos en {time.perf_counter() - t_i:.2f} segundos\n')
+            
+            return manifest
+    
+    def import_collection(self, path:str, collection_name:str=None, batch_size:int=1000) -> chromadb.Collection:
+        """
+        Crea una coleccion a partir de un snapshot (ver ```export_collection```), con la misma metadata (parametros del
+        indice HNSW) que la coleccion exportada. Por defecto la coleccion conserva su nombre original.
+        
+        Los documentos se añaden en bloques de ```batch_size``` con sus embeddings precalculados: no se utiliza el
+        modelo de embeddings. Las consultas posteriores si lo utilizan, por lo que debe ser el mismo con el que se
+        exporto la coleccion.
+        
+        Si la coleccion ya existe, devuelve None.
+        """
+        
+        try:
+            manifest = snapshots.read_manifest(path)
+            collection_name = collection_name or manifest['collection_name']
+            
+            if manifest['model_name'] and manifest['model_name'] != self._model_name():
+                print(f'Advertencia: el snapshot fue generado con el modelo {manifest["model_name"]} y la base de datos utiliza {self._model_name()}')
+            
+            collection = self.create_collection(collection_name, metadata=manifest['metadata'])
+            
+            if collection:
+                print(f'\nSe importaran {manifest["count"]} documentos a la coleccion {collection_name}')
+                t_i = time.perf_counter()
+                
+                count = snapshots.import_collection(collection, path, batch_size=self.get_batch_size(batch_size), progress=progress_bar)
+                
+                t_total = time.perf_counter() - t_i
+                print(f'\nSe han importado {count} documentos en {t_total:.2f} segundos ({count / t_total if t_total else 0:.2f} docs/seg)\n')
+                
+                return collection
+            
+        except Exception as e:
+            print('No se ha podido importar la coleccion. ', e)
+    
     def delete_collection(self, collection_name:str, ignore_warnings=False) -> None:
         """
         Elimina una coleccion. Por defecto solicitara una confirmacion manual para elimar la coleccion, aunque se puede deshabilitar
@@ -169,24 +831,62 @@ class Database():
 
                 if collection:
                     self.client.delete_collection(collection.name)
+                    self.registry.invalidate(collection.name)
+                    self._invalidate_indexes(collection.name)
             else:
                 print('Operacion abortada.')
                 
         else:
             try:
                 self.client.delete_collection(collection_name)
+                self.registry.invalidate(collection_name)
+                self._invalidate_indexes(collection_name)
                 print('Coleccion eliminada exitosamente')
             except Exception as e:
                 print('No se ha podido eliminar la coleccion. ', e)
             
+    def _invalidate_indexes(self, collection_name:str, exact_engine:bool=True) -> None:
+        # los indices se vuelven a construir a partir de la coleccion en la proxima consulta
+        for indexes in (self.lexical, self.exact, self.categories):
+            if indexes:
+                indexes.invalidate(collection_name)
+        
+        if exact_engine:
+            self.exact_engines.pop(collection_name, None)
+        
+        self._mark_quantized_stale(collection_name)
+    
+    def _refresh_indexes(self, collection:chromadb.Collection, ids:list[str]) -> None:
+        # luego de escribir ids: los indices en memoria vuelven a leer esos registros (los eliminados se quitan)
+        for indexes in (self.lexical, self.exact, self.categories):
+            if indexes:
+                indexes.refresh(collection, ids)
+        
+        engine = self.exact_engines.get(collection.name)
+        if engine:
+            engine.refresh(collection, ids)
+        
+        self._mark_quantized_stale(collection.name)
+    
+    def _mark_quantized_stale(self, collection_name:str) -> None:
+        # el almacen comprimido (en memoria y en disco) se reconstruye en la proxima consulta
+        store = self.quantized_stores.get(collection_name)
+        if store is not None:
+            store.stale = True
+        
+        if self.persistent:
+            mark_stale(os.path.join(self.database_path, 'quantized', collection_name))
+    
+    def _model_name(self) -> str:
+        # modelo de embeddings de las colecciones (se guarda en los snapshots)
+        return getattr(self.embedding_function, 'model_name', None) or getattr(self.embedding_function, 'MODEL_NAME', type(self.embedding_function).__name__)
+    
     def force_mount(self, port:int=8000, host:str='localhost', log_path:str='logs/chroma.log'):
         """ De manera forzada establece un servidor chroma local de la base de datos junto con un registro de logs a la misma
         
         Por defecto el servidor se establece en ```http://localhost:8000```
         
         """
-        import os        
-        
         os.system(
             f'chroma run --path {self.database_path} --host {host} --port {port} --log-path {log_path}'
             )
@@ -207,9 +907,18 @@ if __name__ == '__main__':
     #database.delete_collection(crm_data['collection_name'], ignore_warnings=True)
     #database.delete_collection(monotributo_data['collection_name'], ignore_warnings=True)
 
-    #database.build_collection(dataset_data=abc_data)
+    #database.build_collection(dataset_data=abc_data, batch_size=1000)
     #database.build_collection(dataset_data=crm_data)
+    #database.build_collection(dataset_data=abc_data, batch_size=1000, quantization='int8')
+    #database.build_collection(dataset_data=crm_data, batch_size=1000, profile='recall')
+    #database.tune_index('crm_collection', ['Como me doy de baja?', 'Que es la recategorizacion?'], profiles=['default', 'latency', 'recall', 'memory'])
+    #database.evaluate_quantized('abc_collection', ['Como me doy de baja?', 'Que es la recategorizacion?'], k=10)
+    #database.ingest_collection(dataset_data=monotributo_data, batch_size=256, workers=8)
+    #database.stream_collection(CRM(auto_build=False), batch_size=500)
+    #database.sync_collection(CRM(auto_build=False))
     #database.build_collection(dataset_data=monotributo_data)
+    #database.export_collection(abc_data['collection_name'], 'snapshots/abc_collection')
+    #database.import_collection('snapshots/abc_collection')
     
     
     #database.get_collection_info(abc.collection_name)
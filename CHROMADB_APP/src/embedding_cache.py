@@ -0,0 +1,213 @@
+"""
+Cache de embeddings con dos niveles: memoria (LRU) y disco (SQLite).
+
+Se ubica delante de la funcion de embeddings utilizada por ```Database``` y ```Client```: los textos cuyo vector
+ya es conocido no vuelven a pasar por el modelo.
+"""
+
+import os
+import time
+import sqlite3
+import hashlib
+import threading
+from collections import OrderedDict
+
+import numpy as np
+from chromadb.api.types import Documents, EmbeddingFunction, Embeddings
+
+from metrics import track, EMBEDDING_CACHE
+
+
+class EmbeddingCache(EmbeddingFunction[Documents]):
+    """
+    Funcion de embeddings que cachea los vectores de otra funcion de embeddings.
+
+    ```python
+    embedding_function = EmbeddingCache(DefaultEmbeddingFunction(), cache_path='./database/embedding_cache.sqlite3')
+    collection = client.get_collection('abc_collection', embedding_function=embedding_function)
+    ```
+
+    - model_name: nombre del modelo. Forma parte de la clave, por lo que cambiar de modelo no reutiliza vectores viejos.
+    - cache_path: archivo SQLite del nivel en disco. Si es None solo se utiliza el nivel en memoria.
+    - max_memory_items: cantidad maxima de vectores en memoria (se descartan los menos usados recientemente).
+    - max_disk_bytes: tamaño maximo de los vectores almacenados en disco (se descartan los accedidos hace mas tiempo).
+    """
+
+    def __init__(self, embedding_function:EmbeddingFunction, model_name:str=None, cache_path:str=None, max_memory_items:int=10_000, max_disk_bytes:int=512 * 1024 * 1024) -> None:
+        self.embedding_function = embedding_function
+        self.model_name = model_name or getattr(embedding_function, 'MODEL_NAME', type(embedding_function).__name__)
+        self.cache_path = cache_path
+        self.max_memory_items = max_memory_items
+        self.max_disk_bytes = max_disk_bytes
+
+        self.hits_memory = 0
+        self.hits_disk = 0
+        self.misses = 0
+
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+        self._connection = None
+        self._disk_bytes = 0
+
+        if cache_path:
+            self._open(cache_path)
+
+    def __call__(self, input:Documents) -> Embeddings:
+        return self.embed(input)
+
+    def embed(self, input:Documents, compute=None) -> Embeddings:
+        """
+        Devuelve los embeddings de ```input``` utilizando el cache. Los textos que no estan en el cache se calculan con
+        ```compute``` (por defecto la funcion de embeddings), por ejemplo en un pool de procesos (ver ```ingestion```).
+        """
+        compute = compute or self.embedding_function
+        keys = [self._key(text) for text in input]
+        vectors = [None] * len(keys)
+
+        with self._lock:
+            for i, key in enumerate(keys):
+                vector = self._memory.get(key)
+                if vector is not None:
+                    self._memory.move_to_end(key)
+                    vectors[i] = vector
+                    self.hits_memory += 1
+
+            pending = [i for i, vector in enumerate(vectors) if vector is None]
+
+            if pending and self._connection:
+                stored = self._disk_get({keys[i] for i in pending})
+                for i in pending:
+                    vector = stored.get(keys[i])
+                    if vector is not None:
+                        vectors[i] = vector
+                        self._memory_put(keys[i], vector)
+                        self.hits_disk += 1
+
+                pending = [i for i in pending if vectors[i] is None]
+
+        if pending:
+            # los textos repetidos dentro del mismo llamado se embeben una sola vez
+            unique_keys = list(dict.fromkeys(keys[i] for i in pending))
+            texts = {keys[i]: input[i] for i in pending}
+
+            with track('embed', batch_size=len(unique_keys)):
+                embeddings = compute([texts[key] for key in unique_keys])
+            computed = {key: np.asarray(embedding, dtype=np.float32) for key, embedding in zip(unique_keys, embeddings)}
+
+            with self._lock:
+                self.misses += len(unique_keys)
+                for key, vector in computed.items():
+                    self._memory_put(key, vector)
+
+                if self._connection:
+                    self._disk_put(computed)
+
+            for i in pending:
+                vectors[i] = computed[keys[i]]
+
+        EMBEDDING_CACHE.inc(len(keys) - len(pending), result='hit')
+        EMBEDDING_CACHE.inc(len(pending), result='miss')
+
+        return [vector.tolist() for vector in vectors]
+
+    def stats(self) -> dict[str, int]:
+        """ Devuelve los contadores de aciertos y fallos del cache y su tamaño actual. """
+        return {
+            'hits_memory': self.hits_memory,
+            'hits_disk': self.hits_disk,
+            'misses': self.misses,
+            'memory_items': len(self._memory),
+            'disk_bytes': self._disk_bytes,
+        }
+
+    def clear(self) -> None:
+        """ Vacia ambos niveles del cache. """
+        with self._lock:
+            self._memory.clear()
+            if self._connection:
+                self._connection.execute('DELETE FROM embeddings')
+                self._connection.commit()
+                self._disk_bytes = 0
+
+    def close(self) -> None:
+        """ Cierra el archivo del nivel en disco. """
+        with self._lock:
+            if self._connection:
+                self._connection.close()
+                self._connection = None
+
+    def _key(self, text:str) -> str:
+        return hashlib.sha256(f'{self.model_name}\x1f{text}'.encode('utf-8')).hexdigest()
+
+    def _memory_put(self, key:str, vector:np.ndarray) -> None:
+        self._memory[key] = vector
+        self._memory.move_to_end(key)
+
+        while len(self._memory) > self.max_memory_items:
+            self._memory.popitem(last=False)
+
+    def _open(self, cache_path:str) -> None:
+        directory = os.path.dirname(cache_path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+        self._connection = sqlite3.connect(cache_path, check_same_thread=False)
+        self._connection.execute(
+            'CREATE TABLE IF NOT EXISTS embeddings (key TEXT PRIMARY KEY, vector BLOB NOT NULL, size INTEGER NOT NULL, last_access REAL NOT NULL)'
+        )
+        self._connection.execute('CREATE INDEX IF NOT EXISTS embeddings_last_access ON embeddings (last_access)')
+        self._connection.commit()
+
+        self._disk_bytes = self._connection.execute('SELECT COALESCE(SUM(size), 0) FROM embeddings').fetchone()[0]
+
+    def _disk_get(self, keys:set[str]) -> dict[str, np.ndarray]:
+        keys = list(keys)
+        stored = {}
+
+        # sqlite limita la cantidad de parametros por consulta
+        for start in range(0, len(keys), 500):
+            chunk = keys[start:start + 500]
+            placeholders = ','.join('?' * len(chunk))
+            rows = self._connection.execute(f'SELECT key, vector FROM embeddings WHERE key IN ({placeholders})', chunk).fetchall()
+            stored.update({key: np.frombuffer(vector, dtype=np.float32) for key, vector in rows})
+
+        if stored:
+            now = time.time()
+            self._connection.executemany('UPDATE embeddings SET last_access = ? WHERE key = ?', [(now, key) for key in stored])
+            self._connection.commit()
+
+        return stored
+
+    def _disk_put(self, vectors:dict[str, np.ndarray]) -> None:
+        now = time.time()
+        rows = [(key, vector.tobytes(), vector.nbytes, now) for key, vector in vectors.items()]
+
+        # INSERT OR REPLACE reemplaza las claves existentes: su tamaño anterior se descuenta del total
+        keys = list(vectors)
+        replaced = 0
+        for start in range(0, len(keys), 500):
+            chunk = keys[start:start + 500]
+            placeholders = ','.join('?' * len(chunk))
+            replaced += self._connection.execute(f'SELECT COALESCE(SUM(size), 0) FROM embeddings WHERE key IN ({placeholders})', chunk).fetchone()[0]
+
+        self._connection.executemany('INSERT OR REPLACE INTO embeddings (key, vector, size, last_access) VALUES (?, ?, ?, ?)', rows)
+        self._disk_bytes += sum(row[2] for row in rows) - replaced
+
+        if self._disk_bytes > self.max_disk_bytes:
+            self._evict()
+
+        self._connection.commit()
+
+    def _evict(self) -> None:
+        # descarta los vectores accedidos hace mas tiempo hasta quedar en el 90% del tamaño maximo
+        target = int(self.max_disk_bytes * 0.9)
+        rows = self._connection.execute('SELECT key, size FROM embeddings ORDER BY last_access')
+
+        evicted = []
+        for key, size in rows:
+            if self._disk_bytes <= target:
+                break
+            evicted.append((key,))
+            self._disk_bytes -= size
+
+        self._connection.executemany('DELETE FROM embeddings WHERE key = ?', evicted)
@@ -0,0 +1,187 @@
+"""
+Backends de embeddings locales.
+
+Reemplazan a la funcion de embeddings por defecto de chroma (que descarga el modelo en el primer uso) por backends
+explicitos, sin llamados a la red:
+
+- OnnxEmbeddingBackend: modelo ONNX (por defecto all-MiniLM-L6-v2) cargado desde una carpeta local, con inferencia
+  por lotes y control de la cantidad de hilos de onnxruntime.
+- HashingEmbeddingBackend: embeddings deterministicos por hashing de tokens. No requiere modelo, es muy barato y sirve
+  para pruebas y benchmarks (no captura semantica).
+
+```python
+embedding_function = get_embedding_backend('onnx', model_path='./models/all-MiniLM-L6-v2', intra_op_threads=4)
+database = Database(embedding_function=embedding_function)
+```
+"""
+
+import os
+import hashlib
+
+import numpy as np
+from chromadb.api.types import Documents, EmbeddingFunction, Embeddings
+from chromadb.utils import embedding_functions
+
+from utilities import normalizar_texto
+
+
+# carpeta donde chroma descomprime el modelo por defecto la primera vez que lo descarga
+DEFAULT_MODEL_PATH = os.path.join(os.path.expanduser('~'), '.cache', 'chroma', 'onnx_models', 'all-MiniLM-L6-v2', 'onnx')
+
+
+def _normalize(vectors:np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    norms[norms == 0] = 1e-12
+    return vectors / norms
+
+
+class OnnxEmbeddingBackend(EmbeddingFunction[Documents]):
+    """
+    Embeddings de un modelo tipo sentence-transformers exportado a ONNX.
+
+    La carpeta ```model_path``` debe contener ```model.onnx``` y ```tokenizer.json```. Los vectores son los mismos que
+    los de la funcion por defecto de chroma (mean pooling + normalizacion), por lo que las colecciones existentes
+    siguen siendo compatibles.
+
+    - batch_size: cantidad de textos por llamado al modelo.
+    - max_length: cantidad maxima de tokens por texto. Cada lote se rellena hasta su texto mas largo, no hasta max_length.
+    - intra_op_threads: hilos utilizados dentro de cada operacion (0 = los decide onnxruntime).
+    - inter_op_threads: hilos para ejecutar operaciones en paralelo (0 = los decide onnxruntime). Si es mayor a 1 se
+      utiliza el modo de ejecucion paralelo.
+    - providers: proveedores de onnxruntime (por defecto los disponibles).
+    """
+
+    def __init__(self, model_path:str=None, model_name:str='all-MiniLM-L6-v2', batch_size:int=32, max_length:int=256,
+                 intra_op_threads:int=0, inter_op_threads:int=0, providers:list[str]=None) -> None:
+
+        import onnxruntime
+        from tokenizers import Tokenizer
+
+        self.model_path = model_path or DEFAULT_MODEL_PATH
+        self.batch_size = batch_size
+        self.max_length = max_length
+        self.intra_op_threads = intra_op_threads
+        self.inter_op_threads = inter_op_threads
+
+        # forma parte de la clave del cache de embeddings
+        self.MODEL_NAME = model_name
+
+        model_file = os.path.join(self.model_path, 'model.onnx')
+        tokenizer_file = os.path.join(self.model_path, 'tokenizer.json')
+
+        for path in (model_file, tokenizer_file):
+            if not os.path.isfile(path):
+                raise FileNotFoundError(f'No se encontro {path}. El backend ONNX no descarga modelos: se debe indicar una carpeta local en model_path.')
+
+        self.tokenizer = Tokenizer.from_file(tokenizer_file)
+        self.tokenizer.enable_truncation(max_length=max_length)
+        self.tokenizer.enable_padding(pad_id=0, pad_token='[PAD]')
+
+        options = onnxruntime.SessionOptions()
+        options.log_severity_level = 3
+        options.intra_op_num_threads = intra_op_threads
+        options.inter_op_num_threads = inter_op_threads
+        options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+
+        if inter_op_threads > 1:
+            options.execution_mode = onnxruntime.ExecutionMode.ORT_PARALLEL
+
+        self.session = onnxruntime.InferenceSession(
+            model_file,
+            sess_options=options,
+            providers=providers or onnxruntime.get_available_providers()
+        )
+        self._input_names = {model_input.name for model_input in self.session.get_inputs()}
+
+    def __call__(self, input:Documents) -> Embeddings:
+        if not input:
+            return []
+
+        batches = [self._forward(input[start:start + self.batch_size]) for start in range(0, len(input), self.batch_size)]
+        return np.concatenate(batches).tolist()
+
+    def _forward(self, texts:list[str]) -> np.ndarray:
+        encoded = self.tokenizer.encode_batch(texts)
+
+        input_ids = np.array([e.ids for e in encoded], dtype=np.int64)
+        attention_mask = np.array([e.attention_mask for e in encoded], dtype=np.int64)
+
+        inputs = {'input_ids': input_ids, 'attention_mask': attention_mask}
+        if 'token_type_ids' in self._input_names:
+            inputs['token_type_ids'] = np.zeros_like(input_ids)
+
+        last_hidden_state = self.session.run(None, inputs)[0]
+
+        # mean pooling ponderado por la mascara de atencion: el relleno no afecta al vector
+        mask = attention_mask[:, :, np.newaxis].astype(np.float32)
+        embeddings = (last_hidden_state * mask).sum(axis=1) / np.clip(mask.sum(axis=1), 1e-9, None)
+
+        return _normalize(embeddings).astype(np.float32)
+
+
+class HashingEmbeddingBackend(EmbeddingFunction[Documents]):
+    """
+    Embeddings deterministicos por hashing de tokens (feature hashing con signo).
+
+    Cada token normalizado (ver ```utilities.normalizar_texto```) suma +1 o -1 en una dimension elegida por su hash.
+    Textos con las mismas palabras producen el mismo vector, en cualquier proceso y maquina.
+
+    - dim: dimension de los vectores.
+    - ngrams: ademas de las palabras, utiliza los n-gramas de palabras hasta este tamaño.
+    """
+
+    def __init__(self, dim:int=384, ngrams:int=1) -> None:
+        self.dim = dim
+        self.ngrams = ngrams
+
+        # forma parte de la clave del cache de embeddings
+        self.MODEL_NAME = f'hashing-{dim}-{ngrams}'
+
+    def __call__(self, input:Documents) -> Embeddings:
+        if not input:
+            return []
+
+        vectors = np.zeros((len(input), self.dim), dtype=np.float32)
+
+        for row, text in enumerate(input):
+            indices, signs = self._features(text)
+            np.add.at(vectors[row], indices, signs)
+
+        return _normalize(vectors).tolist()
+
+    def _features(self, text:str) -> tuple[np.ndarray, np.ndarray]:
+        tokens = normalizar_texto(text).split()
+        features = [' '.join(tokens[i:i + n]) for n in range(1, self.ngrams + 1) for i in range(len(tokens) - n + 1)]
+
+        digests = [int.from_bytes(hashlib.blake2b(feature.encode('utf-8'), digest_size=8).digest(), 'little') for feature in features]
+
+        indices = np.array([digest % self.dim for digest in digests], dtype=np.int64)
+        signs = np.array([1.0 if (digest >> 63) else -1.0 for digest in digests], dtype=np.float32)
+
+        return indices, signs
+
+
+BACKENDS = {
+    'onnx': OnnxEmbeddingBackend,
+    'hashing': HashingEmbeddingBackend,
+}
+
+
+def get_embedding_backend(backend=None, **kwargs) -> EmbeddingFunction:
+    """
+    Devuelve una funcion de embeddings a partir de:
+
+    - None o 'default': la funcion por defecto de chroma (descarga el modelo si no esta en el cache local).
+    - 'onnx' o 'hashing': el backend correspondiente, construido con ```kwargs```.
+    - una funcion de embeddings: se devuelve sin cambios.
+    """
+    if backend is None or backend == 'default':
+        return embedding_functions.DefaultEmbeddingFunction()
+
+    if not isinstance(backend, str):
+        return backend
+
+    if backend not in BACKENDS:
+        raise ValueError(f'Backend de embeddings desconocido: {backend}. Opciones: default, {", ".join(BACKENDS)}')
+
+    return BACKENDS[backend](**kwargs)
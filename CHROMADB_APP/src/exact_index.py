@@ -0,0 +1,270 @@
+"""
+Atajo de coincidencia exacta: indice hash de preguntas normalizadas.
+
+Gran parte de las consultas son preguntas frecuentes elegidas desde la interfaz, identicas (o casi) a los documentos
+de la coleccion. Estas consultas se resuelven con un diccionario en O(1), sin calcular el embedding ni consultar el
+indice vectorial. El resto de las consultas sigue el camino habitual.
+
+Si hay menos coincidencias que ```n_results```, los lugares restantes se completan con la busqueda por embeddings
+(ver ```merge_results```): la interfaz sigue recibiendo preguntas relacionadas, con la coincidencia exacta primero.
+
+```python
+normalizar_pregunta('¿Qué es la  RECATEGORIZACIÓN?')
+# 'que es la recategorizacion'
+```
+"""
+
+import re
+import threading
+from typing import Optional
+
+import chromadb
+
+from utilities import normalizar_texto
+from metrics import EXACT_MATCH
+
+
+def normalizar_pregunta(texto:str) -> str:
+    """ Clave de una pregunta: texto normalizado (ver ```normalizar_texto```) sin signos de puntuacion. """
+    return re.sub(r'[\W_]+', ' ', normalizar_texto(texto)).strip()
+
+
+def merge_results(exact:chromadb.QueryResult, response:chromadb.QueryResult, n_results:int) -> chromadb.QueryResult:
+    """
+    Completa el resultado del atajo (una consulta) con los de la busqueda por embeddings, hasta ```n_results```: primero
+    las coincidencias exactas y luego los demas resultados, sin repetir documentos.
+    """
+    ids = set(exact['ids'][0])
+    rows = [j for j, id in enumerate(response['ids'][0]) if id not in ids][:max(n_results - len(ids), 0)]
+
+    return {
+        key: [values[0] + [response[key][0][j] for j in rows]] if values is not None and response.get(key) is not None else None
+        for key, values in exact.items()
+    }
+
+
+class ExactMatchIndex:
+    """
+    Indice pregunta normalizada -> documentos de una coleccion.
+
+    Varias preguntas pueden compartir la misma clave (por ejemplo si solo difieren en mayusculas o signos): se
+    devuelven en el orden en que fueron agregadas.
+    """
+
+    def __init__(self) -> None:
+        # clave -> ids, e id -> (clave, documento, metadata)
+        self._keys:dict[str, list[str]] = {}
+        self._entries:dict[str, tuple[str, str, dict]] = {}
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def add(self, ids:list[str], documents:list[str], metadatas:list[dict]=None) -> None:
+        """ Agrega documentos al indice. Los ids existentes se reemplazan. """
+        with self._lock:
+            for id, document, metadata in zip(ids, documents, metadatas or [None] * len(ids)):
+                self._remove(id)
+
+                if not document:
+                    continue
+
+                key = normalizar_pregunta(document)
+                self._entries[id] = (key, document, metadata)
+                self._keys.setdefault(key, []).append(id)
+
+    def remove(self, ids:list[str]) -> None:
+        with self._lock:
+            for id in ids:
+                self._remove(id)
+
+    def lookup(self, query_text:str) -> list[tuple[str, str, dict]]:
+        """ Devuelve los documentos ```(id, documento, metadata)``` cuya pregunta coincide con la consulta. """
+        ids = self._keys.get(normalizar_pregunta(query_text), ())
+        return [(id, *self._entries[id][1:]) for id in list(ids) if id in self._entries]
+
+    def _remove(self, id:str) -> None:
+        entry = self._entries.pop(id, None)
+
+        if entry:
+            ids = self._keys[entry[0]]
+            ids.remove(id)
+
+            if not ids:
+                del self._keys[entry[0]]
+
+
+class ExactMatchIndexes:
+    """
+    Indices de coincidencia exacta de las colecciones indicadas en ```collections```.
+
+    Cada indice se carga a partir de los datos del dataset al construir la coleccion (```load```) o, si no, se
+    construye la primera vez que se consulta la coleccion, leyendo sus documentos en paginas. Las escrituras realizadas
+    a traves de ```Database``` y ```Client``` lo mantienen sincronizado (```add```, ```refresh```, ```remove```) o lo
+    descartan para reconstruirlo (```invalidate```).
+
+    Cada coleccion tiene su propio lock de construccion: mientras se construye el indice de una coleccion, las
+    consultas a las demas no se bloquean.
+
+    ```python
+    indexes = ExactMatchIndexes(['abc_collection', 'monotributo_collection'])
+    indexes.query(collection, 'Que es la recategorizacion?', n_results=5, include=['documents', 'metadatas'])
+    indexes.stats()
+    # {'abc_collection': {'hits': 412, 'misses': 96, 'hit_rate': 0.81, 'items': 1830}, ...}
+    ```
+    """
+
+    def __init__(self, collections:list[str], page_size:int=1000) -> None:
+        self.collections = set(collections)
+        self.page_size = page_size
+
+        self._indexes:dict[str, ExactMatchIndex] = {}
+        self._hits:dict[str, int] = {}
+        self._misses:dict[str, int] = {}
+        self._build_locks:dict[str, threading.Lock] = {}
+        self._generations:dict[str, int] = {}
+        self._lock = threading.Lock()
+
+    def enabled(self, collection_name:str) -> bool:
+        return collection_name in self.collections
+
+    def get(self, collection:chromadb.Collection) -> ExactMatchIndex:
+        index = self._indexes.get(collection.name)
+
+        if index is None:
+            with self._lock:
+                build_lock = self._build_locks.setdefault(collection.name, threading.Lock())
+
+            with build_lock:
+                index = self._indexes.get(collection.name)
+
+                if index is None:
+                    generation = self._generations.get(collection.name, 0)
+                    index = self._build(collection)
+
+                    # una escritura durante la construccion pudo no quedar en el indice: se usa pero no se guarda
+                    with self._lock:
+                        if self._generations.get(collection.name, 0) == generation:
+                            self._indexes[collection.name] = index
+
+        return index
+
+    def query(self, collection:chromadb.Collection, query_text:str, n_results:int=5,
+              include:list[str]=['documents', 'metadatas', 'distances']) -> Optional[chromadb.QueryResult]:
+        """
+        Resuelve la consulta si coincide con una pregunta de la coleccion. Devuelve None si no hay coincidencia (o si
+        la consulta no se puede resolver con el indice), en cuyo caso se debe realizar la busqueda por embeddings.
+
+        El resultado tiene el mismo formato que ```collection.query()``` y contiene solo las preguntas coincidentes (a
+        lo sumo ```n_results```), con distancia 0. Si son menos que ```n_results``` se deben completar con la busqueda
+        por embeddings (ver ```merge_results```).
+        """
+        # solo consultas individuales, y los embeddings no se guardan en el indice
+        if not self.enabled(collection.name) or not isinstance(query_text, str) or 'embeddings' in include:
+            return None
+
+        matches = self.get(collection).lookup(query_text)[:n_results]
+        self._count(collection.name, bool(matches))
+
+        if not matches:
+            return None
+
+        return {
+            'ids': [[id for id, _, _ in matches]],
+            'distances': [[0.0] * len(matches)] if 'distances' in include else None,
+            'metadatas': [[metadata for _, _, metadata in matches]] if 'metadatas' in include else None,
+            'embeddings': None,
+            'documents': [[document for _, document, _ in matches]] if 'documents' in include else None,
+            'uris': None,
+            'data': None,
+        }
+
+    def load(self, collection_name:str, ids:list[str], documents:list[str], metadatas:list[dict]=None) -> None:
+        """ Construye el indice de la coleccion a partir de los datos de un dataset (ver ```get_data()```). """
+        if self.enabled(collection_name):
+            index = ExactMatchIndex()
+            index.add(ids, documents, metadatas)
+
+            with self._lock:
+                self._generations[collection_name] = self._generations.get(collection_name, 0) + 1
+                self._indexes[collection_name] = index
+
+    def add(self, collection_name:str, ids:list[str], documents:list[str], metadatas:list[dict]=None) -> None:
+        """ Agrega documentos al indice de la coleccion (si ya fue construido). """
+        self._bump(collection_name)
+        index = self._indexes.get(collection_name)
+
+        if index is not None:
+            index.add(ids, documents, metadatas)
+
+    def refresh(self, collection:chromadb.Collection, ids:list[str]) -> None:
+        """ Vuelve a leer documentos de la coleccion (por ejemplo luego de una actualizacion parcial). """
+        self._bump(collection.name)
+        index = self._indexes.get(collection.name)
+
+        if index is not None:
+            stored = collection.get(ids=ids, include=['documents', 'metadatas'])
+            index.remove([id for id in ids if id not in set(stored['ids'])])
+            index.add(stored['ids'], stored['documents'], stored['metadatas'])
+
+    def remove(self, collection_name:str, ids:list[str]) -> None:
+        self._bump(collection_name)
+        index = self._indexes.get(collection_name)
+
+        if index is not None:
+            index.remove(ids)
+
+    def invalidate(self, collection_name:str=None) -> None:
+        with self._lock:
+            for name in [collection_name] if collection_name else set(self._generations) | set(self._build_locks):
+                self._generations[name] = self._generations.get(name, 0) + 1
+
+            if collection_name:
+                self._indexes.pop(collection_name, None)
+            else:
+                self._indexes.clear()
+
+    def stats(self) -> dict:
+        """ Devuelve, por coleccion, los aciertos y fallos del atajo y la cantidad de preguntas indexadas. """
+        stats = {}
+
+        for collection_name in sorted(self.collections):
+            hits, misses = self._hits.get(collection_name, 0), self._misses.get(collection_name, 0)
+            index = self._indexes.get(collection_name)
+
+            stats[collection_name] = {
+                'hits': hits,
+                'misses': misses,
+                'hit_rate': hits / (hits + misses) if hits + misses else 0.0,
+                'items': len(index) if index is not None else None,
+            }
+
+        return stats
+
+    def _count(self, collection_name:str, hit:bool) -> None:
+        counters = self._hits if hit else self._misses
+
+        with self._lock:
+            counters[collection_name] = counters.get(collection_name, 0) + 1
+
+        EXACT_MATCH.inc(collection=collection_name, result='hit' if hit else 'miss')
+
+    def _bump(self, collection_name:str) -> None:
+        # las escrituras cambian la generacion de la coleccion (ver get)
+        with self._lock:
+            self._generations[collection_name] = self._generations.get(collection_name, 0) + 1
+
+    def _build(self, collection:chromadb.Collection) -> ExactMatchIndex:
+        index = ExactMatchIndex()
+        offset = 0
+
+        while True:
+            page = collection.get(include=['documents', 'metadatas'], limit=self.page_size, offset=offset)
+
+            if not page['ids']:
+                break
+
+            index.add(page['ids'], page['documents'], page['metadatas'])
+            offset += len(page['ids'])
+
+        return index
@@ -0,0 +1,254 @@
+"""
+Motor de busqueda exacta en memoria (NumPy).
+
+Con colecciones de decenas de miles de vectores, una multiplicacion de matrices sobre una matriz float32 contigua es
+exacta y mas rapida que un llamado HTTP al servidor de chroma. Tambien es la referencia para medir el recall del
+indice HNSW (ver ```Database.evaluate_recall```).
+
+Las distancias tienen la misma definicion que chroma: l2 al cuadrado, 1 - coseno y 1 - producto interno. Para 'cosine'
+los vectores se guardan normalizados, por lo que la distancia es ```1 - producto interno```.
+
+```python
+engine = ExactSearchEngine.from_collection(collection)
+ids, distances = engine.search(query_embeddings, n_results=5)
+```
+"""
+
+import threading
+
+import numpy as np
+import chromadb
+
+
+SPACES = ('l2', 'cosine', 'ip')
+
+
+def normalize(vectors:np.ndarray) -> np.ndarray:
+    """ Normaliza cada fila a norma 1 (las filas nulas quedan en cero). """
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors / np.maximum(norms, 1e-12)
+
+
+def distances(space:str, queries:np.ndarray, vectors:np.ndarray, squared_norms:np.ndarray=None) -> np.ndarray:
+    """
+    Matriz de distancias ```(consultas, vectores)```. Para 'cosine' las consultas y los vectores deben estar
+    normalizados (ver ```normalize```). ```squared_norms``` evita recalcular las normas de los vectores en 'l2'.
+    """
+    dot = queries @ vectors.T
+
+    if space == 'l2':
+        if squared_norms is None:
+            squared_norms = (vectors * vectors).sum(axis=1)
+
+        return np.maximum((queries * queries).sum(axis=1)[:, np.newaxis] - 2 * dot + squared_norms[np.newaxis, :], 0)
+
+    return 1 - dot
+
+
+def top_k(distances:np.ndarray, k:int) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Devuelve ```(indices, distancias)``` de los ```k``` menores valores de cada fila, ordenados. Se seleccionan con
+    ```argpartition``` (O(n)) y solo se ordenan los ```k``` elegidos.
+    """
+    k = min(k, distances.shape[1])
+
+    if k == 0:
+        return np.zeros((len(distances), 0), dtype=np.int64), np.zeros((len(distances), 0), dtype=distances.dtype)
+
+    top = np.argpartition(distances, k - 1, axis=1)[:, :k] if k < distances.shape[1] else np.tile(np.arange(k), (len(distances), 1))
+    top = np.take_along_axis(top, np.argsort(np.take_along_axis(distances, top, axis=1), axis=1, kind='stable'), axis=1)
+
+    return top, np.take_along_axis(distances, top, axis=1)
+
+
+class ExactSearchEngine:
+    """
+    Indice de fuerza bruta sobre una matriz float32 contigua, actualizable.
+
+    Las filas se agregan al final (la capacidad crece al doble) y al eliminar un id su lugar lo ocupa la ultima fila,
+    de modo que la matriz no tiene huecos.
+
+    - space: distancia de la coleccion ('l2', 'cosine' o 'ip'), la misma que ```hnsw:space```.
+    """
+
+    def __init__(self, space:str='l2', capacity:int=1024) -> None:
+        if space not in SPACES:
+            raise ValueError(f'space debe ser uno de {SPACES}')
+
+        self.space = space
+        self.ids:list[str] = []
+
+        self._capacity = capacity
+        self._rows:dict[str, int] = {}
+        self._matrix:np.ndarray = None
+        self._squared_norms:np.ndarray = None
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    @property
+    def dim(self) -> int:
+        return self._matrix.shape[1] if self._matrix is not None else 0
+
+    @property
+    def vectors(self) -> np.ndarray:
+        """ Vista de los vectores almacenados (normalizados si la distancia es 'cosine'). """
+        return self._matrix[:len(self.ids)] if self._matrix is not None else np.zeros((0, 0), dtype=np.float32)
+
+    @classmethod
+    def from_collection(cls, collection:chromadb.Collection, page_size:int=1000) -> 'ExactSearchEngine':
+        """ Carga los embeddings de una coleccion, leidos en paginas de ```page_size```. """
+        engine = cls(space=(collection.metadata or {}).get('hnsw:space', 'l2'), capacity=max(collection.count(), 1))
+        offset = 0
+
+        while True:
+            page = collection.get(include=['embeddings'], limit=page_size, offset=offset)
+
+            if not page['ids']:
+                break
+
+            engine.add(page['ids'], page['embeddings'])
+            offset += len(page['ids'])
+
+        return engine
+
+    def add(self, ids:list[str], embeddings) -> None:
+        """ Agrega (o reemplaza) vectores. """
+        vectors = np.atleast_2d(np.asarray(embeddings, dtype=np.float32))
+
+        if not len(ids):
+            return
+
+        if self.space == 'cosine':
+            vectors = normalize(vectors)
+
+        with self._lock:
+            if self._matrix is None:
+                self._matrix = np.empty((self._capacity, vectors.shape[1]), dtype=np.float32)
+                self._squared_norms = np.empty(self._capacity, dtype=np.float32)
+
+            for id, vector in zip(ids, vectors):
+                row = self._rows.get(id)
+
+                if row is None:
+                    row = len(self.ids)
+                    self._grow(row + 1)
+                    self._rows[id] = row
+                    self.ids.append(id)
+
+                self._matrix[row] = vector
+                self._squared_norms[row] = vector @ vector
+
+    def remove(self, ids:list[str]) -> None:
+        with self._lock:
+            for id in ids:
+                row = self._rows.pop(id, None)
+
+                if row is None:
+                    continue
+
+                # la ultima fila ocupa el lugar de la eliminada
+                last = len(self.ids) - 1
+                last_id = self.ids.pop()
+
+                if row != last:
+                    self._matrix[row] = self._matrix[last]
+                    self._squared_norms[row] = self._squared_norms[last]
+                    self.ids[row] = last_id
+                    self._rows[last_id] = row
+
+    def refresh(self, collection:chromadb.Collection, ids:list[str]) -> None:
+        """ Vuelve a leer de la coleccion los vectores de ```ids``` (los que ya no existen se eliminan). """
+        stored = collection.get(ids=ids, include=['embeddings'])
+        self.remove([id for id in ids if id not in set(stored['ids'])])
+        self.add(stored['ids'], stored['embeddings'])
+
+    def search(self, query_embeddings, n_results:int=5, batch_size:int=256) -> tuple[list[list[str]], list[list[float]]]:
+        """
+        Devuelve ```(ids, distances)``` de los ```n_results``` vecinos exactos de cada consulta. Las consultas se
+        procesan en bloques de ```batch_size``` para acotar la memoria de la matriz de distancias.
+        """
+        queries = np.atleast_2d(np.asarray(query_embeddings, dtype=np.float32))
+
+        if self.space == 'cosine':
+            queries = normalize(queries)
+
+        ids, result = [], []
+
+        with self._lock:
+            count = len(self.ids)
+
+            for start in range(0, len(queries), batch_size):
+                if count:
+                    block = distances(self.space, queries[start:start + batch_size], self._matrix[:count], self._squared_norms[:count])
+                else:
+                    block = np.zeros((len(queries[start:start + batch_size]), 0), dtype=np.float32)
+
+                top, top_distances = top_k(block, n_results)
+
+                ids.extend([self.ids[j] for j in row] for row in top)
+                result.extend(top_distances.tolist())
+
+        return ids, result
+
+    def query(self, collection:chromadb.Collection, query_embeddings, n_results:int=5,
+              include:list[str]=['documents', 'metadatas', 'distances']) -> chromadb.QueryResult:
+        """
+        Busqueda exacta con el mismo formato que ```collection.query()```. Los documentos y la metadata de los
+        resultados se leen de la coleccion.
+        """
+        ids, result = self.search(query_embeddings, n_results)
+        keys = [key for key in ('documents', 'metadatas', 'embeddings') if key in include]
+
+        response = {
+            'ids': ids,
+            'distances': result if 'distances' in include else None,
+            'metadatas': None,
+            'embeddings': None,
+            'documents': None,
+            'uris': None,
+            'data': None,
+        }
+
+        if keys:
+            unicos = list(dict.fromkeys(id for row in ids for id in row))
+            stored = collection.get(ids=unicos, include=keys) if unicos else {'ids': []}
+            rows = {id: j for j, id in enumerate(stored['ids'])}
+
+            for key in keys:
+                response[key] = [[stored[key][rows[id]] for id in row] for row in ids]
+
+        return response
+
+    def query_function(self, collection:chromadb.Collection, fallback=None):
+        """
+        Devuelve una funcion con la firma de ```collection.query``` resuelta por el motor (ver ```hybrid_query```).
+        Las consultas con filtro ```where``` se delegan en ```fallback``` (por defecto ```collection.query```).
+        """
+        fallback = fallback or collection.query
+
+        def consultar(query_embeddings:list, n_results:int=5, include:list[str]=['documents', 'metadatas', 'distances'], where:dict=None):
+            if where:
+                return fallback(query_embeddings=query_embeddings, n_results=n_results, include=include, where=where)
+
+            return self.query(collection, query_embeddings, n_results, include)
+
+        return consultar
+
+    def memory(self) -> int:
+        """ Bytes ocupados por la matriz de vectores (incluida la capacidad reservada). """
+        return self._matrix.nbytes + self._squared_norms.nbytes if self._matrix is not None else 0
+
+    def _grow(self, size:int) -> None:
+        if size <= len(self._matrix):
+            return
+
+        capacity = max(size, 2 * len(self._matrix))
+
+        matrix = np.empty((capacity, self._matrix.shape[1]), dtype=np.float32)
+        matrix[:len(self.ids)] = self._matrix[:len(self.ids)]
+        squared_norms = np.empty(capacity, dtype=np.float32)
+        squared_norms[:len(self.ids)] = self._squared_norms[:len(self.ids)]
+
+        self._matrix, self._squared_norms = matrix, squared_norms
@@ -0,0 +1,192 @@
+"""
+Perfiles de parametros del indice HNSW de chroma y herramienta de ajuste.
+
+Los parametros del indice solo se pueden fijar al crear la coleccion (metadata ```hnsw:*```):
+
+- hnsw:space: distancia ('l2', 'cosine' o 'ip').
+- hnsw:M: vecinos por nodo. Mas vecinos = mejor recall, mas memoria y construccion mas lenta.
+- hnsw:construction_ef: tamaño de la lista de candidatos al insertar. Mejora la calidad del grafo a costa del tiempo de carga.
+- hnsw:search_ef: tamaño de la lista de candidatos al consultar. Mejora el recall a costa de la latencia.
+
+```python
+database.create_collection('abc_collection', profile='recall')
+tune_index(database.get_collection('abc_collection'), query_embeddings, profiles=['default', 'latency', 'recall'])
+```
+"""
+
+import time
+import itertools
+
+import numpy as np
+import pandas as pd
+import chromadb
+from chromadb.config import Settings
+
+from utilities import recall_at_k
+from exact_search import ExactSearchEngine
+
+
+# valores por defecto de chroma: M=16, construction_ef=100, search_ef=10
+INDEX_PROFILES = {
+    'default': {},
+    'latency': {'hnsw:M': 12, 'hnsw:construction_ef': 100, 'hnsw:search_ef': 16},
+    'recall': {'hnsw:M': 32, 'hnsw:construction_ef': 400, 'hnsw:search_ef': 128},
+    'memory': {'hnsw:M': 8, 'hnsw:construction_ef': 64, 'hnsw:search_ef': 32},
+}
+
+DEFAULT_PARAMS = {'hnsw:space': 'l2', 'hnsw:M': 16, 'hnsw:construction_ef': 100, 'hnsw:search_ef': 10}
+
+# base de datos de la instancia en memoria de chroma donde se crean las colecciones temporales de tune_index
+TUNING_DATABASE = 'index_tuning'
+
+
+def get_index_metadata(profile:str=None, metadata:dict=None, space:str=None) -> dict:
+    """
+    Devuelve la metadata de creacion de una coleccion para el perfil indicado. ```metadata``` se combina con el
+    perfil (y tiene prioridad). Devuelve None si no hay nada que configurar.
+    """
+    if profile and profile not in INDEX_PROFILES:
+        raise ValueError(f'Perfil de indice desconocido: {profile}. Opciones: {", ".join(INDEX_PROFILES)}')
+
+    result = dict(INDEX_PROFILES.get(profile or 'default'))
+
+    if space:
+        result['hnsw:space'] = space
+
+    result.update(metadata or {})
+
+    return result or None
+
+
+def estimate_index_memory(count:int, dim:int, M:int) -> int:
+    """
+    Estimacion de los bytes en memoria del indice hnswlib: en el nivel 0 cada elemento guarda su vector (float32),
+    hasta 2*M vecinos y su etiqueta. Los niveles superiores agregan en promedio una fraccion 1/M de eso.
+    """
+    level0 = 4 * dim + (2 * M * 4 + 4) + 8
+    upper = (M * 4 + 4) / max(M - 1, 1)
+
+    return int(count * (level0 + upper))
+
+
+def tune_index(collection:chromadb.Collection, query_embeddings, profiles:list[str]=None, grid:dict=None, k:int=10,
+               batch_size:int=1000, page_size:int=1000) -> pd.DataFrame:
+    """
+    Compara configuraciones del indice sobre los vectores de una coleccion y un conjunto de consultas reservado
+    (```query_embeddings```, que no deberian ser documentos de la coleccion).
+
+    Cada configuracion se construye en una coleccion temporal en memoria, dentro de una base de datos propia
+    (```TUNING_DATABASE```), por lo que ni la coleccion original ni las colecciones en memoria de ```Database``` se
+    modifican. Las configuraciones se indican como nombres de perfiles, como una grilla de parametros o ambos:
+
+    ```python
+    tune_index(collection, query_embeddings, grid={'hnsw:M': [8, 16, 32], 'hnsw:search_ef': [10, 50, 100]})
+    ```
+
+    Por configuracion se reporta: tiempo de construccion, latencia p50/p99 de consultas individuales, consultas por
+    segundo, memoria estimada del indice y recall@k frente a la busqueda exacta.
+    """
+    space = (collection.metadata or {}).get('hnsw:space', 'l2')
+    ids, vectors = _load_vectors(collection, page_size)
+    queries = np.atleast_2d(np.asarray(query_embeddings, dtype=np.float32))
+
+    k = min(k, len(ids))
+
+    # referencia: busqueda exacta en memoria
+    engine = ExactSearchEngine(space, capacity=len(ids))
+    engine.add(ids, vectors)
+    expected, _ = engine.search(queries, n_results=k)
+
+    configs = [(profile, get_index_metadata(profile, space=space) or {}) for profile in (profiles or ([] if grid else list(INDEX_PROFILES)))]
+
+    if grid:
+        keys = list(grid)
+        for values in itertools.product(*(grid[key] for key in keys)):
+            params = dict(zip(keys, values))
+            configs.append((' '.join(f'{key[5:]}={value}' for key, value in params.items()), {'hnsw:space': space, **params}))
+
+    client = _tuning_client()
+    report = []
+
+    for i, (name, metadata) in enumerate(configs):
+        params = {**DEFAULT_PARAMS, **metadata}
+        tuning_name = f'tuning_{i}_{int(time.time() * 1000)}'
+
+        try:
+            tuning = client.create_collection(tuning_name, metadata=metadata)
+
+            t_i = time.perf_counter()
+            for start in range(0, len(ids), batch_size):
+                tuning.add(ids=ids[start:start + batch_size], embeddings=vectors[start:start + batch_size].tolist())
+            build_seconds = time.perf_counter() - t_i
+
+            # la primera consulta carga el indice: no se mide
+            tuning.query(query_embeddings=queries[:1].tolist(), n_results=k, include=[])
+
+            latencies, found = [], []
+            for query in queries:
+                t_q = time.perf_counter()
+                result = tuning.query(query_embeddings=[query.tolist()], n_results=k, include=[])
+                latencies.append(time.perf_counter() - t_q)
+                found.append(result['ids'][0])
+
+            latencies = np.array(latencies) * 1000
+
+            report.append({
+                'profile': name,
+                'M': params['hnsw:M'],
+                'construction_ef': params['hnsw:construction_ef'],
+                'search_ef': params['hnsw:search_ef'],
+                'build_seconds': round(build_seconds, 3),
+                'p50_ms': round(float(np.percentile(latencies, 50)), 3),
+                'p99_ms': round(float(np.percentile(latencies, 99)), 3),
+                'qps': round(len(latencies) / (latencies.sum() / 1000), 1),
+                'memory_mb': round(estimate_index_memory(len(ids), vectors.shape[1], params['hnsw:M']) / 2**20, 2),
+                f'recall@{k}': round(recall_at_k(expected, found), 4),
+            })
+
+        finally:
+            try:
+                client.delete_collection(tuning_name)
+            except Exception:
+                pass
+
+    df = pd.DataFrame(report)
+    print(f'\nAjuste de indice: {len(ids)} vectores, {len(queries)} consultas, k={k}')
+    print(df.to_string(index=False))
+
+    return df
+
+
+def _tuning_client() -> chromadb.ClientAPI:
+    # chroma comparte una unica instancia en memoria por proceso (tambien con Database(persistent=False)): las
+    # colecciones temporales se aislan en su propia base de datos
+    settings = Settings(anonymized_telemetry=False)
+    admin = chromadb.AdminClient(settings)
+
+    try:
+        admin.get_database(TUNING_DATABASE)
+    except Exception:
+        admin.create_database(TUNING_DATABASE)
+
+    return chromadb.EphemeralClient(settings, database=TUNING_DATABASE)
+
+
+def _load_vectors(collection:chromadb.Collection, page_size:int) -> tuple[list[str], np.ndarray]:
+    ids, vectors = [], []
+    offset = 0
+
+    while True:
+        page = collection.get(include=['embeddings'], limit=page_size, offset=offset)
+
+        if not page['ids']:
+            break
+
+        ids.extend(page['ids'])
+        vectors.append(np.asarray(page['embeddings'], dtype=np.float32))
+        offset += len(page['ids'])
+
+    if not vectors:
+        raise ValueError(f'La coleccion {collection.name} no contiene vectores')
+
+    return ids, np.concatenate(vectors)
@@ -0,0 +1,224 @@
+"""
+Motor de ingesta en paralelo para colecciones de chroma.
+
+La ingesta se divide en tres etapas conectadas por colas acotadas (backpressure):
+
+    lectura (1 hilo) -> embeddings (N workers) -> escritura (1 hilo)
+
+- lectura: recorre los bloques ```(documents, metadatas, ids)``` del dataset
+- embeddings: un pool de workers calcula los embeddings de cada bloque en paralelo
+- escritura: un unico hilo llama a ```collection.add(embeddings=...)```, de manera que la coleccion nunca
+  recibe escrituras concurrentes
+"""
+
+import os
+import queue
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from typing import Iterable, Iterator
+
+import chromadb
+
+from metrics import track
+from utilities import progress_bar
+from embedding_cache import EmbeddingCache
+
+
+# sentinela que indica el fin de los datos en una cola
+_FIN = object()
+
+# funcion de embeddings de cada proceso worker (solo se utiliza con use_processes=True)
+_worker_embedding_function = None
+
+
+def _init_worker(embedding_function) -> None:
+    global _worker_embedding_function
+    _worker_embedding_function = embedding_function
+
+
+def _embed(documents:list[str]) -> list:
+    return _worker_embedding_function(documents)
+
+
+def chunk_data(dataset_data:dict, batch_size:int) -> Iterator[tuple[list, list, list]]:
+    """
+    Divide el diccionario devuelto por ```get_data()``` en bloques ```(documents, metadatas, ids)``` de tamaño ```batch_size```.
+    """
+    documents = dataset_data['documents']
+    metadatas = dataset_data['metadatas']
+    ids = dataset_data['ids']
+
+    for start in range(0, len(ids), batch_size):
+        end = start + batch_size
+        yield documents[start:end], metadatas[start:end], ids[start:end]
+
+
+class IngestionPipeline:
+    """
+    Pipeline productor/consumidor para añadir documentos a una coleccion.
+
+    Ejemplo de uso:
+
+    ```python
+    pipeline = IngestionPipeline(collection, embedding_function, workers=8)
+    pipeline.run(chunk_data(abc.get_data(), batch_size=256), total=abc_data['count'])
+    ```
+
+    - workers: cantidad de workers que calculan embeddings. Por defecto la cantidad de nucleos del equipo.
+    - queue_size: tamaño maximo de las colas entre etapas. Por defecto el doble de workers.
+    - use_processes: calcula los embeddings en un pool de procesos en lugar de hilos. La funcion de embeddings
+      debe poder serializarse con pickle. Si es un ```EmbeddingCache``` los procesos reciben solo la funcion que
+      envuelve: el cache (su lock y su conexion SQLite) se consulta y se actualiza en el proceso principal.
+    """
+
+    def __init__(self, collection:chromadb.Collection, embedding_function, workers:int=None, queue_size:int=None, use_processes:bool=False) -> None:
+        self.collection = collection
+        self.embedding_function = embedding_function
+        self.workers = workers or os.cpu_count() or 1
+        self.queue_size = queue_size or 2 * self.workers
+        self.use_processes = use_processes
+
+        self._read_queue = queue.Queue(maxsize=self.queue_size)
+        self._write_queue = queue.Queue(maxsize=self.queue_size)
+        self._stop = threading.Event()
+        self._errors = []
+        self._executor = None
+
+        self.count = 0
+
+    def run(self, batches:Iterable[tuple[list, list, list]], total:int=None) -> int:
+        """
+        Ejecuta la ingesta de los bloques indicados y devuelve la cantidad de documentos añadidos.
+
+        Si se especifica ```total``` se muestra una barra de progreso por cada bloque escrito.
+        Cualquier error en alguna de las etapas detiene el pipeline y se vuelve a lanzar en este metodo.
+        """
+        if self.use_processes:
+            self._executor = ProcessPoolExecutor(
+                max_workers=self.workers,
+                initializer=_init_worker,
+                initargs=(self._backend(),)
+            )
+
+        threads = [threading.Thread(target=self._reader, args=(batches,), daemon=True)]
+        threads += [threading.Thread(target=self._embedder, daemon=True) for _ in range(self.workers)]
+        threads += [threading.Thread(target=self._writer, args=(total,), daemon=True)]
+
+        t_i = time.perf_counter()
+
+        try:
+            for thread in threads:
+                thread.start()
+
+            for thread in threads:
+                thread.join()
+
+        finally:
+            if self._executor:
+                self._executor.shutdown(cancel_futures=True)
+                self._executor = None
+
+        if self._errors:
+            raise self._errors[0]
+
+        t_total = time.perf_counter() - t_i
+        print(f'\nSe han añadido {self.count} documentos en {t_total:.2f} segundos ({self.count / t_total if t_total else 0:.2f} docs/seg)')
+
+        return self.count
+
+    def _backend(self):
+        # funcion de embeddings de los procesos worker: sin el cache, que no se puede compartir entre procesos
+        if isinstance(self.embedding_function, EmbeddingCache):
+            return self.embedding_function.embedding_function
+
+        return self.embedding_function
+
+    def _embed_in_process(self, documents:list[str]) -> list:
+        return self._executor.submit(_embed, documents).result()
+
+    def _put(self, target:queue.Queue, item) -> bool:
+        # put bloqueante que se libera si alguna etapa fallo
+        while not self._stop.is_set():
+            try:
+                target.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _get(self, source:queue.Queue):
+        while not self._stop.is_set():
+            try:
+                return source.get(timeout=0.1)
+            except queue.Empty:
+                continue
+        return _FIN
+
+    def _fail(self, error:Exception) -> None:
+        self._errors.append(error)
+        self._stop.set()
+
+    def _reader(self, batches:Iterable[tuple[list, list, list]]) -> None:
+        try:
+            for batch in batches:
+                if not self._put(self._read_queue, batch):
+                    return
+        except Exception as e:
+            self._fail(e)
+        finally:
+            for _ in range(self.workers):
+                self._put(self._read_queue, _FIN)
+
+    def _embedder(self) -> None:
+        try:
+            while True:
+                batch = self._get(self._read_queue)
+                if batch is _FIN:
+                    break
+
+                documents, metadatas, ids = batch
+
+                if self._executor and isinstance(self.embedding_function, EmbeddingCache):
+                    embeddings = self.embedding_function.embed(documents, compute=self._embed_in_process)
+                elif self._executor:
+                    embeddings = self._embed_in_process(documents)
+                else:
+                    embeddings = self.embedding_function(documents)
+
+                if not self._put(self._write_queue, (documents, metadatas, ids, embeddings)):
+                    break
+        except Exception as e:
+            self._fail(e)
+        finally:
+            self._put(self._write_queue, _FIN)
+
+    def _writer(self, total:int=None) -> None:
+        finished = 0
+
+        try:
+            while finished < self.workers:
+                batch = self._get(self._write_queue)
+                if batch is _FIN:
+                    # el sentinela tambien se devuelve al detener el pipeline
+                    if self._stop.is_set():
+                        break
+                    finished += 1
+                    continue
+
+                documents, metadatas, ids, embeddings = batch
+
+                with track('add', collection=self.collection.name, batch_size=len(ids)):
+                    self.collection.add(
+                        documents= documents,
+                        metadatas= metadatas,
+                        ids= ids,
+                        embeddings= embeddings
+                    )
+                self.count += len(ids)
+
+                if total:
+                    progress_bar(min(self.count, total), total)
+
+        except Exception as e:
+            self._fail(e)
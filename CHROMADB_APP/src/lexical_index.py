@@ -0,0 +1,405 @@
+"""
+Indice lexico (BM25) en memoria y busqueda hibrida.
+
+Complementa la busqueda por embeddings en consultas con numeros de formulario, nombres de regimenes y siglas
+("F.184", "recategorizacion", "CUIT"), que el modelo de embeddings suele ordenar mal. La busqueda por embeddings y
+BM25 devuelven cada una sus candidatos y ambos rankings se combinan con reciprocal rank fusion (RRF). Los documentos
+que solo encontro BM25 (por ejemplo un numero de formulario que el modelo de embeddings no acerca a la consulta) se
+leen de la coleccion con un unico llamado adicional a ```collection.get```, que tambien aplica el filtro ```where```.
+
+El texto indexado de cada documento es el documento (la pregunta) mas los campos de metadata indicados en ```fields```
+(por defecto la 'respuesta' que generan los datasets de ```local_datasets```).
+
+```python
+indexes = LexicalIndexes()
+response = hybrid_query(collection, indexes.get(collection), ['formulario F.184'], query_embeddings, n_results=5)
+```
+"""
+
+import re
+import math
+import threading
+from collections import Counter
+
+import numpy as np
+import chromadb
+
+from utilities import normalizar_texto
+from metrics import track
+from exact_search import normalize, distances
+
+
+# palabras vacias del español, sin acentos (el texto se normaliza antes de separar las palabras)
+STOPWORDS = frozenset('''
+    a al algo algun alguna algunas alguno algunos ante antes como con contra cual cuales cuando de del desde donde
+    durante e el ella ellas ello ellos en entre era eran es esa esas ese eso esos esta estan estas este esto estos fue
+    fueron ha han hasta hay la las le les lo los mas me mi mis mucho muy ni no nos o os otra otras otro otros para pero
+    poco por porque que quien quienes se sea sean segun ser si sin sobre son su sus tambien te tiene tienen tu tus un una
+    unas uno unos y ya yo
+'''.split())
+
+_TOKEN = re.compile(r'[a-z0-9]+')
+
+# codigos como "F.184", "f 184", "F-184" o "f184": se indexan tambien unidos ("f184")
+_CODIGO = re.compile(r'\b([a-z]{1,4})[.\-/ ]?(\d+)\b')
+
+
+def tokenizar(texto:str) -> list[str]:
+    """
+    Separa un texto en terminos: minusculas, sin acentos, sin palabras vacias, y con los codigos de formulario unidos.
+
+    ```python
+    tokenizar('¿Cómo presento el F.184 de recategorización?')
+    # ['presento', 'f', '184', 'recategorizacion', 'f184']
+    ```
+    """
+    texto = normalizar_texto(texto)
+
+    terminos = [termino for termino in _TOKEN.findall(texto) if termino not in STOPWORDS]
+    terminos.extend(letras + numero for letras, numero in _CODIGO.findall(texto) if letras not in STOPWORDS)
+
+    return terminos
+
+
+class BM25Index:
+    """
+    Indice invertido con puntaje BM25.
+
+    Las listas de cada termino se guardan como arreglos de numpy (posiciones de documentos y frecuencias), de modo
+    que una consulta acumula los puntajes de todos los documentos con unas pocas operaciones vectorizadas.
+    Admite altas, modificaciones y bajas de documentos.
+
+    - k1: saturacion de la frecuencia de un termino en un documento.
+    - b: normalizacion por longitud del documento.
+    """
+
+    def __init__(self, k1:float=1.5, b:float=0.75) -> None:
+        self.k1 = k1
+        self.b = b
+
+        self._slots:dict[str, int] = {}           # id -> posicion
+        self._ids:list[str] = []                  # posicion -> id (None si esta libre)
+        self._free:list[int] = []
+        self._lengths = np.zeros(1024, dtype=np.float32)
+        self._total_length = 0
+
+        self._postings:dict[str, dict[int, int]] = {}          # termino -> {posicion: frecuencia}
+        self._arrays:dict[str, tuple[np.ndarray, np.ndarray]] = {}
+        self._terms:dict[int, Counter] = {}                     # posicion -> terminos del documento
+
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._slots)
+
+    def __contains__(self, id:str) -> bool:
+        return id in self._slots
+
+    def add(self, ids:list[str], texts:list[str]) -> None:
+        """ Agrega (o reemplaza) documentos. """
+        with self._lock:
+            for id, text in zip(ids, texts):
+                if id in self._slots:
+                    self._remove(id)
+                self._add(id, text)
+
+    def remove(self, ids:list[str]) -> None:
+        with self._lock:
+            for id in ids:
+                if id in self._slots:
+                    self._remove(id)
+
+    def search(self, query:str, n_results:int=10, ids:list[str]=None) -> list[tuple[str, float]]:
+        """
+        Devuelve los ```n_results``` documentos con mayor puntaje BM25, como ```[(id, puntaje), ...]```. Con ```ids```
+        solo se consideran esos documentos.
+        """
+        terms = set(tokenizar(query))
+
+        with self._lock:
+            count = len(self._slots)
+
+            if not count or not terms:
+                return []
+
+            average_length = self._total_length / count
+            scores = np.zeros(len(self._ids), dtype=np.float32)
+
+            for term in terms:
+                if term not in self._postings:
+                    continue
+
+                slots, frequencies = self._posting_arrays(term)
+                idf = math.log(1 + (count - len(slots) + 0.5) / (len(slots) + 0.5))
+                norm = self.k1 * (1 - self.b + self.b * self._lengths[slots] / average_length)
+
+                scores[slots] += idf * frequencies * (self.k1 + 1) / (frequencies + norm)
+
+            if ids is not None:
+                allowed = np.zeros(len(scores), dtype=bool)
+                allowed[[self._slots[id] for id in ids if id in self._slots]] = True
+                scores[~allowed] = 0
+
+            found = np.flatnonzero(scores)
+            if len(found) > n_results:
+                found = found[np.argpartition(-scores[found], n_results - 1)[:n_results]]
+
+            found = found[np.argsort(-scores[found])]
+
+            return [(self._ids[slot], float(scores[slot])) for slot in found]
+
+    def _add(self, id:str, text:str) -> None:
+        terms = Counter(tokenizar(text))
+
+        if self._free:
+            slot = self._free.pop()
+            self._ids[slot] = id
+        else:
+            slot = len(self._ids)
+            self._ids.append(id)
+
+            if slot >= len(self._lengths):
+                self._lengths = np.concatenate([self._lengths, np.zeros(len(self._lengths), dtype=np.float32)])
+
+        length = sum(terms.values())
+
+        self._slots[id] = slot
+        self._terms[slot] = terms
+        self._lengths[slot] = length
+        self._total_length += length
+
+        for term, frequency in terms.items():
+            self._postings.setdefault(term, {})[slot] = frequency
+            self._arrays.pop(term, None)
+
+    def _remove(self, id:str) -> None:
+        slot = self._slots.pop(id)
+
+        for term in self._terms.pop(slot):
+            posting = self._postings[term]
+            del posting[slot]
+            self._arrays.pop(term, None)
+
+            if not posting:
+                del self._postings[term]
+
+        self._total_length -= int(self._lengths[slot])
+        self._lengths[slot] = 0
+        self._ids[slot] = None
+        self._free.append(slot)
+
+    def _posting_arrays(self, term:str) -> tuple[np.ndarray, np.ndarray]:
+        # los arreglos de un termino se reconstruyen solo cuando sus documentos cambiaron
+        arrays = self._arrays.get(term)
+
+        if arrays is None:
+            posting = self._postings[term]
+            arrays = self._arrays[term] = (
+                np.fromiter(posting.keys(), dtype=np.int64, count=len(posting)),
+                np.fromiter(posting.values(), dtype=np.float32, count=len(posting)),
+            )
+
+        return arrays
+
+
+class LexicalIndexes:
+    """
+    Indices BM25 por coleccion. Cada indice se construye la primera vez que se consulta la coleccion (o antes, con
+    ```get```, al iniciar la aplicacion), leyendo sus documentos en paginas. Las escrituras realizadas a traves de
+    ```Database``` y ```Client``` lo mantienen sincronizado (```add```, ```refresh```, ```remove```) o lo descartan
+    para reconstruirlo (```invalidate```).
+
+    Cada coleccion tiene su propio lock de construccion: mientras se construye el indice de una coleccion, las
+    consultas a las demas no se bloquean.
+    """
+
+    def __init__(self, fields:tuple[str, ...]=('respuesta',), page_size:int=1000) -> None:
+        self.fields = fields
+        self.page_size = page_size
+
+        self._indexes:dict[str, BM25Index] = {}
+        self._build_locks:dict[str, threading.Lock] = {}
+        self._generations:dict[str, int] = {}
+        self._lock = threading.Lock()
+
+    def get(self, collection:chromadb.Collection) -> BM25Index:
+        index = self._indexes.get(collection.name)
+
+        if index is None:
+            with self._lock:
+                build_lock = self._build_locks.setdefault(collection.name, threading.Lock())
+
+            with build_lock:
+                index = self._indexes.get(collection.name)
+
+                if index is None:
+                    generation = self._generations.get(collection.name, 0)
+                    index = self._build(collection)
+
+                    # una escritura durante la construccion pudo no quedar en el indice: se usa pero no se guarda
+                    with self._lock:
+                        if self._generations.get(collection.name, 0) == generation:
+                            self._indexes[collection.name] = index
+
+        return index
+
+    def add(self, collection_name:str, ids:list[str], documents:list[str], metadatas:list[dict]=None) -> None:
+        """ Agrega documentos al indice de la coleccion (si ya fue construido). """
+        self._bump(collection_name)
+        index = self._indexes.get(collection_name)
+
+        if index is not None:
+            index.add(ids, [self.text(document, metadata) for document, metadata in zip(documents, metadatas or [None] * len(ids))])
+
+    def refresh(self, collection:chromadb.Collection, ids:list[str]) -> None:
+        """ Vuelve a leer documentos de la coleccion (por ejemplo luego de una actualizacion parcial). """
+        self._bump(collection.name)
+        index = self._indexes.get(collection.name)
+
+        if index is not None:
+            stored = collection.get(ids=ids, include=['documents', 'metadatas'])
+            index.remove([id for id in ids if id not in set(stored['ids'])])
+            self.add(collection.name, stored['ids'], stored['documents'], stored['metadatas'])
+
+    def remove(self, collection_name:str, ids:list[str]) -> None:
+        self._bump(collection_name)
+        index = self._indexes.get(collection_name)
+
+        if index is not None:
+            index.remove(ids)
+
+    def invalidate(self, collection_name:str=None) -> None:
+        with self._lock:
+            for name in [collection_name] if collection_name else set(self._generations) | set(self._build_locks):
+                self._generations[name] = self._generations.get(name, 0) + 1
+
+            if collection_name:
+                self._indexes.pop(collection_name, None)
+            else:
+                self._indexes.clear()
+
+    def text(self, document:str, metadata:dict=None) -> str:
+        """ Texto indexado de un documento: el documento y los campos de metadata configurados. """
+        campos = [str(metadata[field]) for field in self.fields if metadata and metadata.get(field)]
+        return ' '.join([document or '', *campos])
+
+    def _bump(self, collection_name:str) -> None:
+        # las escrituras cambian la generacion de la coleccion (ver get)
+        with self._lock:
+            self._generations[collection_name] = self._generations.get(collection_name, 0) + 1
+
+    def _build(self, collection:chromadb.Collection) -> BM25Index:
+        index = BM25Index()
+        offset = 0
+
+        while True:
+            page = collection.get(include=['documents', 'metadatas'], limit=self.page_size, offset=offset)
+
+            if not page['ids']:
+                break
+
+            index.add(page['ids'], [self.text(document, metadata) for document, metadata in zip(page['documents'], page['metadatas'])])
+            offset += len(page['ids'])
+
+        return index
+
+
+def reciprocal_rank_fusion(rankings:list[list[str]], k:int=60) -> list[str]:
+    """
+    Combina varios rankings de ids: cada id suma ```1 / (k + posicion)``` por cada ranking en el que aparece.
+    """
+    scores:dict[str, float] = {}
+
+    for ranking in rankings:
+        for position, id in enumerate(ranking, start=1):
+            scores[id] = scores.get(id, 0.0) + 1 / (k + position)
+
+    return sorted(scores, key=scores.get, reverse=True)
+
+
+def hybrid_query(collection:chromadb.Collection, index:BM25Index, query_texts:list[str], query_embeddings:list, n_results:int=5,
+                 include:list[str]=['documents', 'metadatas', 'distances'], candidates:int=None, rrf_k:int=60, query_function=None,
+                 where:dict=None) -> chromadb.QueryResult:
+    """
+    Consulta hibrida: obtiene ```candidates``` resultados por embeddings y ```candidates``` por BM25 (sobre toda la
+    coleccion), combina ambos rankings con RRF y devuelve los ```n_results``` mejores con el mismo formato que
+    ```collection.query()```.
+
+    Los documentos encontrados solo por BM25 se leen de la coleccion en un unico ```collection.get``` para todas las
+    consultas. Su distancia se calcula con el embedding de la consulta y la misma metrica de la coleccion, de modo que
+    todas las distancias son comparables. El orden es el de RRF, por lo que las distancias no son necesariamente
+    crecientes.
+
+    - query_function: funcion que ejecuta la consulta por embeddings (por defecto ```collection.query```), por
+      ejemplo con reintentos.
+    - where: filtro de metadata de chroma. Se aplica a la consulta por embeddings y a los documentos de BM25 (el
+      indice BM25 no conoce la metadata).
+    """
+    candidates = candidates or max(n_results * 4, 20)
+    query_function = query_function or collection.query
+
+    response = query_function(query_embeddings=query_embeddings, n_results=candidates, include=include, where=where)
+
+    keys = [key for key in ('ids', 'distances', 'metadatas', 'documents', 'embeddings', 'uris') if key == 'ids' or response.get(key) is not None]
+    result = {key: [] for key in keys}
+
+    rankings = []
+
+    for i, query_text in enumerate(query_texts):
+        with track('lexical_query', collection=collection.name, batch_size=1) as op:
+            rankings.append([id for id, _ in index.search(query_text, candidates)])
+            op.results = len(rankings[-1])
+
+    # documentos de BM25 que no devolvio la busqueda por embeddings: se leen todos juntos
+    vector_ids = [set(ids) for ids in response['ids']]
+    missing = list(dict.fromkeys(id for i, lexical in enumerate(rankings) for id in lexical if id not in vector_ids[i]))
+    stored = _fetch(collection, missing, keys, where) if missing else {}
+
+    for i, lexical in enumerate(rankings):
+        rows = {id: {key: response[key][i][j] for key in keys} for j, id in enumerate(response['ids'][i])}
+
+        # los ids que no devolvio la coleccion fueron eliminados o no cumplen el filtro
+        lexical = [id for id in lexical if id in rows or id in stored]
+        fused = reciprocal_rank_fusion([response['ids'][i], lexical], k=rrf_k)[:n_results]
+
+        for id in fused:
+            if id not in rows:
+                rows[id] = _row(collection, stored[id], keys, query_embeddings[i])
+
+        for key in keys:
+            result[key].append([rows[id][key] for id in fused])
+
+    for key in ('ids', 'distances', 'metadatas', 'documents', 'embeddings', 'uris', 'data'):
+        result.setdefault(key, None)
+
+    return result
+
+
+def _fetch(collection:chromadb.Collection, ids:list[str], keys:list[str], where:dict=None) -> dict[str, dict]:
+    # documentos, metadata y embeddings (para calcular la distancia) de los ids que cumplen el filtro
+    include = [key for key in ('documents', 'metadatas', 'embeddings') if key in keys]
+    if 'distances' in keys and 'embeddings' not in include:
+        include.append('embeddings')
+
+    stored = collection.get(ids=ids, where=where, include=include)
+
+    return {id: {'ids': id, **{key: stored[key][j] for key in include}} for j, id in enumerate(stored['ids'])}
+
+
+def _row(collection:chromadb.Collection, stored:dict, keys:list[str], query_embedding:list) -> dict:
+    row = {key: stored.get(key) for key in keys}
+
+    if 'distances' in keys:
+        row['distances'] = _distance((collection.metadata or {}).get('hnsw:space', 'l2'), query_embedding, stored['embeddings'])
+
+    return row
+
+
+def _distance(space:str, query:list, vector:list) -> float:
+    """ Distancia con la misma definicion que chroma (ver ```exact_search.distances```). """
+    query, vector = np.asarray(query, dtype=np.float32)[np.newaxis, :], np.asarray(vector, dtype=np.float32)[np.newaxis, :]
+
+    if space == 'cosine':
+        query, vector = normalize(query), normalize(vector)
+
+    return float(distances(space, query, vector)[0, 0])
@@ -2,8 +2,90 @@
 Interfaz para la creacion de datasets.
 """
 
-import uuid
+import os
 import csv
+from typing import Callable, Iterator
+
+from utilities import clave_duplicado, stable_id
+
+
+def _generar_id(collection_name:str, clave_natural:str, pregunta:str) -> str:
+    """
+    Genera un id deterministico a partir del contenido de la fila: la clave natural y la pregunta (o solo la pregunta
+    si la fila no tiene clave natural).
+    
+    El id no depende del orden de las filas: varias filas pueden compartir la clave natural (por ejemplo un mismo
+    evento del CRM con distintas preguntas) y cada una conserva su id aunque el csv se reordene. Como las preguntas
+    duplicadas se omiten, dos filas no generan el mismo id.
+    """
+    if clave_natural:
+        return stable_id(collection_name, clave_natural, pregunta)
+    
+    return stable_id(collection_name, pregunta)
+
+
+def _iter_rows(data_path:str, collection_name:str, parse_line:Callable[[list[str]], tuple[str, str, dict]], normalize:bool=False,
+               duplicados:list=None) -> Iterator[tuple[str, str, dict]]:
+    """
+    Lee el archivo de datos csv linea a linea y devuelve ```(id, pregunta, metadata)``` por cada pregunta no duplicada.
+    ```parse_line``` convierte una linea del csv en ```(clave natural, pregunta, metadata)```.
+    
+    Para omitir duplicados se mantiene el conjunto de preguntas ya vistas, por lo que la memoria es O(preguntas unicas)
+    aunque el archivo se lea en bloques (las preguntas largas se guardan como un hash de 16 bytes, ver
+    ```clave_duplicado```). Las preguntas duplicadas se agregan a ```duplicados``` (si se indica) y al terminar se
+    informa su cantidad.
+    """
+    with open(data_path, 'r', encoding='utf-8') as input_file:
+        csv_reader = csv.reader(input_file, delimiter='|')
+        
+        #omitir el header
+        _ = next(csv_reader)
+        
+        # indice de preguntas ya vistas para detectar duplicados en O(1)
+        vistos = set()
+        cantidad_duplicados = 0
+        
+        for line in csv_reader:
+            clave_natural, pregunta, metadata = parse_line(line)
+            clave = clave_duplicado(pregunta, normalize)
+            
+            #omitir preguntas duplicadas
+            if clave in vistos:
+                cantidad_duplicados += 1
+                if duplicados is not None:
+                    duplicados.append(pregunta)
+                continue
+            
+            vistos.add(clave)
+            
+            #ids deterministicos
+            yield _generar_id(collection_name, clave_natural, pregunta), pregunta, metadata
+        
+        if cantidad_duplicados:
+            print(f'Se han encontrado y filtrado {cantidad_duplicados} elementos duplicados en "{os.path.basename(data_path)}"\n')
+
+
+def _iter_batches(data_path:str, collection_name:str, parse_line:Callable[[list[str]], tuple[str, str, dict]], batch_size:int, normalize:bool=False) -> Iterator[tuple[list, list, list]]:
+    """
+    Lee el archivo de datos csv linea a linea y devuelve bloques ```(documents, metadatas, ids)``` de a lo sumo ```batch_size``` elementos.
+    
+    Se mantiene en memoria el bloque actual y el conjunto de preguntas ya vistas, que crece con la cantidad de
+    preguntas unicas (ver ```_iter_rows```).
+    """
+    documents, metadatas, ids = [], [], []
+    
+    for id, document, metadata in _iter_rows(data_path, collection_name, parse_line, normalize):
+        documents.append(document)
+        metadatas.append(metadata)
+        ids.append(id)
+        
+        if len(ids) == batch_size:
+            yield documents, metadatas, ids
+            documents, metadatas, ids = [], [], []
+    
+    if ids:
+        yield documents, metadatas, ids
+
 
 class ABC:
     """
@@ -12,10 +94,14 @@ class ABC:
     Metodos que incluye la clase:
         - build_data -> Construye el dataset con informacion del archivo de datos csv
         - get_data -> Retorna la informacion del dataset
+        - iter_batches -> Recorre el archivo de datos csv en bloques, sin construir el dataset completo en memoria
+    
+    Con ```normalize=True``` las preguntas que solo difieren en mayusculas, acentos o espacios se consideran duplicadas.
     """
-    def __init__(self, data_path:str='./data/abc.csv', collection_name:str='abc_collection', auto_build:bool=True) -> None:
+    def __init__(self, data_path:str='./data/abc.csv', collection_name:str='abc_collection', auto_build:bool=True, normalize:bool=False) -> None:
         self.data_path = data_path
         self.collection_name = collection_name
+        self.normalize = normalize
         
         if auto_build:
             self.build_data()
@@ -25,36 +111,39 @@ class ABC:
         Extrae la informacion del archivo de datos csv y la almacena dentro los arrays 'preguntas', 'respuestas' y 'ids'
         """
 
-        with open(self.data_path, 'r', encoding='utf-8') as input_file:
-            csv_reader = csv.reader(input_file, delimiter='|')
-            
-            #omitir el header
-            _ = next(csv_reader)    
-
-            self.preguntas = []
-            self.respuestas = []
-            self.ids = []
+        self.preguntas = []
+        self.respuestas = []
+        self.ids = []
+        self.duplicados = []
+        
+        # mismo recorrido (y campos) que iter_batches, ver _parse_line
+        for id, pregunta, metadata in _iter_rows(self.data_path, self.collection_name, self._parse_line, self.normalize, self.duplicados):
+            self.preguntas.append(pregunta)
+            self.respuestas.append(metadata['respuesta'])
+            self.ids.append(id)
 
-            duplicados = 0
-            self.duplicados = []
-            
-            for line in csv_reader:
-                pregunta = line[0]
-                respuesta = line[1]
-                
-                #omitir preguntas duplicadas
-                if pregunta not in self.preguntas:
-                    self.preguntas.append(pregunta)
-                    self.respuestas.append(respuesta)
-                    #ids ficticios
-                    self.ids.append(str(uuid.uuid4()))
-                else:
-                    duplicados += 1
-                    self.duplicados.append(pregunta)
+    def iter_batches(self, batch_size:int=256) -> Iterator[tuple[list, list, list]]:
+        """
+        Devuelve un iterador de bloques ```(documents, metadatas, ids)``` leidos directamente del archivo de datos csv.
+        
+        Los bloques tienen el mismo formato que 'documents', 'metadatas' e 'ids' de ```get_data()```. Para no cargar
+        el dataset completo en memoria, instanciar la clase con ```auto_build=False```:
+        
+        ```python
+        abc = ABC(auto_build=False)
+        for documents, metadatas, ids in abc.iter_batches(batch_size=500):
+            ...
+        ```
+        """
+        return _iter_batches(self.data_path, self.collection_name, self._parse_line, batch_size, self.normalize)
 
-            else:
-                if duplicados:
-                    print(f'\nSe han encontrado y filtrado {duplicados} elementos duplicados en "abc.csv"\n')
+    @staticmethod
+    def _parse_line(line:list[str]) -> tuple[str, str, dict]:
+        pregunta = line[0]
+        respuesta = line[1]
+        
+        # el abc no tiene clave natural: el id se deriva de la pregunta
+        return '', pregunta, {'pregunta':pregunta, 'respuesta':respuesta}
 
     def get_data(self):
         """
@@ -78,7 +167,7 @@ class ABC:
             [{'preguntas': pregunta, 'respuestas': respuesta}, ...]
             ```
         
-        - ids: ids unicos de cada pregunta
+        - ids: ids unicos y deterministicos de cada pregunta
         - count: cantidad de datos que contiene el dataset
         """
         
@@ -98,9 +187,10 @@ class CRM:
     """
     Dataset con la informacion del CRM AFIP
     """
-    def __init__(self, data_path:str='./data/crm.csv', collection_name:str='crm_collection', auto_build:bool=True) -> None:
+    def __init__(self, data_path:str='./data/crm.csv', collection_name:str='crm_collection', auto_build:bool=True, normalize:bool=False) -> None:
         self.data_path = data_path
         self.collection_name = collection_name
+        self.normalize = normalize
 
         if auto_build:
             self.build_data()
@@ -110,45 +200,42 @@ class CRM:
         Extrae la informacion del archivo de datos csv y la almacena dentro los arrays 'preguntas', 'respuestas', 'tipificaciones', 'fechas' y 'ids'
         """
         
-        with open(self.data_path, 'r', encoding='utf-8') as input_file:
-            csv_reader = csv.reader(input_file, delimiter='|')
-            
-            #omitir el header
-            #NRO_EVENTO|TIPIFICACION|PREGUNTA|RESPUESTA
-            _ = next(csv_reader)
-            
-            self.preguntas = []
-            self.respuestas = []
-            self.tipificaciones = []
-            self.eventos = []
+        self.preguntas = []
+        self.respuestas = []
+        self.tipificaciones = []
+        self.eventos = []
+        
+        self.ids = []
+        self.duplicados = []
+        
+        # mismo recorrido (y campos) que iter_batches, ver _parse_line
+        for id, pregunta, metadata in _iter_rows(self.data_path, self.collection_name, self._parse_line, self.normalize, self.duplicados):
+            self.preguntas.append(pregunta)
+            self.respuestas.append(metadata['respuesta'])
+            self.tipificaciones.append(metadata['tipificacion'])
+            self.eventos.append(metadata['evento'])
+            self.ids.append(id)
+                           
+    def iter_batches(self, batch_size:int=256) -> Iterator[tuple[list, list, list]]:
+        """
+        Devuelve un iterador de bloques ```(documents, metadatas, ids)``` leidos directamente del archivo de datos csv.
+        Ver ```ABC.iter_batches```.
+        """
+        return _iter_batches(self.data_path, self.collection_name, self._parse_line, batch_size, self.normalize)
 
-            self.ids = []    
+    @staticmethod
+    def _parse_line(line:list[str]) -> tuple[str, str, dict]:
+        #NRO_EVENTO|TIPIFICACION|PREGUNTA|RESPUESTA
+        evento = line[0]
+        tipificacion = line[1]
+        pregunta = line[2]
+        respuesta = line[3]
+        
+        return evento, pregunta, {'pregunta':pregunta,
+                                  'respuesta':respuesta,
+                                  'tipificacion': tipificacion,
+                                  'evento': evento}
 
-            duplicados = 0
-            self.duplicados = []
-            
-            for line in csv_reader:
-                evento = line[0]
-                tipificacion = line[1]
-                pregunta = line[2]
-                respuesta = line[3]
-                
-                #omitir preguntas duplicadas
-                if pregunta not in self.preguntas:
-                    self.preguntas.append(pregunta)
-                    self.respuestas.append(respuesta)
-                    self.tipificaciones.append(tipificacion)
-                    self.eventos.append(evento)
-                    #ids ficticios
-                    self.ids.append(str(uuid.uuid4()))
-                
-                else:
-                    duplicados += 1
-                    self.duplicados.append(pregunta)
-            else:
-                if duplicados:
-                    print(f'Se han encontrado y filtrado {duplicados} elementos duplicados en "crm.csv"\n')
-                           
     def get_data(self):
         """
         Retorna un diccionario con informacion relacionada al dataset
@@ -173,7 +260,7 @@ class CRM:
             'tipificacion': tipificacion,
             'evento': evento}, ...]
             ```
-        - ids: ids unicos de cada pregunta
+        - ids: ids unicos y deterministicos de cada pregunta
         - count: cantidad de datos que contiene el dataset
         """
         return {
@@ -197,9 +284,10 @@ class MONOTRIBUTO:
     """
     Dataset con la informacion del ABC MONOTRIBUTO AFIP unicamente.
     """
-    def __init__(self, data_path:str='./data/monotributo.csv', collection_name:str='monotributo_collection', auto_build:bool=True) -> None:
+    def __init__(self, data_path:str='./data/monotributo.csv', collection_name:str='monotributo_collection', auto_build:bool=True, normalize:bool=False) -> None:
         self.data_path = data_path
         self.collection_name = collection_name
+        self.normalize = normalize
 
         if auto_build:
             self.build_data()
@@ -209,64 +297,53 @@ class MONOTRIBUTO:
         Extrae la informacion del archivo de datos csv y la almacena dentro los arrays 'preguntas', 'respuestas', 'tipificaciones', 'fechas' y 'ids'
         """
         
-        with open(self.data_path, 'r', encoding='utf-8') as input_file:
-            csv_reader = csv.reader(input_file, delimiter='|')
-            
-            #omitir el header
-            _ = next(csv_reader) 
-
-            
-            #PREGUNTA|CATEGORIA_PRINCIPAL|SUBCATEGORIA1|SUBCATEGORIA2|SUBCATEGORIA3|ID|RESPUESTA
-
-            self.preguntas = []
-            self.categorias_principales = []
-            self.subcategorias_1 = []
-            self.subcategorias_2 = []
-            self.subcategorias_3 = []
-            
-            # el csv actual de monotributo no incluye las respuestas de las preguntas
-            self.respuestas = [] 
-            self.identificadores = []
-            self.eventos = []
-
-            self.ids = []
-
-            duplicados = 0
-            self.duplicados = []
-              
-            
-            for line in csv_reader:
-                # 0                 1               2              3            4        5      6
-                #PREGUNTA|CATEGORIA_PRINCIPAL|SUBCATEGORIA1|SUBCATEGORIA2|SUBCATEGORIA3|ID|RESPUESTA
-
-                pregunta = line[0]
-                categoria_principal = line[1]
-                subcategoria_1 = line[2]
-                subcategoria_2 = line[3]
-                subcategoria_3 = line[4]
-                identificador = line[5]
-                respuesta = line[6]
+        self.preguntas = []
+        self.categorias_principales = []
+        self.subcategorias_1 = []
+        self.subcategorias_2 = []
+        self.subcategorias_3 = []
+        
+        # el csv actual de monotributo no incluye las respuestas de las preguntas
+        self.respuestas = [] 
+        self.identificadores = []
+        self.eventos = []
+        
+        self.ids = []
+        self.duplicados = []
+        
+        # mismo recorrido (y campos) que iter_batches, ver _parse_line
+        for id, pregunta, metadata in _iter_rows(self.data_path, self.collection_name, self._parse_line, self.normalize, self.duplicados):
+            self.preguntas.append(pregunta)
+            self.categorias_principales.append(metadata['categoria_principal'])
+            self.subcategorias_1.append(metadata['subcategoria_1'])
+            self.subcategorias_2.append(metadata['subcategoria_2'])
+            self.subcategorias_3.append(metadata['subcategoria_3'])
+            self.respuestas.append(metadata['respuesta'])
+            self.identificadores.append(metadata['identificador'])
+            self.ids.append(id)
+                           
+    def iter_batches(self, batch_size:int=256) -> Iterator[tuple[list, list, list]]:
+        """
+        Devuelve un iterador de bloques ```(documents, metadatas, ids)``` leidos directamente del archivo de datos csv.
+        Ver ```ABC.iter_batches```.
+        """
+        return _iter_batches(self.data_path, self.collection_name, self._parse_line, batch_size, self.normalize)
 
-                #omitir preguntas duplicadas
-                if pregunta not in self.preguntas:
-                
-                    self.preguntas.append(pregunta)
-                    self.categorias_principales.append(categoria_principal)
-                    self.subcategorias_1.append(subcategoria_1)
-                    self.subcategorias_2.append(subcategoria_2)
-                    self.subcategorias_3.append(subcategoria_3)
-                    self.respuestas.append(respuesta)
-                    self.identificadores.append(identificador)
-                    #ids ficticios
-                    self.ids.append(str(uuid.uuid4()))
-                else:
-                    duplicados += 1
-                    self.duplicados.append(pregunta)
+    @staticmethod
+    def _parse_line(line:list[str]) -> tuple[str, str, dict]:
+        #PREGUNTA|CATEGORIA_PRINCIPAL|SUBCATEGORIA1|SUBCATEGORIA2|SUBCATEGORIA3|ID|RESPUESTA
+        pregunta = line[0]
+        
+        identificador = line[5]
+        
+        return identificador, pregunta, {'pregunta':pregunta,
+                                         'respuesta':line[6],
+                                         'identificador': identificador,
+                                         'categoria_principal': line[1],
+                                         'subcategoria_1': line[2],
+                                         'subcategoria_2': line[3],
+                                         'subcategoria_3': line[4]}
 
-            else:
-                if duplicados:
-                    print(f'Se han encontrado y filtrado {duplicados} elementos duplicados en "monotributo.csv"\n')
-                           
     def get_data(self):
         """
         Retorna un diccionario con informacion relacionada al dataset
@@ -294,7 +371,7 @@ class MONOTRIBUTO:
             'subcategoria_2': subcategoria_2,
             'subcategoria_3': subcategoria_3, ...]
             ```
-        - ids: ids unicos de cada pregunta
+        - ids: ids unicos y deterministicos de cada pregunta
         - count: cantidad de datos que contiene el dataset
         """
 
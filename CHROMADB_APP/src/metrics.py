@@ -0,0 +1,247 @@
+"""
+Instrumentacion liviana: histogramas y contadores en memoria, exportables en formato de texto de Prometheus.
+
+Las operaciones del camino caliente (embeddings, consultas, escrituras y pedidos HTTP) se miden con ```track```:
+
+```python
+with track('query', collection='abc_collection', batch_size=1) as op:
+    response = collection.query(...)
+    op.results = len(response['ids'][0])
+```
+
+Se registra la latencia, el tamaño del lote, la cantidad de resultados y los errores de cada operacion. Los valores se
+exponen con ```render()``` (ver el endpoint /metrics de la API) y, opcionalmente, cada operacion se escribe como una
+linea JSON en el logger 'chromadb_app.metrics' (ver ```configure_logging```).
+
+Las metricas son por proceso: con varios workers cada uno expone las suyas.
+"""
+
+import os
+import sys
+import json
+import time
+import bisect
+import logging
+import threading
+from contextlib import contextmanager
+
+
+logger = logging.getLogger('chromadb_app')
+events_logger = logging.getLogger('chromadb_app.metrics')
+
+# los eventos JSON solo se escriben si se habilitan explicitamente (ver configure_logging)
+events_logger.setLevel(logging.WARNING)
+
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+SIZE_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000)
+
+
+class Counter:
+    """ Contador monotono, con etiquetas. """
+
+    type = 'counter'
+
+    def __init__(self, name:str, help:str, labelnames:tuple[str, ...]=()) -> None:
+        self.name = name
+        self.help = help
+        self.labelnames = labelnames
+
+        self._values:dict[tuple, float] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount:float=1, **labels) -> None:
+        key = tuple(str(labels.get(label, '')) for label in self.labelnames)
+
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels) -> float:
+        return self._values.get(tuple(str(labels.get(label, '')) for label in self.labelnames), 0)
+
+    def samples(self) -> list[str]:
+        with self._lock:
+            return [f'{self.name}{_labels(self.labelnames, key)} {_number(value)}' for key, value in self._values.items()]
+
+
+class Histogram:
+    """ Histograma de buckets acumulados, con etiquetas (mismo modelo que los histogramas de Prometheus). """
+
+    type = 'histogram'
+
+    def __init__(self, name:str, help:str, labelnames:tuple[str, ...]=(), buckets:tuple[float, ...]=LATENCY_BUCKETS) -> None:
+        self.name = name
+        self.help = help
+        self.labelnames = labelnames
+        self.buckets = tuple(sorted(buckets))
+
+        # etiquetas -> [conteo por bucket (no acumulado, el ultimo es +Inf), suma, cantidad]
+        self._values:dict[tuple, list] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value:float, **labels) -> None:
+        key = tuple(str(labels.get(label, '')) for label in self.labelnames)
+        index = bisect.bisect_left(self.buckets, value)
+
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                entry = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+
+            entry[0][index] += 1
+            entry[1] += value
+            entry[2] += 1
+
+    def count(self, **labels) -> int:
+        entry = self._values.get(tuple(str(labels.get(label, '')) for label in self.labelnames))
+        return entry[2] if entry else 0
+
+    def samples(self) -> list[str]:
+        lines = []
+
+        with self._lock:
+            for key, (counts, total, count) in self._values.items():
+                cumulative = 0
+                for bound, bucket_count in zip((*self.buckets, '+Inf'), counts):
+                    cumulative += bucket_count
+                    le = bound if bound == '+Inf' else _number(bound)
+                    lines.append(f'{self.name}_bucket{_labels((*self.labelnames, "le"), (*key, le))} {cumulative}')
+
+                lines.append(f'{self.name}_sum{_labels(self.labelnames, key)} {_number(total)}')
+                lines.append(f'{self.name}_count{_labels(self.labelnames, key)} {count}')
+
+        return lines
+
+
+class MetricsRegistry:
+    """ Conjunto de metricas del proceso. """
+
+    def __init__(self) -> None:
+        self._metrics:dict[str, Counter | Histogram] = {}
+        self._lock = threading.Lock()
+
+    def counter(self, name:str, help:str, labelnames:tuple[str, ...]=()) -> Counter:
+        return self._register(Counter(name, help, labelnames))
+
+    def histogram(self, name:str, help:str, labelnames:tuple[str, ...]=(), buckets:tuple[float, ...]=LATENCY_BUCKETS) -> Histogram:
+        return self._register(Histogram(name, help, labelnames, buckets))
+
+    def render(self) -> str:
+        """ Todas las metricas en formato de texto de Prometheus (version 0.0.4). """
+        lines = []
+
+        for metric in list(self._metrics.values()):
+            lines.append(f'# HELP {metric.name} {metric.help}')
+            lines.append(f'# TYPE {metric.name} {metric.type}')
+            lines.extend(metric.samples())
+
+        return '\n'.join(lines) + '\n'
+
+    def _register(self, metric):
+        with self._lock:
+            return self._metrics.setdefault(metric.name, metric)
+
+
+REGISTRY = MetricsRegistry()
+
+OPERATION_SECONDS = REGISTRY.histogram('chromadb_app_operation_seconds', 'Latencia de las operaciones (embed, query, add, update, delete)', ('operation', 'collection'))
+OPERATION_ERRORS = REGISTRY.counter('chromadb_app_operation_errors_total', 'Operaciones que terminaron con error', ('operation', 'collection'))
+BATCH_SIZE = REGISTRY.histogram('chromadb_app_batch_size', 'Elementos por llamado (textos embebidos, consultas, documentos escritos)', ('operation',), SIZE_BUCKETS)
+QUERY_RESULTS = REGISTRY.histogram('chromadb_app_query_results', 'Resultados devueltos por consulta', ('collection',), SIZE_BUCKETS)
+EMBEDDING_CACHE = REGISTRY.counter('chromadb_app_embedding_cache_total', 'Textos resueltos por el cache de embeddings', ('result',))
+QUERY_CACHE = REGISTRY.counter('chromadb_app_query_cache_total', 'Consultas resueltas por el cache de consultas', ('collection', 'result'))
+EXACT_MATCH = REGISTRY.counter('chromadb_app_exact_match_total', 'Consultas resueltas por el indice de preguntas exactas', ('collection', 'result'))
+FILTERED_QUERIES = REGISTRY.counter('chromadb_app_filtered_queries_total', 'Consultas con filtro de categoria, por estrategia (ann o brute_force)', ('collection', 'plan'))
+HTTP_SECONDS = REGISTRY.histogram('chromadb_app_http_request_seconds', 'Latencia de los pedidos HTTP de la API', ('endpoint', 'method', 'status'))
+HTTP_REQUESTS = REGISTRY.counter('chromadb_app_http_requests_total', 'Pedidos HTTP atendidos por la API', ('endpoint', 'method', 'status'))
+
+
+class _Operation:
+    """ Datos de una operacion en curso. ```results``` se completa dentro del bloque ```track```. """
+
+    __slots__ = ('results',)
+
+    def __init__(self) -> None:
+        self.results = None
+
+
+@contextmanager
+def track(operation:str, collection:str='', batch_size:int=None):
+    """
+    Mide una operacion: latencia, tamaño del lote, resultados (```op.results```) y errores. Las excepciones se
+    cuentan y se vuelven a lanzar.
+    """
+    op = _Operation()
+    error = None
+    t_i = time.perf_counter()
+
+    try:
+        yield op
+
+    except BaseException as e:
+        error = e
+        OPERATION_ERRORS.inc(operation=operation, collection=collection)
+        raise
+
+    finally:
+        seconds = time.perf_counter() - t_i
+        OPERATION_SECONDS.observe(seconds, operation=operation, collection=collection)
+
+        if batch_size is not None:
+            BATCH_SIZE.observe(batch_size, operation=operation)
+
+        if op.results is not None:
+            QUERY_RESULTS.observe(op.results, collection=collection)
+
+        if events_logger.isEnabledFor(logging.INFO):
+            log_event(operation, collection=collection, seconds=round(seconds, 6), batch_size=batch_size, results=op.results,
+                      error=repr(error) if error else None)
+
+
+def log_event(event:str, **fields) -> None:
+    """ Escribe un evento como una linea JSON en el logger de metricas (si esta habilitado). """
+    if events_logger.isEnabledFor(logging.INFO):
+        events_logger.info(json.dumps({'ts': round(time.time(), 6), 'event': event, **{k: v for k, v in fields.items() if v is not None}}, default=str))
+
+
+def render() -> str:
+    return REGISTRY.render()
+
+
+def configure_logging(level:str=None, structured:bool=None) -> None:
+    """
+    Configura los logs de la aplicacion. Por defecto toma los valores de las variables de entorno:
+
+    - LOG_LEVEL: nivel de los logs de 'chromadb_app' (DEBUG, INFO, WARNING, ERROR). Por defecto WARNING.
+    - METRICS_LOG: si es 1, cada operacion medida se escribe como una linea JSON (logger 'chromadb_app.metrics').
+    """
+    level = (level or os.environ.get('LOG_LEVEL', 'WARNING')).upper()
+    structured = structured if structured is not None else os.environ.get('METRICS_LOG', '0') == '1'
+
+    if not logger.handlers:
+        handler = logging.StreamHandler(sys.stderr)
+        handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s %(name)s [%(process)d] %(message)s'))
+        logger.addHandler(handler)
+        logger.propagate = False
+
+    logger.setLevel(level)
+
+    # el logger de eventos escribe solo el JSON, en su propio handler
+    events_logger.propagate = False
+    events_logger.setLevel(logging.INFO if structured else logging.WARNING)
+
+    if structured and not events_logger.handlers:
+        handler = logging.StreamHandler(sys.stderr)
+        handler.setFormatter(logging.Formatter('%(message)s'))
+        events_logger.addHandler(handler)
+
+
+def _labels(names:tuple[str, ...], values:tuple) -> str:
+    if not names:
+        return ''
+
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for value in values)
+    return '{' + ','.join(f'{name}="{value}"' for name, value in zip(names, escaped)) + '}'
+
+
+def _number(value:float) -> str:
+    return repr(float(value)) if isinstance(value, float) else str(value)
@@ -0,0 +1,310 @@
+"""
+Almacen lateral de embeddings comprimidos (float16 o int8) para busquedas de primera pasada.
+
+Los vectores comprimidos se mantienen en memoria y se recorren por fuerza bruta para obtener candidatos. Los mejores
+candidatos se reordenan con la distancia exacta en float32, leyendo solo esas filas de un archivo en disco
+(```np.memmap```). Los vectores comprimidos ocupan 1/2 (float16) o 1/4 (int8) del tamaño de los originales.
+
+El almacen es solo un nivel adicional de busqueda y reordenamiento: el indice HNSW de chroma sigue en memoria sin
+cambios y las consultas de la coleccion lo siguen cargando. No reduce la memoria del proceso sino que la aumenta en los
+vectores comprimidos y la lista de ids (ver ```memory```). Su ventaja es una busqueda exacta de primera pasada sobre una
+matriz mas chica que la float32.
+
+El almacen es una copia de la coleccion al momento de construirlo. ```store.json``` registra la cantidad de documentos
+de la coleccion; un almacen marcado como desactualizado (```mark_stale```) o cuya cantidad no coincide con la de la
+coleccion se debe volver a construir (ver ```Database.get_quantized_store```).
+"""
+
+import os
+import sys
+import json
+
+import numpy as np
+import chromadb
+
+from utilities import recall_at_k
+from exact_search import normalize, distances, top_k
+from index_profiles import DEFAULT_PARAMS, estimate_index_memory
+
+
+DTYPES = ('float16', 'int8')
+METRICS = ('l2', 'cosine', 'ip')
+
+# parametro M por defecto del indice HNSW de chroma
+HNSW_M = DEFAULT_PARAMS['hnsw:M']
+
+
+def mark_stale(path:str) -> None:
+    """ Marca como desactualizado el almacen guardado en ```path``` (si existe). Se debe llamar luego de escribir en la coleccion. """
+    info_path = os.path.join(path, 'store.json')
+
+    if not os.path.isfile(info_path):
+        return
+
+    with open(info_path, encoding='utf-8') as f:
+        info = json.load(f)
+
+    info['stale'] = True
+
+    with open(info_path, 'w', encoding='utf-8') as f:
+        json.dump(info, f)
+
+
+class QuantizedStore:
+    """
+    Indice de fuerza bruta sobre vectores comprimidos, con reordenamiento exacto en float32.
+
+    ```python
+    store = QuantizedStore.from_collection(collection, dtype='int8', path='./database/quantized/abc_collection')
+    ids, distances = store.search(query_embeddings, n_results=5, oversample=4)
+    store.recall_at_k(query_embeddings, k=10)
+    # {'k': 10, 'recall_first_pass': 0.93, 'recall_reranked': 0.998, 'total_bytes': ..., ...}
+    ```
+
+    - dtype: 'float16' o 'int8' (cuantizacion escalar con minimo y escala por dimension).
+    - metric: distancia de la coleccion ('l2', 'cosine' o 'ip'), la misma que ```hnsw:space```.
+    - path: carpeta donde se guardan los vectores. Si es None los vectores float32 se mantienen en memoria.
+    """
+
+    def __init__(self, dtype:str='int8', metric:str='l2', path:str=None) -> None:
+        if dtype not in DTYPES:
+            raise ValueError(f'dtype debe ser uno de {DTYPES}')
+
+        if metric not in METRICS:
+            raise ValueError(f'metric debe ser uno de {METRICS}')
+
+        self.dtype = dtype
+        self.metric = metric
+        self.path = path
+
+        self.ids:list[str] = []
+        self.codes:np.ndarray = None
+        self.vectors:np.ndarray = None
+
+        # parametro M del indice HNSW de la coleccion (para estimar su memoria) y estado del almacen guardado
+        self.hnsw_m = HNSW_M
+        self.stale = False
+
+        # parametros de la cuantizacion int8: x ~ (code + 128) * scale + offset
+        self.scale:np.ndarray = None
+        self.offset:np.ndarray = None
+
+    @classmethod
+    def from_collection(cls, collection:chromadb.Collection, dtype:str='int8', path:str=None, page_size:int=1000) -> 'QuantizedStore':
+        """ Construye el almacen a partir de los embeddings de una coleccion, leidos en paginas de ```page_size```. """
+        metric = (collection.metadata or {}).get('hnsw:space', 'l2')
+        store = cls(dtype=dtype, metric=metric, path=path)
+        store.hnsw_m = (collection.metadata or {}).get('hnsw:M', HNSW_M)
+
+        ids, vectors = [], []
+        offset = 0
+
+        while True:
+            page = collection.get(include=['embeddings'], limit=page_size, offset=offset)
+
+            if not page['ids']:
+                break
+
+            ids.extend(page['ids'])
+            vectors.append(np.asarray(page['embeddings'], dtype=np.float32))
+            offset += len(page['ids'])
+
+        store.build(ids, np.concatenate(vectors) if vectors else np.zeros((0, 0), dtype=np.float32))
+
+        return store
+
+    def build(self, ids:list[str], vectors:np.ndarray) -> None:
+        """ Comprime los vectores y, si hay ```path```, guarda todo en disco. """
+        vectors = np.asarray(vectors, dtype=np.float32)
+
+        if self.metric == 'cosine':
+            vectors = normalize(vectors)
+
+        self.ids = list(ids)
+        self.codes = self._quantize(vectors)
+        self.vectors = vectors
+
+        if self.path:
+            self.save()
+
+    def search(self, query_embeddings, n_results:int=5, oversample:int=4, rerank:bool=True) -> tuple[list[list[str]], list[list[float]]]:
+        """
+        Devuelve ```(ids, distances)``` de los ```n_results``` vecinos de cada consulta.
+
+        La primera pasada sobre los vectores comprimidos obtiene ```n_results * oversample``` candidatos, que se
+        reordenan con la distancia exacta. Con ```rerank=False``` se devuelve directamente la primera pasada.
+        """
+        queries = self._prepare(query_embeddings)
+
+        if not self.ids:
+            return [[] for _ in queries], [[] for _ in queries]
+
+        k = min(n_results, len(self.ids))
+        candidates = min(max(k * oversample, k), len(self.ids)) if rerank else k
+
+        first_pass = self._first_pass(queries, candidates)
+
+        ids, result = [], []
+
+        for query, indices in zip(queries, first_pass):
+            if rerank:
+                # las filas del memmap se leen en orden para acceder al disco de manera secuencial
+                indices = np.sort(indices)
+                exact = distances(self.metric, query[np.newaxis, :], np.asarray(self.vectors[indices]))[0]
+            else:
+                exact = distances(self.metric, query[np.newaxis, :], self._dequantize(self.codes[indices]))[0]
+
+            order = np.argsort(exact)[:k]
+            ids.append([self.ids[i] for i in indices[order]])
+            result.append(exact[order].tolist())
+
+        return ids, result
+
+    def exact_search(self, query_embeddings, n_results:int=5) -> tuple[list[list[str]], list[list[float]]]:
+        """ Busqueda exacta sobre los vectores float32 (linea base sin compresion). """
+        top, top_distances = top_k(distances(self.metric, self._prepare(query_embeddings), np.asarray(self.vectors)), n_results)
+
+        return [[self.ids[i] for i in row] for row in top], top_distances.tolist()
+
+    def recall_at_k(self, query_embeddings, k:int=10, oversample:int=4) -> dict:
+        """
+        Compara la busqueda sobre vectores comprimidos contra la busqueda exacta en float32.
+
+        Devuelve el recall@k de la primera pasada, el recall@k luego del reordenamiento y el uso de memoria.
+        """
+        exact, _ = self.exact_search(query_embeddings, n_results=k)
+        first_pass, _ = self.search(query_embeddings, n_results=k, rerank=False)
+        reranked, _ = self.search(query_embeddings, n_results=k, oversample=oversample)
+
+        return {
+            'k': k,
+            'oversample': oversample,
+            'queries': len(exact),
+            'recall_first_pass': recall_at_k(exact, first_pass),
+            'recall_reranked': recall_at_k(exact, reranked),
+            **self.memory(),
+        }
+
+    def memory(self) -> dict:
+        """
+        Bytes en memoria de la coleccion con el almacen.
+
+        - hnsw_bytes: estimacion del indice HNSW de chroma (ver ```index_profiles.estimate_index_memory```), que no cambia con el almacen
+        - quantized_bytes: vectores comprimidos
+        - ids_bytes: lista de ids del almacen
+        - float32_bytes: vectores float32 en memoria (0 si se leen de disco)
+        - store_bytes: memoria agregada por el almacen; total_bytes: HNSW mas el almacen
+        """
+        quantized_bytes = self.codes.nbytes if self.codes is not None else 0
+        ids_bytes = sys.getsizeof(self.ids) + sum(sys.getsizeof(id) for id in self.ids)
+        float32_bytes = self.vectors.nbytes if isinstance(self.vectors, np.ndarray) and not isinstance(self.vectors, np.memmap) else 0
+        store_bytes = quantized_bytes + ids_bytes + float32_bytes
+        index_bytes = estimate_index_memory(len(self.ids), self.dim, self.hnsw_m)
+
+        return {
+            'dtype': self.dtype,
+            'count': len(self.ids),
+            'hnsw_bytes': index_bytes,
+            'quantized_bytes': quantized_bytes,
+            'ids_bytes': ids_bytes,
+            'float32_bytes': float32_bytes,
+            'store_bytes': store_bytes,
+            'total_bytes': index_bytes + store_bytes,
+        }
+
+    @property
+    def dim(self) -> int:
+        return self.codes.shape[1] if self.codes is not None and self.codes.ndim == 2 else 0
+
+    def save(self) -> None:
+        os.makedirs(self.path, exist_ok=True)
+
+        np.save(os.path.join(self.path, 'vectors.npy'), np.asarray(self.vectors))
+        np.save(os.path.join(self.path, 'codes.npy'), self.codes)
+
+        if self.dtype == 'int8':
+            np.save(os.path.join(self.path, 'scale.npy'), self.scale)
+            np.save(os.path.join(self.path, 'offset.npy'), self.offset)
+
+        with open(os.path.join(self.path, 'store.json'), 'w', encoding='utf-8') as f:
+            json.dump({'dtype': self.dtype, 'metric': self.metric, 'hnsw_m': self.hnsw_m, 'count': len(self.ids), 'stale': False, 'ids': self.ids}, f)
+
+        # los vectores float32 solo se leen de disco al reordenar
+        self.vectors = np.load(os.path.join(self.path, 'vectors.npy'), mmap_mode='r')
+
+    @classmethod
+    def load(cls, path:str) -> 'QuantizedStore':
+        """ Carga un almacen guardado con ```save```. Los vectores float32 quedan en disco (memmap). """
+        with open(os.path.join(path, 'store.json'), encoding='utf-8') as f:
+            info = json.load(f)
+
+        store = cls(dtype=info['dtype'], metric=info['metric'], path=path)
+        store.hnsw_m = info.get('hnsw_m', HNSW_M)
+        # los almacenes guardados sin 'count' son anteriores al control de version: se consideran desactualizados
+        store.stale = info.get('stale', 'count' not in info)
+        store.ids = info['ids']
+        store.codes = np.load(os.path.join(path, 'codes.npy'))
+        store.vectors = np.load(os.path.join(path, 'vectors.npy'), mmap_mode='r')
+
+        if store.dtype == 'int8':
+            store.scale = np.load(os.path.join(path, 'scale.npy'))
+            store.offset = np.load(os.path.join(path, 'offset.npy'))
+
+        return store
+
+    def is_current(self, collection:chromadb.Collection) -> bool:
+        """
+        Devuelve False si el almacen fue marcado como desactualizado o si la cantidad de documentos de la coleccion
+        cambio desde que se construyo. Las modificaciones de documentos que no cambian la cantidad solo se detectan si
+        se realizaron a traves de ```Database``` (que marca el almacen con ```mark_stale```).
+        """
+        return not self.stale and collection.count() == len(self.ids)
+
+    def _prepare(self, query_embeddings) -> np.ndarray:
+        queries = np.atleast_2d(np.asarray(query_embeddings, dtype=np.float32))
+        return normalize(queries) if self.metric == 'cosine' else queries
+
+    def _quantize(self, vectors:np.ndarray) -> np.ndarray:
+        if self.dtype == 'float16':
+            return vectors.astype(np.float16)
+
+        # coleccion vacia: no hay minimos ni maximos por dimension
+        if not len(vectors):
+            self.offset = np.zeros(vectors.shape[1], dtype=np.float32)
+            self.scale = np.ones(vectors.shape[1], dtype=np.float32)
+            return np.zeros(vectors.shape, dtype=np.int8)
+
+        low, high = vectors.min(axis=0), vectors.max(axis=0)
+        self.offset = low
+        self.scale = np.where(high > low, (high - low) / 255, 1.0).astype(np.float32)
+
+        return (np.rint((vectors - self.offset) / self.scale) - 128).astype(np.int8)
+
+    def _dequantize(self, codes:np.ndarray) -> np.ndarray:
+        if self.dtype == 'float16':
+            return codes.astype(np.float32)
+
+        return (codes.astype(np.float32) + 128) * self.scale + self.offset
+
+    def _first_pass(self, queries:np.ndarray, candidates:int, chunk_size:int=65_536) -> np.ndarray:
+        # los vectores se descomprimen por bloques y de cada bloque solo se conservan los mejores candidatos: la memoria
+        # es (consultas x (candidatos + chunk_size)) y no (consultas x N)
+        if candidates >= len(self.ids):
+            return np.tile(np.arange(len(self.ids)), (len(queries), 1))
+
+        best = np.empty((len(queries), 0), dtype=np.int64)
+        best_distances = np.empty((len(queries), 0), dtype=np.float32)
+
+        for start in range(0, len(self.ids), chunk_size):
+            chunk = self._dequantize(self.codes[start:start + chunk_size])
+
+            merged = np.concatenate([best_distances, distances(self.metric, queries, chunk)], axis=1)
+            indices = np.concatenate([best, np.broadcast_to(np.arange(start, start + len(chunk)), (len(queries), len(chunk)))], axis=1)
+
+            if merged.shape[1] > candidates:
+                top = np.argpartition(merged, candidates - 1, axis=1)[:, :candidates]
+                merged, indices = np.take_along_axis(merged, top, axis=1), np.take_along_axis(indices, top, axis=1)
+
+            best, best_distances = indices, merged
+
+        return best
@@ -0,0 +1,140 @@
+"""
+Cache de resultados de consultas a colecciones de chroma.
+
+Las entradas se indexan por ```(coleccion, pregunta normalizada, n_results, include, where)```, tienen un tiempo de vida (TTL)
+y la cantidad maxima de entradas es acotada (se descartan las menos usadas recientemente). Las consultas por lotes
+(```query_text``` como lista de preguntas) se indexan por la tupla de preguntas normalizadas.
+
+Cada coleccion tiene un numero de version. Toda escritura a la coleccion (ver ```Client.insert_data```,
+```Client.update_data``` y ```Client.delete_data```) debe llamar a ```invalidate(collection_name)```, lo que
+incrementa la version y descarta todos los resultados cacheados de esa coleccion.
+
+La version se toma antes de consultar y se pasa a ```set```: si la coleccion se modifico mientras se realizaba la
+consulta, el resultado (que puede ser anterior a la escritura) no se guarda.
+
+```python
+version = cache.version('abc_collection')
+response = cache.get('abc_collection', pregunta, 5, include)
+
+if response is None:
+    response = collection.query(...)
+    cache.set('abc_collection', pregunta, 5, include, response, version)
+```
+"""
+
+import copy
+import json
+import time
+import threading
+from collections import OrderedDict, defaultdict
+
+from utilities import normalizar_texto
+
+
+class QueryCache:
+    """
+    Cache LRU con TTL de resultados de ```collection.query()```.
+
+    ```python
+    cache = QueryCache(max_items=2048, ttl=600)
+    client = Client(query_cache=cache)
+    ...
+    cache.stats()
+    # {'hits': 812, 'misses': 190, 'invalidations': 3, 'items': 190, 'hit_rate': 0.81}
+    ```
+    """
+
+    def __init__(self, max_items:int=1024, ttl:float=300) -> None:
+        self.max_items = max_items
+        self.ttl = ttl
+
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+        self._entries = OrderedDict()
+        self._versions = defaultdict(int)
+        self._lock = threading.Lock()
+
+    def version(self, collection_name:str) -> int:
+        """ Version actual de la coleccion. Se debe tomar antes de realizar la consulta que luego se guarda con ```set```. """
+        with self._lock:
+            return self._versions[collection_name]
+
+    def get(self, collection_name:str, query_text:str|list[str], n_results:int, include:list[str], where:dict=None):
+        """
+        Devuelve una copia del resultado cacheado de la consulta, o None si no existe, expiro o la coleccion fue
+        modificada.
+        """
+        key = self._key(collection_name, query_text, n_results, include, where)
+
+        with self._lock:
+            entry = self._entries.get(key)
+
+            if entry:
+                version, expires, result = entry
+
+                if version == self._versions[collection_name] and expires > time.monotonic():
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+
+                    # copia: modificar la respuesta no altera la entrada cacheada
+                    return copy.deepcopy(result)
+
+                del self._entries[key]
+
+            self.misses += 1
+            return None
+
+    def set(self, collection_name:str, query_text:str|list[str], n_results:int, include:list[str], result, version:int, where:dict=None) -> None:
+        """
+        Almacena (una copia de) el resultado de una consulta. ```version``` es la version de la coleccion tomada antes
+        de consultar (ver ```version```): si la coleccion se modifico desde entonces, el resultado se descarta.
+        """
+        key = self._key(collection_name, query_text, n_results, include, where)
+        result = copy.deepcopy(result)
+
+        with self._lock:
+            if version != self._versions[collection_name]:
+                return
+
+            self._entries[key] = (version, time.monotonic() + self.ttl, result)
+            self._entries.move_to_end(key)
+
+            while len(self._entries) > self.max_items:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, collection_name:str) -> None:
+        """ Descarta los resultados cacheados de una coleccion. Se debe llamar luego de cada escritura. """
+        with self._lock:
+            self._versions[collection_name] += 1
+            self.invalidations += 1
+
+            for key in [key for key in self._entries if key[0] == collection_name]:
+                del self._entries[key]
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> dict:
+        """ Devuelve los contadores de aciertos y fallos del cache. """
+        total = self.hits + self.misses
+
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'invalidations': self.invalidations,
+            'items': len(self._entries),
+            'max_items': self.max_items,
+            'hit_rate': self.hits / total if total else 0.0,
+        }
+
+    @staticmethod
+    def _key(collection_name:str, query_text:str|list[str], n_results:int, include:list[str], where:dict=None) -> tuple:
+        if isinstance(query_text, str):
+            query_key = normalizar_texto(query_text)
+        else:
+            query_key = tuple(normalizar_texto(text) for text in query_text)
+
+        return collection_name, query_key, n_results, tuple(sorted(include)), json.dumps(where, sort_keys=True) if where else None
@@ -0,0 +1,156 @@
+"""
+Snapshots de colecciones: exportacion e importacion en un formato binario columnar.
+
+Reconstruir una coleccion con ```build_collection``` implica volver a leer el csv y calcular todos los embeddings. Un
+snapshot guarda los embeddings ya calculados, de modo que restaurar la coleccion (en otro nodo o en CI) solo copia
+los datos y no requiere el modelo de embeddings.
+
+Un snapshot es un directorio con:
+
+- ```embeddings.npy```: matriz float32 ```(documentos, dimension)```.
+- ```records.parquet```: ids, documentos y metadata (JSON), en el mismo orden que los embeddings.
+- ```manifest.json```: nombre y metadata de la coleccion (parametros del indice HNSW), cantidad de documentos,
+  dimension y modelo de embeddings.
+
+```python
+export_collection(collection, 'snapshots/abc_collection', model_name='all-MiniLM-L6-v2')
+import_collection(client.create_collection('abc_collection'), 'snapshots/abc_collection')
+```
+"""
+
+import os
+import json
+
+import numpy as np
+import chromadb
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+
+FORMAT_VERSION = 1
+
+MANIFEST = 'manifest.json'
+EMBEDDINGS = 'embeddings.npy'
+RECORDS = 'records.parquet'
+
+SCHEMA = pa.schema([('id', pa.string()), ('document', pa.string()), ('metadata', pa.string())])
+
+
+def read_manifest(path:str) -> dict:
+    """ Devuelve el manifiesto del snapshot ```path```. """
+    with open(os.path.join(path, MANIFEST), encoding='utf-8') as file:
+        manifest = json.load(file)
+
+    if manifest.get('format_version') != FORMAT_VERSION:
+        raise ValueError(f'Version de snapshot no soportada: {manifest.get("format_version")}')
+
+    return manifest
+
+
+def export_collection(collection:chromadb.Collection, path:str, page_size:int=1000, model_name:str=None, progress=None) -> dict:
+    """
+    Exporta la coleccion al directorio ```path``` (se crea si no existe) y devuelve el manifiesto.
+
+    La coleccion se lee en paginas de ```page_size```: cada pagina se escribe en la matriz de embeddings (mapeada en
+    disco) y como un bloque del archivo parquet, por lo que la memoria no depende del tamaño de la coleccion.
+
+    - model_name: modelo con el que se calcularon los embeddings (se guarda en el manifiesto).
+    - progress: funcion ```progress(actual, total)``` llamada luego de cada pagina (ver ```utilities.progress_bar```).
+    """
+    os.makedirs(path, exist_ok=True)
+
+    total = collection.count()
+    embeddings = None
+    offset = 0
+
+    with pq.ParquetWriter(os.path.join(path, RECORDS), SCHEMA, compression='zstd') as writer:
+        while True:
+            page = collection.get(include=['embeddings', 'documents', 'metadatas'], limit=page_size, offset=offset)
+
+            if not page['ids']:
+                break
+
+            if offset + len(page['ids']) > total:
+                raise RuntimeError('La coleccion fue modificada durante la exportacion')
+
+            vectors = np.asarray(page['embeddings'], dtype=np.float32)
+
+            if embeddings is None:
+                embeddings = np.lib.format.open_memmap(os.path.join(path, EMBEDDINGS), mode='w+', dtype=np.float32, shape=(total, vectors.shape[1]))
+
+            embeddings[offset:offset + len(vectors)] = vectors
+
+            writer.write_table(pa.table({
+                'id': page['ids'],
+                'document': page['documents'],
+                'metadata': [json.dumps(metadata, ensure_ascii=False) if metadata is not None else None for metadata in page['metadatas']],
+            }, schema=SCHEMA))
+
+            offset += len(page['ids'])
+
+            if progress:
+                progress(offset, total)
+
+    if embeddings is None:
+        np.save(os.path.join(path, EMBEDDINGS), np.zeros((0, 0), dtype=np.float32))
+    else:
+        embeddings.flush()
+        del embeddings
+
+    manifest = {
+        'format_version': FORMAT_VERSION,
+        'collection_name': collection.name,
+        'metadata': collection.metadata,
+        'count': offset,
+        'dim': int(vectors.shape[1]) if offset else 0,
+        'model_name': model_name,
+    }
+
+    with open(os.path.join(path, MANIFEST), 'w', encoding='utf-8') as file:
+        json.dump(manifest, file, ensure_ascii=False, indent=4)
+
+    return manifest
+
+
+def import_collection(collection:chromadb.Collection, path:str, batch_size:int=1000, progress=None) -> int:
+    """
+    Agrega a ```collection``` los documentos del snapshot ```path``` con sus embeddings precalculados (no se llama a
+    la funcion de embeddings). Devuelve la cantidad de documentos agregados.
+
+    Los registros se leen en bloques de ```batch_size``` y los embeddings se leen del archivo mapeado en memoria.
+
+    - progress: funcion ```progress(actual, total)``` llamada luego de cada bloque.
+    """
+    manifest = read_manifest(path)
+    total = manifest['count']
+
+    if not total:
+        return 0
+
+    embeddings = np.load(os.path.join(path, EMBEDDINGS), mmap_mode='r')
+
+    if embeddings.shape[0] < total or embeddings.shape[1] != manifest['dim']:
+        raise ValueError(f'Los embeddings del snapshot no coinciden con el manifiesto: {embeddings.shape}')
+
+    offset = 0
+
+    for batch in pq.ParquetFile(os.path.join(path, RECORDS)).iter_batches(batch_size=batch_size):
+        records = batch.to_pydict()
+        metadatas = [json.loads(metadata) if metadata is not None else None for metadata in records['metadata']]
+
+        collection.add(
+            ids= records['id'],
+            embeddings= embeddings[offset:offset + len(records['id'])].tolist(),
+            documents= records['document'],
+            metadatas= metadatas if any(metadata is not None for metadata in metadatas) else None
+        )
+
+        offset += len(records['id'])
+
+        if progress:
+            progress(offset, total)
+
+    if offset != total:
+        raise ValueError(f'El snapshot contiene {offset} registros y el manifiesto indica {total}')
+
+    return offset
@@ -1,8 +1,113 @@
 import sys
+import re
+import hashlib
+import json
+import unicodedata
+from concurrent.futures import ThreadPoolExecutor
+
+# claves de mas de esta longitud se reemplazan por su hash para reducir la memoria del indice de duplicados
+MAX_KEY_LENGTH = 128
 
 def progress_bar(actual:int, total:int, lenght=50):
-    percent = actual / total
+    percent = actual / total if total else 1.0
     bar_length = int(50 * percent)
     bar = '█' * bar_length + '▯' * (50 - bar_length)
     sys.stdout.write(f'\r[{bar}] {percent:.2%} ')
-    sys.stdout.flush()
\ No newline at end of file
+    sys.stdout.flush()
+
+def normalizar_texto(texto:str) -> str:
+    """
+    Normaliza un texto: minusculas, sin acentos y con los espacios colapsados.
+    
+    ```python
+    normalizar_texto('  ¿Qué es la   RECATEGORIZACIÓN? ')
+    # '¿que es la recategorizacion?'
+    ```
+    """
+    texto = unicodedata.normalize('NFKD', texto.casefold())
+    texto = ''.join(caracter for caracter in texto if not unicodedata.combining(caracter))
+    
+    return re.sub(r'\s+', ' ', texto).strip()
+
+def clave_duplicado(texto:str, normalize:bool=False) -> str | bytes:
+    """
+    Devuelve la clave con la que se detectan duplicados en un indice de tipo ```set```.
+    
+    Si ```normalize``` es True se normaliza el texto antes (ver ```normalizar_texto```).
+    Los textos largos se reemplazan por su hash (blake2b de 16 bytes).
+    """
+    if normalize:
+        texto = normalizar_texto(texto)
+    
+    if len(texto) > MAX_KEY_LENGTH:
+        return hashlib.blake2b(texto.encode('utf-8'), digest_size=16).digest()
+    
+    return texto
+
+
+def stable_id(*partes:str) -> str:
+    """
+    Devuelve un id deterministico (hash sha1 en hexadecimal) a partir de las partes indicadas.
+    
+    El mismo contenido siempre genera el mismo id, por lo que una reconstruccion del dataset no cambia los ids.
+    """
+    return hashlib.sha1('\x1f'.join(partes).encode('utf-8')).hexdigest()
+
+def content_hash(document:str, metadata:dict) -> str:
+    """
+    Devuelve un hash del contenido de una fila (documento y metadata). Se utiliza para detectar filas modificadas.
+    """
+    contenido = json.dumps([document, metadata], sort_keys=True, ensure_ascii=False)
+    
+    return hashlib.blake2b(contenido.encode('utf-8'), digest_size=16).hexdigest()
+
+def query_in_batches(collection, query_texts:list[str]=None, query_embeddings:list=None, n_results:int=5, include:list[str]=['documents', 'metadatas', 'distances'], batch_size:int=100, workers:int=1, **kwargs) -> dict:
+    """
+    Ejecuta muchas consultas a una coleccion enviando bloques de ```batch_size``` consultas por llamado a ```collection.query()```.
+    
+    Se indican los textos (```query_texts```) o los embeddings ya calculados (```query_embeddings```). Con ```workers``` > 1
+    los bloques se envian en paralelo. El resultado tiene el formato de ```collection.query()``` y esta alineado con las
+    consultas de entrada: ```resultado['ids'][i]``` corresponde a la consulta ```i```.
+    """
+    if (query_texts is None) == (query_embeddings is None):
+        raise ValueError('Se debe indicar query_texts o query_embeddings')
+    
+    consultas = query_texts if query_texts is not None else query_embeddings
+    parametro = 'query_texts' if query_texts is not None else 'query_embeddings'
+    bloques = [consultas[start:start + batch_size] for start in range(0, len(consultas), batch_size)]
+    
+    # sin consultas: mismo formato que collection.query(), con listas vacias en los campos incluidos
+    if not bloques:
+        return {key: [] if key == 'ids' or key in include else None for key in ('ids', 'distances', 'embeddings', 'metadatas', 'documents', 'uris', 'data')}
+    
+    def consultar(bloque):
+        return collection.query(**{parametro: bloque}, n_results=n_results, include=include, **kwargs)
+    
+    if workers > 1:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            # map conserva el orden de los bloques
+            respuestas = list(executor.map(consultar, bloques))
+    else:
+        respuestas = [consultar(bloque) for bloque in bloques]
+    
+    resultado = {}
+    for respuesta in respuestas:
+        for key, value in respuesta.items():
+            if value is None:
+                resultado.setdefault(key, None)
+            else:
+                resultado.setdefault(key, [])
+                resultado[key].extend(value)
+    
+    return resultado
+
+
+def recall_at_k(expected:list[list[str]], found:list[list[str]]) -> float:
+    """
+    Fraccion de los resultados esperados (busqueda exacta) presentes en los resultados encontrados, promediada
+    sobre todas las consultas.
+    """
+    total = sum(len(ids) for ids in expected)
+    hits = sum(len(set(a) & set(b)) for a, b in zip(expected, found))
+    
+    return hits / total if total else 0.0
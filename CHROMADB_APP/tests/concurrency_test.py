@@ -1 +1,382 @@
-""" TBC """
+"""
+Prueba de concurrencia: cargas mixtas de lectura y escritura sobre una misma coleccion.
+
+Cada worker (hilo o proceso) ejecuta una secuencia aleatoria de operaciones:
+    - query: busqueda semantica (```query_collection```)
+    - insert / update / delete: ```insert_data```, ```update_data``` y ```delete_data``` sobre ids propios del worker
+    - read: lectura de un id propio (vigente o eliminado), para verificar que se lee lo ultimo que el worker escribio
+      (read-your-writes). La lectura se hace por id y tambien con una busqueda del ultimo documento escrito: la
+      busqueda debe devolver la version vigente, o no devolver el id si fue eliminado
+
+Las escrituras y las busquedas pasan por la misma interfaz (```Database``` o ```Client```), de modo que tambien se
+verifican sus caches e indices en memoria.
+
+Cada worker es el unico que escribe sus ids, por lo que conoce el estado final esperado de cada uno (version vigente
+o eliminado). Al finalizar se compara contra la coleccion para detectar escrituras perdidas.
+
+Se reporta: operaciones por segundo, latencias p50/p95/p99 y tasa de errores por operacion, lecturas y busquedas
+inconsistentes y escrituras perdidas. El proceso termina con codigo 1 si hubo inconsistencias o escrituras perdidas.
+
+Destinos:
+    - local: ```Database``` persistente compartida entre hilos (solo hilos: chroma no soporta varios procesos
+      sobre el mismo directorio persistente)
+    - http: ```Client``` contra un servidor de chroma (hilos que comparten un cliente, o procesos con un cliente cada uno)
+
+    python tests/concurrency_test.py --target local --workers 8 --ops 500
+    python tests/concurrency_test.py --target http --host localhost --port 8000 --mode process --workers 8 --ops 500
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import argparse
+import tempfile
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+from stress_tests import PALABRAS, percentiles, synthetic_dataset
+from embeddings import HashingEmbeddingBackend
+
+
+COLLECTION_NAME = 'concurrency_test'
+OPERATIONS = ('query', 'insert', 'update', 'delete', 'read')
+
+
+class LocalTarget:
+    """ Operaciones sobre una ```Database``` persistente (en el mismo proceso). """
+
+    def __init__(self, database_path:str) -> None:
+        from database import Database
+
+        self.database = Database(database_path, embedding_function=HashingEmbeddingBackend(), cache_embeddings=False)
+
+    def setup(self, dataset:dict) -> None:
+        self.database.delete_collection(COLLECTION_NAME, ignore_warnings=True)
+        self.database.build_collection(dataset, batch_size=1000)
+
+    def query(self, text:str):
+        return self.database.query_collection(COLLECTION_NAME, text, n_results=5)
+
+    def insert(self, id:str, document:str, metadata:dict) -> None:
+        self.database.insert_data(COLLECTION_NAME, {'id': id, 'document': document, 'metadata': metadata})
+
+    def update(self, id:str, document:str, metadata:dict) -> None:
+        self.database.update_data(COLLECTION_NAME, {'id': id, 'document': document, 'metadata': metadata})
+
+    def delete(self, id:str) -> None:
+        self.database.delete_data(COLLECTION_NAME, {'id': id})
+
+    def get(self, ids:list[str]) -> dict:
+        result = self.database.get_collection(COLLECTION_NAME).get(ids=ids, include=['metadatas'])
+        return dict(zip(result['ids'], result['metadatas']))
+
+
+class HttpTarget:
+    """ Operaciones a traves de ```Client``` contra un servidor de chroma. """
+
+    def __init__(self, host:str, port:int) -> None:
+        from cliente import Client
+
+        self.client = Client(host=host, port=port, embedding_function=HashingEmbeddingBackend(), retries=0)
+
+    def setup(self, dataset:dict) -> None:
+        try:
+            self.client.client.delete_collection(COLLECTION_NAME)
+        except Exception:
+            pass
+
+        self.client.registry.invalidate(COLLECTION_NAME)
+        collection = self.client.registry.create(COLLECTION_NAME)
+
+        for start in range(0, dataset['count'], 1000):
+            collection.add(
+                ids=dataset['ids'][start:start + 1000],
+                documents=dataset['documents'][start:start + 1000],
+                metadatas=dataset['metadatas'][start:start + 1000]
+            )
+
+    def query(self, text:str):
+        return self.client.query_collection(COLLECTION_NAME, text, n_results=5, include=['documents', 'metadatas', 'distances'])
+
+    def insert(self, id:str, document:str, metadata:dict) -> None:
+        self.client.insert_data({'id': id, 'document': document, 'metadata': metadata}, collection_name=COLLECTION_NAME)
+
+    def update(self, id:str, document:str, metadata:dict) -> None:
+        self.client.update_data({'id': id, 'document': document, 'metadata': metadata}, collection_name=COLLECTION_NAME)
+
+    def delete(self, id:str) -> None:
+        self.client.delete_data({'id': id}, collection_name=COLLECTION_NAME)
+
+    def get(self, ids:list[str]) -> dict:
+        result = self.client.registry.get(COLLECTION_NAME).get(ids=ids, include=['metadatas'])
+        return dict(zip(result['ids'], result['metadatas']))
+
+
+def make_target(config:dict):
+    if config['target'] == 'http':
+        return HttpTarget(config['host'], config['port'])
+
+    return LocalTarget(config['path'])
+
+
+def run_worker(target, worker_id:int, config:dict) -> dict:
+    """
+    Ejecuta ```config['ops']``` operaciones aleatorias y devuelve las latencias y errores por operacion, las lecturas
+    inconsistentes y el estado esperado de los ids escritos por el worker (```ledger```: id -> version o None si
+    fue eliminado).
+    """
+    rng = random.Random(config['seed'] * 1000 + worker_id)
+    weights = [config['mix'][operation] for operation in OPERATIONS]
+
+    stats = {operation: {'latencies': [], 'errors': 0} for operation in OPERATIONS}
+    ledger:dict[str, int] = {}
+    # ultimo documento escrito de cada id (tambien de los eliminados), usado como texto de busqueda en 'read'
+    documents:dict[str, str] = {}
+    uncertain:set[str] = set()
+    inconsistent_reads = []
+    inconsistent_queries = []
+    error_samples = []
+    sequence = 0
+
+    for _ in range(config['ops']):
+        operation = rng.choices(OPERATIONS, weights)[0]
+        live = [id for id, version in ledger.items() if version is not None]
+        readable = [id for id in ledger if id not in uncertain]
+
+        # sin ids propios vigentes solo se puede insertar (se lee cualquier id escrito, tambien los eliminados)
+        if operation in ('update', 'delete') and not live or operation == 'read' and not readable:
+            operation = 'insert'
+
+        t_i = time.perf_counter()
+
+        try:
+            if operation == 'query':
+                target.query(' '.join(rng.choices(PALABRAS, k=4)))
+
+            elif operation == 'insert':
+                id = f'w{worker_id}_{sequence}'
+                sequence += 1
+                uncertain.add(id)
+                documents[id] = f'{id} version 1 ' + ' '.join(rng.choices(PALABRAS, k=8))
+                target.insert(id, documents[id], {'worker': worker_id, 'version': 1})
+                ledger[id] = 1
+                uncertain.discard(id)
+
+            elif operation == 'update':
+                id = rng.choice(live)
+                version = ledger[id] + 1
+                uncertain.add(id)
+                documents[id] = f'{id} version {version} ' + ' '.join(rng.choices(PALABRAS, k=8))
+                target.update(id, documents[id], {'worker': worker_id, 'version': version})
+                ledger[id] = version
+                uncertain.discard(id)
+
+            elif operation == 'delete':
+                id = rng.choice(live)
+                uncertain.add(id)
+                target.delete(id)
+                ledger[id] = None
+                uncertain.discard(id)
+
+            else:
+                id = rng.choice(readable)
+                stored = target.get([id]).get(id)
+                read = stored.get('version') if stored else None
+
+                if read != ledger[id]:
+                    inconsistent_reads.append({'id': id, 'expected': ledger[id], 'read': read})
+
+                # la busqueda del ultimo documento escrito debe reflejar la escritura (o la eliminacion)
+                response = target.query(documents[id])
+                found = dict(zip(response['ids'][0], response['metadatas'][0]))
+                queried = found[id].get('version') if id in found else None
+
+                if queried != ledger[id]:
+                    inconsistent_queries.append({'id': id, 'expected': ledger[id], 'query': queried})
+
+        except Exception as e:
+            stats[operation]['errors'] += 1
+            if len(error_samples) < 5:
+                error_samples.append(f'{operation}: {e}')
+
+        stats[operation]['latencies'].append(time.perf_counter() - t_i)
+
+    # los ids cuya ultima escritura fallo tienen un estado final desconocido: no se verifican
+    for id in uncertain:
+        ledger.pop(id, None)
+
+    return {
+        'worker': worker_id,
+        'stats': stats,
+        'ledger': ledger,
+        'inconsistent_reads': inconsistent_reads,
+        'inconsistent_queries': inconsistent_queries,
+        'error_samples': error_samples,
+    }
+
+
+def _process_worker(worker_id:int, config:dict) -> dict:
+    # cada proceso abre su propio cliente (sus propias conexiones al servidor)
+    return run_worker(make_target(config), worker_id, config)
+
+
+def verify_writes(target, ledger:dict[str, int], chunk_size:int=500) -> dict:
+    """ Compara el estado esperado de los ids escritos contra la coleccion. """
+    ids = list(ledger)
+    stored = {}
+
+    for start in range(0, len(ids), chunk_size):
+        stored.update(target.get(ids[start:start + chunk_size]))
+
+    lost_inserts, lost_updates, lost_deletes = [], [], []
+
+    for id, version in ledger.items():
+        metadata = stored.get(id)
+
+        if version is None:
+            if metadata is not None:
+                lost_deletes.append(id)
+        elif metadata is None:
+            lost_inserts.append(id)
+        elif metadata.get('version') != version:
+            lost_updates.append(id)
+
+    return {
+        'verified_ids': len(ids),
+        'lost_inserts': len(lost_inserts),
+        'lost_updates': len(lost_updates),
+        'lost_deletes': len(lost_deletes),
+        'lost_samples': (lost_inserts + lost_updates + lost_deletes)[:10],
+    }
+
+
+def summarize(results:list[dict], wall_seconds:float) -> dict:
+    operations = {}
+    total_ops = total_errors = 0
+
+    for operation in OPERATIONS:
+        latencies = [latency for result in results for latency in result['stats'][operation]['latencies']]
+        errors = sum(result['stats'][operation]['errors'] for result in results)
+
+        if not latencies:
+            continue
+
+        total_ops += len(latencies)
+        total_errors += errors
+
+        operations[operation] = {
+            'count': len(latencies),
+            'errors': errors,
+            'error_rate': round(errors / len(latencies), 4),
+            **percentiles(latencies),
+        }
+
+    return {
+        'ops': total_ops,
+        'seconds': round(wall_seconds, 4),
+        'ops_per_sec': round(total_ops / wall_seconds, 2),
+        'error_rate': round(total_errors / total_ops, 4) if total_ops else 0.0,
+        'operations': operations,
+        'inconsistent_reads': sum(len(result['inconsistent_reads']) for result in results),
+        'inconsistent_samples': [read for result in results for read in result['inconsistent_reads']][:10],
+        'inconsistent_queries': sum(len(result['inconsistent_queries']) for result in results),
+        'inconsistent_query_samples': [query for result in results for query in result['inconsistent_queries']][:10],
+        'error_samples': [sample for result in results for sample in result['error_samples']][:10],
+    }
+
+
+def run_concurrency(args) -> dict:
+    if args.target == 'local' and args.mode == 'process':
+        raise ValueError('El destino local solo admite hilos: chroma no soporta varios procesos sobre el mismo directorio persistente')
+
+    path = args.path or tempfile.mkdtemp(prefix='chroma_concurrency_')
+
+    config = {
+        'target': args.target,
+        'host': args.host,
+        'port': args.port,
+        'path': path,
+        'ops': args.ops,
+        'seed': args.seed,
+        'mix': {'query': args.query, 'insert': args.insert, 'update': args.update, 'delete': args.delete, 'read': args.read},
+    }
+
+    target = make_target(config)
+    target.setup(synthetic_dataset(COLLECTION_NAME, args.docs, args.seed))
+
+    try:
+        t_i = time.perf_counter()
+
+        if args.mode == 'thread':
+            # todos los hilos comparten el mismo cliente / base de datos
+            with ThreadPoolExecutor(max_workers=args.workers) as executor:
+                results = list(executor.map(lambda worker_id: run_worker(target, worker_id, config), range(args.workers)))
+        else:
+            with ProcessPoolExecutor(max_workers=args.workers) as executor:
+                results = list(executor.map(_process_worker, range(args.workers), [config] * args.workers))
+
+        wall_seconds = time.perf_counter() - t_i
+
+        ledger = {id: version for result in results for id, version in result['ledger'].items()}
+
+        report = summarize(results, wall_seconds)
+        report['writes'] = verify_writes(target, ledger)
+        report['config'] = {key: value for key, value in vars(args).items() if key != 'output'}
+
+        return report
+
+    finally:
+        if not args.path and args.target == 'local':
+            del target
+            shutil.rmtree(path, ignore_errors=True)
+
+
+def parse_args(argv:list[str]=None):
+    parser = argparse.ArgumentParser(description='Cargas mixtas de lectura y escritura concurrentes')
+    parser.add_argument('--target', choices=['local', 'http'], default='local')
+    parser.add_argument('--mode', choices=['thread', 'process'], default='thread')
+    parser.add_argument('--workers', type=int, default=8)
+    parser.add_argument('--ops', type=int, default=500, help='operaciones por worker')
+    parser.add_argument('--docs', type=int, default=2000, help='documentos iniciales de la coleccion')
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--path', default=None, help='directorio de la base de datos local (por defecto uno temporal)')
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--output', default=None, help='archivo JSON de resultados')
+
+    # proporcion de cada operacion en la carga
+    parser.add_argument('--query', type=float, default=0.6)
+    parser.add_argument('--insert', type=float, default=0.15)
+    parser.add_argument('--update', type=float, default=0.1)
+    parser.add_argument('--delete', type=float, default=0.05)
+    parser.add_argument('--read', type=float, default=0.1)
+
+    return parser.parse_args(argv)
+
+
+if __name__ == '__main__':
+
+    args = parse_args()
+    report = run_concurrency(args)
+
+    print('\n' + json.dumps(report, indent=2))
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=2)
+        print(f'Resultados guardados en {args.output}')
+
+    writes = report['writes']
+    lost = writes['lost_inserts'] + writes['lost_updates'] + writes['lost_deletes']
+
+    if lost or report['inconsistent_reads'] or report['inconsistent_queries']:
+        print(f"\nINCONSISTENCIAS: {lost} escrituras perdidas, {report['inconsistent_reads']} lecturas inconsistentes, "
+              f"{report['inconsistent_queries']} busquedas inconsistentes")
+        sys.exit(1)
+
+    print('\nSin escrituras perdidas ni lecturas o busquedas inconsistentes')
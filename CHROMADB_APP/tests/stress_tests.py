@@ -1,76 +1,450 @@
+"""
+Suite de benchmarks de la base de datos.
 
+Escenarios:
+    - ingestion: documentos por segundo de la carga masiva (build_collection) y del pipeline en paralelo (ingest_collection)
+    - latency: latencia p50/p95/p99 de consultas individuales, con y sin el calculo del embedding
+    - concurrency: consultas por segundo y latencias con N hilos cliente simultaneos
+    - cache: tasa de aciertos y latencias del cache de consultas con una distribucion de preguntas tipo Zipf
+    - exact: busqueda exacta en memoria (exact_search) frente al indice HNSW: latencias y recall@k del HNSW
+    - filtered: consultas filtradas por una categoria, con el filtro de chroma (HNSW) y por fuerza bruta (category_index)
+    - http: (opcional, con --host) consultas concurrentes con N corrutinas a traves de AsyncClient
+
+Corre sobre una base de datos local (persistente en un directorio temporal, o en memoria con --in-memory) con el
+embedder deterministico por hashing, por lo que los resultados son comparables entre corridas. Los resultados se
+escriben en JSON y se pueden comparar contra una corrida previa para detectar regresiones:
+
+    python tests/stress_tests.py --docs 5000 --queries 500 --threads 1 4 16 --output bench.json
+    python tests/stress_tests.py --docs 5000 --queries 500 --threads 1 4 16 --baseline bench.json --tolerance 0.15
+
+Con --baseline el proceso termina con codigo 1 si alguna metrica empeora mas que la tolerancia.
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import asyncio
+import argparse
+import platform
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
 import chromadb
-import time, importlib
-import matplotlib.pyplot as plt
-
-
-
-def iter_test(intervalos:list=[], f=None):
-    
-    promedios = []
-    
-    for amount in intervalos:
-        promedio = f(amount)
-        promedios.append(promedio)
-        
-    else:
-        plt.plot(intervalos, promedios)
-        plt.xlabel('Cantidad de queries')
-        plt.ylabel('Queries por segundo [q/seg]')
-        plt.grid(visible=True)
-        plt.title('Caudal de queries vs Total queries')
-        plt.show()
-        
-
-def stress_test1(query_amout:int, collection_name:str=None, query_text:str=None) -> None:
-
-    print(' Comenzando prueba de stress: stress_test1')
-    print('Cantidad de queries a realizar: ', query_amout)
-
-    # si no se especifica una coleccion, se selecciona la primer coleccion dentro de la base de datos 
-    if not collection_name:
-
-        #print('Client collections: ', client.list_collections())
-        collections:dict = client.list_collections()
-        collection:chromadb.Collection = collections[0]
-        collection_name:str = collection.name
-        
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from database import Database
+from embeddings import HashingEmbeddingBackend
+from query_cache import QueryCache
+from utilities import recall_at_k
+
+
+# vocabulario del corpus sintetico
+PALABRAS = (
+    'monotributo categoria factura recategorizacion baja alta cuit clave fiscal domicilio pago vencimiento deuda plan '
+    'cuotas ingresos brutos impuesto ganancias iva aportes jubilacion obra social constancia inscripcion formulario '
+    'tramite turno credencial empleador retencion percepcion devolucion reintegro beneficio exencion tasa interes '
+    'declaracion jurada regimen simplificado actividad comercio servicios alquiler venta compra importacion'
+).split()
+
+# metricas donde un valor mas alto es mejor. Para el resto (latencias, tiempos) un valor mas bajo es mejor
+HIGHER_IS_BETTER = ('docs_per_sec', 'qps', 'hit_rate', 'speedup', 'recall')
+
+
+def percentiles(latencies:list[float]) -> dict:
+    """ Resumen en milisegundos de una lista de latencias en segundos. """
+    values = np.array(latencies) * 1000
+
+    return {
+        'p50_ms': round(float(np.percentile(values, 50)), 4),
+        'p95_ms': round(float(np.percentile(values, 95)), 4),
+        'p99_ms': round(float(np.percentile(values, 99)), 4),
+        'mean_ms': round(float(values.mean()), 4),
+        'max_ms': round(float(values.max()), 4),
+    }
+
+
+def synthetic_dataset(collection_name:str, count:int, seed:int) -> dict:
+    """ Dataset sintetico con el mismo formato que ```get_data()``` de local_datasets. """
+    rng = random.Random(seed)
+
+    documents = [' '.join(rng.choices(PALABRAS, k=rng.randint(6, 20))) for _ in range(count)]
+    metadatas = [{'categoria_principal': f'categoria_{i % 10}', 'respuesta': f'respuesta {i}'} for i in range(count)]
+    ids = [f'doc_{i}' for i in range(count)]
+
+    return {
+        'collection_name': collection_name,
+        'documents': documents,
+        'metadatas': metadatas,
+        'ids': ids,
+        'count': count,
+    }
+
+
+def synthetic_queries(count:int, seed:int) -> list[str]:
+    rng = random.Random(seed + 1)
+    return [' '.join(rng.choices(PALABRAS, k=rng.randint(3, 8))) for _ in range(count)]
+
+
+def bench_ingestion(database:Database, docs:int, batch_size:int, workers:int, seed:int) -> dict:
+    """ Carga el mismo corpus con la carga masiva y con el pipeline en paralelo. """
+    results = {}
+
+    for mode, collection_name in (('bulk', 'bench_bulk'), ('pipeline', 'bench_pipeline')):
+        dataset = synthetic_dataset(collection_name, docs, seed)
+        database.delete_collection(collection_name, ignore_warnings=True)
+
+        t_i = time.perf_counter()
+        if mode == 'bulk':
+            database.build_collection(dataset, batch_size=batch_size)
+        else:
+            database.ingest_collection(dataset, batch_size=batch_size, workers=workers)
+        t_total = time.perf_counter() - t_i
+
+        results[mode] = {
+            'docs': docs,
+            'seconds': round(t_total, 4),
+            'docs_per_sec': round(docs / t_total, 2),
+        }
+
+    return results
+
+
+def bench_latency(database:Database, collection_name:str, queries:list[str], n_results:int) -> dict:
+    """ Latencia de consultas individuales, incluyendo el embedding (end_to_end) y con vectores ya calculados (search). """
+    # la primera consulta carga el indice en memoria: no se mide
+    database.query_collection(collection_name, queries[0], n_results=n_results)
+
+    end_to_end, search = [], []
+    embeddings = [database.embed_query(query) for query in queries]
+
+    for query in queries:
+        t_i = time.perf_counter()
+        database.query_collection(collection_name, query, n_results=n_results)
+        end_to_end.append(time.perf_counter() - t_i)
+
+    for query, embedding in zip(queries, embeddings):
+        t_i = time.perf_counter()
+        database.query_collection(collection_name, query, n_results=n_results, query_embeddings=embedding)
+        search.append(time.perf_counter() - t_i)
+
+    return {
+        'queries': len(queries),
+        'end_to_end': percentiles(end_to_end),
+        'search': percentiles(search),
+    }
+
+
+def bench_concurrency(database:Database, collection_name:str, queries:list[str], n_results:int, threads:list[int]) -> dict:
+    """ Consultas por segundo y latencias con N hilos cliente consultando al mismo tiempo. """
+    results = {}
+
+    def timed_query(query:str) -> float:
+        t_i = time.perf_counter()
+        database.query_collection(collection_name, query, n_results=n_results)
+        return time.perf_counter() - t_i
+
+    for n in threads:
+        with ThreadPoolExecutor(max_workers=n) as executor:
+            t_i = time.perf_counter()
+            latencies = list(executor.map(timed_query, queries))
+            t_total = time.perf_counter() - t_i
+
+        results[f'threads_{n}'] = {
+            'threads': n,
+            'queries': len(queries),
+            'qps': round(len(queries) / t_total, 2),
+            **percentiles(latencies),
+        }
+
+    return results
+
+
+def bench_cache(database:Database, collection_name:str, queries:list[str], n_results:int, requests:int, cache_size:int, seed:int) -> dict:
+    """
+    Simula trafico dominado por pocas preguntas repetidas (distribucion Zipf sobre ```queries```) con un QueryCache
+    delante de la coleccion, y lo compara con el mismo trafico sin cache.
+    """
+    rng = np.random.default_rng(seed)
+    ranks = np.arange(1, len(queries) + 1)
+    weights = 1 / ranks ** 1.1
+    stream = [queries[i] for i in rng.choice(len(queries), size=requests, p=weights / weights.sum())]
+
+    include = ['documents', 'metadatas', 'distances']
+    cache = QueryCache(max_items=cache_size, ttl=3600)
+
+    def cached_query(query:str):
+        version = cache.version(collection_name)
+        response = cache.get(collection_name, query, n_results, include)
+        if response is None:
+            response = database.query_collection(collection_name, query, n_results=n_results)
+            cache.set(collection_name, query, n_results, include, response, version)
+        return response
+
+    latencies = {'uncached': [], 'cached': []}
+
+    for mode, query_function in (('uncached', lambda query: database.query_collection(collection_name, query, n_results=n_results)), ('cached', cached_query)):
+        for query in stream:
+            t_i = time.perf_counter()
+            query_function(query)
+            latencies[mode].append(time.perf_counter() - t_i)
+
+    uncached, cached = percentiles(latencies['uncached']), percentiles(latencies['cached'])
+    stats = cache.stats()
+
+    return {
+        'requests': requests,
+        'distinct_queries': len(set(stream)),
+        'cache_size': cache_size,
+        'hit_rate': round(stats['hit_rate'], 4),
+        'uncached': uncached,
+        'cached': cached,
+        'speedup': round(uncached['mean_ms'] / cached['mean_ms'], 2) if cached['mean_ms'] else 0.0,
+    }
+
+
+def bench_exact(database:Database, collection_name:str, queries:list[str], n_results:int) -> dict:
+    """
+    Busqueda exacta en memoria frente al indice HNSW de chroma, con los mismos vectores de consulta. La busqueda exacta
+    es la referencia del recall del HNSW. Tambien se mide la busqueda exacta de todas las consultas en un unico lote.
+    """
+    collection = database.get_collection(collection_name)
+    engine = database.get_exact_engine(collection_name)
+    embeddings = database.embed_query(queries)
+
+    hnsw, exact, found, expected = [], [], [], []
+
+    for embedding in embeddings:
+        t_i = time.perf_counter()
+        found.append(collection.query(query_embeddings=[embedding], n_results=n_results, include=[])['ids'][0])
+        hnsw.append(time.perf_counter() - t_i)
+
+        t_i = time.perf_counter()
+        expected.append(engine.search([embedding], n_results=n_results)[0][0])
+        exact.append(time.perf_counter() - t_i)
+
     t_i = time.perf_counter()
-    for _ in range(query_amout):
-        collection.query(
-            query_texts= 'default_query' if not query_text else query_text,
-            n_results= 2
-            )
-        
-    else:
-        t_total = (time.perf_counter() - t_i) # pasaje de microsegundos a milisegundos
-        promedio = query_amout/t_total
-        print(f'se han realizado {query_amout} consultas en {t_total:.4f} segundos.')
-        print(f'Cantidad de consultas por segundo: {promedio:.4f}')
-  
-        return promedio
-    
-def concurrency_test1():
-    pass
-        
-if __name__ == '__main__':
+    engine.search(embeddings, n_results=n_results)
+    t_batch = time.perf_counter() - t_i
 
-    client = None
+    return {
+        'vectors': len(engine),
+        'hnsw': percentiles(hnsw),
+        'exact': percentiles(exact),
+        'exact_batch': {'queries': len(embeddings), 'qps': round(len(embeddings) / t_batch, 2)},
+        'recall': round(recall_at_k(expected, found), 4),
+    }
+
+
+def bench_filtered(database:Database, collection_name:str, queries:list[str], n_results:int) -> dict:
+    """
+    Consultas filtradas por una categoria (la decima parte del corpus) con el filtro ```where``` de chroma sobre el
+    indice HNSW y por fuerza bruta con el motor en cache de ```category_index```. La primera consulta por fuerza bruta
+    construye el motor de la categoria y se mide aparte (build_ms).
+    """
+    collection = database.get_collection(collection_name)
+    embeddings = database.embed_query(queries)
+    where = {'categoria_principal': 'categoria_3'}
+
+    t_i = time.perf_counter()
+    database.categories.query(collection, [embeddings[0]], n_results=n_results, where=where)
+    build = time.perf_counter() - t_i
+
+    ann, brute_force, found, expected = [], [], [], []
+
+    for embedding in embeddings:
+        t_i = time.perf_counter()
+        found.append(collection.query(query_embeddings=[embedding], n_results=n_results, where=where)['ids'][0])
+        ann.append(time.perf_counter() - t_i)
+
+        t_i = time.perf_counter()
+        expected.append(database.categories.query(collection, [embedding], n_results=n_results, where=where)['ids'][0])
+        brute_force.append(time.perf_counter() - t_i)
+
+    return {
+        'category_size': len(database.categories.get(collection).ids(where)),
+        'build_ms': round(build * 1000, 4),
+        'ann': percentiles(ann),
+        'brute_force': percentiles(brute_force),
+        'recall': round(recall_at_k(expected, found), 4),
+    }
+
+
+def bench_http(host:str, port:int, dataset:dict, queries:list[str], n_results:int, coroutines:list[int]) -> dict:
+    """ Consultas concurrentes a un servidor de chroma con N corrutinas (AsyncClient). """
+    from cliente_async import AsyncClient
+
+    embedding_function = HashingEmbeddingBackend()
+    client = chromadb.HttpClient(host=host, port=port)
+    collection_name = 'bench_http'
 
     try:
-        print('Intentando alcanzar el servidor de base de datos')
-        client = chromadb.HttpClient()
-        print('Conexion a la base de datos remota exitosa. \n')
-    except Exception as e:
-        print('No se pudo alcanzar el servidor local.', e)
+        client.delete_collection(collection_name)
+    except Exception:
+        pass
+
+    collection = client.create_collection(collection_name, embedding_function=embedding_function)
+    for start in range(0, dataset['count'], 1000):
+        collection.add(
+            ids=dataset['ids'][start:start + 1000],
+            documents=dataset['documents'][start:start + 1000],
+            metadatas=dataset['metadatas'][start:start + 1000]
+        )
+
+    async def run(n:int) -> dict:
+        async with AsyncClient(host=host, port=port, embedding_function=embedding_function, max_concurrency=n, max_connections=n) as async_client:
+            await async_client.query_collection(collection_name, queries[0], n_results=n_results)
+            semaphore = asyncio.Semaphore(n)
+
+            async def timed_query(query:str) -> float:
+                async with semaphore:
+                    t_i = time.perf_counter()
+                    await async_client.query_collection(collection_name, query, n_results=n_results)
+                    return time.perf_counter() - t_i
+
+            t_i = time.perf_counter()
+            latencies = await asyncio.gather(*(timed_query(query) for query in queries))
+            t_total = time.perf_counter() - t_i
+
+        return {'coroutines': n, 'queries': len(queries), 'qps': round(len(queries) / t_total, 2), **percentiles(latencies)}
 
     try:
-        print('Intentando alcanzar la base de datos persistente')
-        client = chromadb.PersistentClient('./database')
-        print('Conexion a la base de datos persistente exitosa. \n')
-    except Exception as e:
-        print('No se pudo alcanzar la base de datos persistente.', e)
-
-    
-    if client:
-            iter_test(f=stress_test1, intervalos=[10, 20, 30, 50, 100])
+        return {f'coroutines_{n}': asyncio.run(run(n)) for n in coroutines}
+    finally:
+        client.delete_collection(collection_name)
+
+
+def flatten(results:dict, prefix:str='') -> dict[str, float]:
+    """ Aplana el diccionario de resultados: {'latency.search.p50_ms': 0.41, ...} """
+    flat = {}
+
+    for key, value in results.items():
+        name = f'{prefix}.{key}' if prefix else key
+
+        if isinstance(value, dict):
+            flat.update(flatten(value, name))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            flat[name] = value
+
+    return flat
+
+
+def compare_results(current:dict, baseline:dict, tolerance:float=0.15) -> list[dict]:
+    """
+    Compara las metricas de dos corridas. Devuelve las metricas que empeoraron mas que ```tolerance``` (fraccion).
+    Solo se comparan metricas de rendimiento (latencias, tiempos, tasas), no los parametros de la corrida.
+    """
+    current, baseline = flatten(current['results']), flatten(baseline['results'])
+    regressions = []
+
+    for name, value in current.items():
+        metric = name.rsplit('.', 1)[-1]
+        higher_is_better = metric in HIGHER_IS_BETTER
+
+        if name not in baseline or not (higher_is_better or metric.endswith('_ms') or metric == 'seconds'):
+            continue
+
+        previous = baseline[name]
+        if not previous:
+            continue
+
+        change = (value - previous) / previous
+        worse = -change if higher_is_better else change
+
+        if worse > tolerance:
+            regressions.append({'metric': name, 'baseline': previous, 'current': value, 'change': round(change, 4)})
+
+    return regressions
+
+
+def run_benchmarks(args) -> dict:
+    database_path = args.path or tempfile.mkdtemp(prefix='chroma_bench_')
+    database = Database(database_path, persistent=not args.in_memory, embedding_function=HashingEmbeddingBackend(dim=args.dim), cache_embeddings=False)
+
+    queries = synthetic_queries(args.queries, args.seed)
+    results = {}
+
+    try:
+        results['ingestion'] = bench_ingestion(database, args.docs, args.batch_size, args.workers, args.seed)
+        results['latency'] = bench_latency(database, 'bench_bulk', queries, args.n_results)
+        results['concurrency'] = bench_concurrency(database, 'bench_bulk', queries, args.n_results, args.threads)
+        results['cache'] = bench_cache(database, 'bench_bulk', queries, args.n_results, args.cache_requests, args.cache_size, args.seed)
+        results['exact'] = bench_exact(database, 'bench_bulk', queries, args.n_results)
+        results['filtered'] = bench_filtered(database, 'bench_bulk', queries, args.n_results)
+
+        if args.host:
+            results['http'] = bench_http(args.host, args.port, synthetic_dataset('bench_http', args.docs, args.seed), queries, args.n_results, args.threads)
+
+    finally:
+        for collection_name in ('bench_bulk', 'bench_pipeline'):
+            database.delete_collection(collection_name, ignore_warnings=True)
+
+        if not args.path:
+            del database
+            shutil.rmtree(database_path, ignore_errors=True)
+
+    return {
+        'meta': {
+            'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'python': platform.python_version(),
+            'chromadb': chromadb.__version__,
+            'platform': platform.platform(),
+            'cpu_count': os.cpu_count(),
+            'config': {key: value for key, value in vars(args).items() if key not in ('output', 'baseline')},
+        },
+        'results': results,
+    }
+
+
+def parse_args(argv:list[str]=None):
+    parser = argparse.ArgumentParser(description='Benchmarks de ingesta, latencia, concurrencia y cache')
+    parser.add_argument('--docs', type=int, default=5000, help='documentos del corpus sintetico')
+    parser.add_argument('--queries', type=int, default=500, help='consultas distintas')
+    parser.add_argument('--n-results', type=int, default=5)
+    parser.add_argument('--batch-size', type=int, default=500)
+    parser.add_argument('--workers', type=int, default=4, help='hilos del pipeline de ingesta')
+    parser.add_argument('--threads', type=int, nargs='+', default=[1, 4, 16], help='hilos (o corrutinas) cliente simultaneos')
+    parser.add_argument('--cache-requests', type=int, default=2000, help='consultas del escenario de cache')
+    parser.add_argument('--cache-size', type=int, default=256)
+    parser.add_argument('--dim', type=int, default=384, help='dimension de los embeddings')
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--path', default=None, help='directorio de la base de datos (por defecto uno temporal)')
+    parser.add_argument('--in-memory', action='store_true', help='utiliza una base de datos en memoria')
+    parser.add_argument('--host', default=None, help='servidor de chroma para el escenario http')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--output', default=None, help='archivo JSON de resultados')
+    parser.add_argument('--baseline', default=None, help='resultados previos contra los que comparar')
+    parser.add_argument('--tolerance', type=float, default=0.15, help='empeoramiento maximo admitido (fraccion)')
+
+    return parser.parse_args(argv)
+
+
+if __name__ == '__main__':
+
+    args = parse_args()
+    report = run_benchmarks(args)
+
+    print('\n' + json.dumps(report['results'], indent=2))
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=2)
+        print(f'Resultados guardados en {args.output}')
+
+    if args.baseline:
+        with open(args.baseline, encoding='utf-8') as f:
+            baseline = json.load(f)
+
+        regressions = compare_results(report, baseline, args.tolerance)
+
+        if regressions:
+            print(f'\nREGRESIONES (tolerancia {args.tolerance:.0%}):')
+            for regression in regressions:
+                print(f"  {regression['metric']}: {regression['baseline']} -> {regression['current']} ({regression['change']:+.1%})")
+            sys.exit(1)
+
+        print(f'\nSin regresiones respecto de {args.baseline} (tolerancia {args.tolerance:.0%})')
@@ -0,0 +1,503 @@
+"""
+Pruebas rapidas de los componentes de busqueda (pytest).
+
+Corren sobre una instancia de chroma en memoria con el embedder deterministico por hashing, sin servidor ni modelo
+de embeddings, desde la carpeta 'CHROMADB_APP'. ```Client``` y la API de Flask se conectan a la misma instancia en
+memoria y ```AsyncClient``` a la aplicacion ASGI del servidor de chroma, dentro del mismo proceso:
+
+    python -m pytest -q tests
+"""
+
+import os
+import sys
+import uuid
+import asyncio
+
+import httpx
+import numpy as np
+import pytest
+import chromadb
+from chromadb.config import Settings
+from chromadb.server.fastapi import FastAPI
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'flask'))
+
+from embeddings import HashingEmbeddingBackend
+from query_cache import QueryCache
+from lexical_index import BM25Index, reciprocal_rank_fusion, hybrid_query
+from exact_search import ExactSearchEngine, distances
+from quantized_store import QuantizedStore
+from exact_index import ExactMatchIndexes, merge_results
+from category_index import CategoryIndexes
+from embedding_cache import EmbeddingCache
+from ingestion import IngestionPipeline, chunk_data
+from snapshots import export_collection, import_collection, read_manifest
+from cliente import Client
+from cliente_async import AsyncClient
+from flask_app import create_app
+
+
+DOCUMENTOS = [
+    'Como me doy de baja del monotributo',
+    'Que es la recategorizacion del monotributo',
+    'Como pago la factura de monotributo',
+    'Donde consulto la categoria que me corresponde',
+    'Como genero la clave fiscal',
+    'Como adhiero al debito automatico',
+]
+
+
+@pytest.fixture
+def collection():
+    """ Coleccion temporal en memoria con ```DOCUMENTOS```. """
+    client = chromadb.EphemeralClient(Settings(anonymized_telemetry=False))
+    name = f'test_{uuid.uuid4().hex[:12]}'
+    collection = client.create_collection(name, embedding_function=HashingEmbeddingBackend(dim=64))
+
+    collection.add(
+        ids=[str(i) for i in range(len(DOCUMENTOS))],
+        documents=DOCUMENTOS,
+        metadatas=[{'respuesta': f'respuesta {i}', 'categoria_principal': 'baja' if i == 0 else 'otras'} for i in range(len(DOCUMENTOS))]
+    )
+
+    yield collection
+
+    client.delete_collection(name)
+
+
+@pytest.fixture
+def client(monkeypatch, collection):
+    """ ```Client``` conectado a la instancia en memoria de ```collection``` en lugar de un servidor. """
+    monkeypatch.setattr(chromadb, 'HttpClient', lambda **kwargs: chromadb.EphemeralClient(Settings(anonymized_telemetry=False)))
+    client = Client(embedding_function='hashing', embedding_options={'dim': 64})
+
+    yield client
+
+    client.disconnect()
+
+
+class _WriteDuringBuild:
+    """ Coleccion que realiza ```write()``` durante la primera lectura paginada (la construccion de un indice). """
+
+    def __init__(self, collection, write) -> None:
+        self._collection = collection
+        self._write = write
+        self.name = collection.name
+
+    def get(self, **kwargs):
+        page = self._collection.get(**kwargs)
+
+        if self._write and 'offset' in kwargs:
+            write, self._write = self._write, None
+            write()
+
+        return page
+
+
+def _vectors(count:int=500, dim:int=32, seed:int=0) -> tuple[list[str], np.ndarray]:
+    rng = np.random.default_rng(seed)
+    return [f'v{i}' for i in range(count)], rng.standard_normal((count, dim)).astype(np.float32)
+
+
+def _brute_force(space:str, queries:np.ndarray, vectors:np.ndarray, ids:list[str], k:int) -> list[list[str]]:
+    order = np.argsort(distances(space, queries, vectors), axis=1)[:, :k]
+    return [[ids[i] for i in row] for row in order]
+
+
+# --- QueryCache ---
+
+def test_query_cache_hit_and_normalized_key():
+    cache = QueryCache()
+    cache.set('abc', 'Que es la recategorizacion?', 5, ['documents'], {'ids': [['1']]}, cache.version('abc'))
+
+    assert cache.get('abc', 'que es la RECATEGORIZACION?', 5, ['documents']) == {'ids': [['1']]}
+    assert cache.get('abc', 'Que es la recategorizacion?', 3, ['documents']) is None
+
+
+def test_query_cache_discards_results_older_than_a_write():
+    cache = QueryCache()
+
+    # la version se toma antes de consultar; una escritura invalida la coleccion mientras tanto
+    version = cache.version('abc')
+    cache.invalidate('abc')
+    cache.set('abc', 'pregunta', 5, ['documents'], {'ids': [['viejo']]}, version)
+
+    assert cache.get('abc', 'pregunta', 5, ['documents']) is None
+
+
+def test_query_cache_invalidate_and_copies():
+    cache = QueryCache()
+    cache.set('abc', 'pregunta', 5, ['documents'], {'ids': [['1']]}, cache.version('abc'))
+
+    # modificar la respuesta devuelta no altera la entrada cacheada
+    cache.get('abc', 'pregunta', 5, ['documents'])['ids'][0].append('2')
+    assert cache.get('abc', 'pregunta', 5, ['documents']) == {'ids': [['1']]}
+
+    cache.invalidate('abc')
+    assert cache.get('abc', 'pregunta', 5, ['documents']) is None
+
+
+def test_query_cache_batched_queries():
+    cache = QueryCache()
+    cache.set('abc', ['Pregunta A', 'Pregunta B'], 5, ['documents'], {'ids': [['1'], ['2']]}, cache.version('abc'))
+
+    assert cache.get('abc', ['pregunta a', 'PREGUNTA B'], 5, ['documents']) == {'ids': [['1'], ['2']]}
+    assert cache.get('abc', ['pregunta b', 'pregunta a'], 5, ['documents']) is None
+    assert cache.get('abc', 'pregunta a', 5, ['documents']) is None
+
+
+# --- BM25 / RRF ---
+
+def test_bm25_ranks_matching_documents_first():
+    index = BM25Index()
+    index.add([str(i) for i in range(len(DOCUMENTOS))], DOCUMENTOS)
+
+    ids = [id for id, _ in index.search('clave fiscal', n_results=3)]
+    assert ids[0] == '4'
+
+    # solo se puntuan los ids indicados
+    assert all(id in ('0', '1') for id, _ in index.search('monotributo', n_results=5, ids=['0', '1']))
+
+    index.remove(['4'])
+    assert '4' not in [id for id, _ in index.search('clave fiscal', n_results=3)]
+
+
+def test_reciprocal_rank_fusion():
+    # a: 1/61 + 1/62, c: 1/63 + 1/61, b: 1/62
+    assert reciprocal_rank_fusion([['a', 'b', 'c'], ['c', 'a']]) == ['a', 'c', 'b']
+
+
+def test_hybrid_query_returns_lexical_hits_outside_vector_candidates(collection):
+    index = BM25Index()
+    index.add([str(i) for i in range(len(DOCUMENTOS))], DOCUMENTOS)
+
+    # embedding de otra pregunta: la busqueda por embeddings no devuelve el documento de la clave fiscal
+    query_embeddings = HashingEmbeddingBackend(dim=64)([DOCUMENTOS[5]])
+    candidates = collection.query(query_embeddings=query_embeddings, n_results=2, include=['distances'])
+    assert '4' not in candidates['ids'][0]
+
+    response = hybrid_query(collection, index, ['clave fiscal'], query_embeddings, n_results=3, candidates=2)
+
+    assert '4' in response['ids'][0]
+    assert len(response['documents'][0]) == len(response['distances'][0]) == len(response['ids'][0])
+
+    # la distancia del documento leido es la misma que calcula chroma
+    row = response['ids'][0].index('4')
+    assert response['documents'][0][row] == DOCUMENTOS[4]
+    expected = collection.query(query_embeddings=query_embeddings, n_results=len(DOCUMENTOS), include=['distances'])
+    assert np.isclose(response['distances'][0][row], expected['distances'][0][expected['ids'][0].index('4')], atol=1e-4)
+
+    # el filtro se aplica tambien a los documentos de BM25
+    filtered = hybrid_query(collection, index, ['clave fiscal'], query_embeddings, n_results=3, candidates=2, where={'categoria_principal': 'otras'})
+    assert '4' in filtered['ids'][0]
+    filtered = hybrid_query(collection, index, ['clave fiscal'], query_embeddings, n_results=3, candidates=2, where={'categoria_principal': 'baja'})
+    assert filtered['ids'][0] == ['0']
+
+
+# --- ExactSearchEngine ---
+
+@pytest.mark.parametrize('space', ['l2', 'cosine', 'ip'])
+def test_exact_search_matches_brute_force(space):
+    ids, vectors = _vectors()
+    queries = _vectors(count=20, seed=1)[1]
+
+    engine = ExactSearchEngine(space, capacity=16)
+    engine.add(ids, vectors)
+    found, found_distances = engine.search(queries, n_results=10)
+
+    if space == 'cosine':
+        vectors = vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+        queries = queries / np.linalg.norm(queries, axis=1, keepdims=True)
+
+    assert found == _brute_force(space, queries, vectors, ids, 10)
+    assert all(row == sorted(row) for row in found_distances)
+
+
+def test_exact_search_remove_and_replace():
+    ids, vectors = _vectors(count=50)
+
+    engine = ExactSearchEngine('l2')
+    engine.add(ids, vectors)
+    engine.remove(['v3'])
+    engine.add(['v7'], vectors[8:9])
+
+    found, found_distances = engine.search(vectors[3:4], n_results=50)
+    assert 'v3' not in found[0] and len(found[0]) == 49
+
+    # v7 ahora tiene el vector de v8: ambos a distancia 0 de la consulta
+    found, found_distances = engine.search(vectors[8:9], n_results=2)
+    assert set(found[0]) == {'v7', 'v8'} and np.allclose(found_distances[0], 0, atol=1e-4)
+
+
+# --- ExactMatchIndexes / CategoryIndexes ---
+
+def test_exact_match_index_discards_build_with_concurrent_write(collection):
+    indexes = ExactMatchIndexes([collection.name], page_size=2)
+
+    def write():
+        collection.add(ids=['nuevo'], documents=['Como tramito el F.184?'])
+        indexes.add(collection.name, ['nuevo'], ['Como tramito el F.184?'])
+
+    # la escritura llega mientras se construye el indice: el indice construido no se guarda
+    indexes.get(_WriteDuringBuild(collection, write))
+    assert indexes.stats()[collection.name]['items'] is None
+
+    response = indexes.query(collection, 'como tramito el f 184', n_results=5, include=['documents'])
+    assert response['ids'] == [['nuevo']]
+    assert indexes.query(collection, 'Como genero la clave fiscal?', include=['documents'])['ids'] == [['4']]
+
+
+def test_exact_match_index_query_and_merge(collection):
+    indexes = ExactMatchIndexes([collection.name])
+
+    exact = indexes.query(collection, '¿Cómo genero la CLAVE fiscal?', n_results=3)
+    assert exact['ids'] == [['4']] and exact['distances'] == [[0.0]]
+    assert indexes.query(collection, 'clave fiscal') is None
+    assert indexes.stats()[collection.name] == {'hits': 1, 'misses': 1, 'hit_rate': 0.5, 'items': len(DOCUMENTOS)}
+
+    # los lugares restantes se completan con la busqueda por embeddings, sin repetir la coincidencia exacta
+    response = collection.query(query_texts=['Como genero la clave fiscal'], n_results=3)
+    merged = merge_results(exact, response, 3)
+    assert merged['ids'][0][0] == '4' and len(merged['ids'][0]) == 3 and len(set(merged['ids'][0])) == 3
+    assert len(merged['documents'][0]) == len(merged['distances'][0]) == 3
+
+
+def test_category_index_plans(collection):
+    query_embeddings = HashingEmbeddingBackend(dim=64)(['baja del monotributo'])
+
+    calls = []
+    def query_function(**kwargs):
+        calls.append(kwargs)
+        return collection.query(**kwargs)
+
+    indexes = CategoryIndexes(brute_force_threshold=1)
+    assert indexes.get(collection).stats()['categoria_principal'] == {'otras': 5, 'baja': 1}
+
+    # categoria chica: busqueda exacta local, con el mismo resultado que chroma
+    where = {'categoria_principal': 'baja'}
+    local = indexes.query(collection, query_embeddings, n_results=3, where=where, query_function=query_function)
+    expected = collection.query(query_embeddings=query_embeddings, n_results=3, where=where)
+    assert calls == [] and local['ids'] == expected['ids'] == [['0']]
+    assert np.allclose(local['distances'], expected['distances'], atol=1e-4)
+
+    # categoria grande: se delega en chroma
+    indexes.query(collection, query_embeddings, n_results=3, where={'categoria_principal': 'otras'}, query_function=query_function)
+    assert len(calls) == 1 and calls[0]['where'] == {'categoria_principal': 'otras'}
+
+
+def test_category_index_discards_build_with_concurrent_write(collection):
+    indexes = CategoryIndexes(page_size=2)
+
+    def write():
+        collection.add(ids=['nuevo'], documents=['Baja por fallecimiento'], metadatas=[{'categoria_principal': 'baja'}])
+        indexes.add(collection.name, ['nuevo'], [{'categoria_principal': 'baja'}])
+
+    indexes.get(_WriteDuringBuild(collection, write))
+    assert indexes.get(collection).ids({'categoria_principal': 'baja'}) == {'0', 'nuevo'}
+
+
+# --- IngestionPipeline ---
+
+@pytest.mark.parametrize('use_processes', [False, True])
+def test_ingestion_pipeline(use_processes):
+    client = chromadb.EphemeralClient(Settings(anonymized_telemetry=False))
+    collection = client.create_collection(f'test_{uuid.uuid4().hex[:12]}', embedding_function=None)
+    embedding_function = EmbeddingCache(HashingEmbeddingBackend(dim=16))
+
+    data = {
+        'documents': [f'pregunta {i}' for i in range(250)],
+        'metadatas': [{'respuesta': f'respuesta {i}'} for i in range(250)],
+        'ids': [str(i) for i in range(250)],
+    }
+
+    try:
+        pipeline = IngestionPipeline(collection, embedding_function, workers=2, use_processes=use_processes)
+        assert pipeline.run(chunk_data(data, batch_size=40)) == 250
+        assert collection.count() == 250
+
+        # con procesos el cache se completa en el proceso principal
+        assert embedding_function.stats()['misses'] == 250
+        stored = collection.get(ids=['7'], include=['embeddings'])
+        assert np.allclose(stored['embeddings'][0], embedding_function(['pregunta 7'])[0])
+
+    finally:
+        client.delete_collection(collection.name)
+
+
+# --- QuantizedStore ---
+
+@pytest.mark.parametrize('dtype, minimum', [('float16', 0.99), ('int8', 0.95)])
+def test_quantized_store_recall(dtype, minimum):
+    ids, vectors = _vectors(count=1000, dim=32)
+    queries = _vectors(count=50, dim=32, seed=1)[1]
+
+    store = QuantizedStore(dtype=dtype)
+    store.build(ids, vectors)
+    report = store.recall_at_k(queries, k=10, oversample=4)
+
+    assert report['recall_reranked'] >= minimum
+    assert report['recall_reranked'] >= report['recall_first_pass']
+    assert report['total_bytes'] == report['hnsw_bytes'] + report['store_bytes']
+
+
+def test_quantized_store_first_pass_by_chunks():
+    ids, vectors = _vectors(count=1000, dim=16)
+    queries = _vectors(count=5, dim=16, seed=1)[1]
+
+    store = QuantizedStore(dtype='int8')
+    store.build(ids, vectors)
+
+    # los candidatos de cada bloque se combinan con los mejores de los bloques anteriores
+    found = store._first_pass(queries, candidates=20, chunk_size=64)
+    expected = np.argsort(distances('l2', queries, store._dequantize(store.codes)), axis=1)[:, :20]
+
+    assert found.shape == (5, 20)
+    assert all(set(row) == set(reference) for row, reference in zip(found, expected))
+
+
+def test_quantized_store_empty_collection(tmp_path):
+    store = QuantizedStore(dtype='int8', path=str(tmp_path / 'store'))
+    store.build([], np.zeros((0, 0), dtype=np.float32))
+
+    assert QuantizedStore.load(str(tmp_path / 'store')).search(_vectors(count=2, dim=8)[1], n_results=5) == ([[], []], [[], []])
+
+
+def test_quantized_store_detects_collection_changes(collection, tmp_path):
+    store = QuantizedStore.from_collection(collection, path=str(tmp_path / 'store'))
+    assert QuantizedStore.load(str(tmp_path / 'store')).is_current(collection)
+
+    collection.add(ids=['nuevo'], documents=['documento nuevo'])
+    assert not QuantizedStore.load(str(tmp_path / 'store')).is_current(collection)
+    assert len(store.ids) == len(DOCUMENTOS)
+
+
+# --- snapshots ---
+
+def test_snapshot_round_trip(collection, tmp_path):
+    manifest = export_collection(collection, str(tmp_path / 'snapshot'), page_size=4, model_name='hashing')
+
+    assert manifest == read_manifest(str(tmp_path / 'snapshot'))
+    assert manifest['count'] == len(DOCUMENTOS) and manifest['dim'] == 64
+
+    client = chromadb.EphemeralClient(Settings(anonymized_telemetry=False))
+    restored = client.create_collection(f'test_{uuid.uuid4().hex[:12]}', embedding_function=None)
+
+    try:
+        assert import_collection(restored, str(tmp_path / 'snapshot'), batch_size=4) == len(DOCUMENTOS)
+
+        original = collection.get(include=['documents', 'metadatas', 'embeddings'])
+        copy = restored.get(ids=original['ids'], include=['documents', 'metadatas', 'embeddings'])
+
+        assert copy['ids'] == original['ids']
+        assert copy['documents'] == original['documents']
+        assert copy['metadatas'] == original['metadatas']
+        assert np.allclose(copy['embeddings'], original['embeddings'])
+
+    finally:
+        client.delete_collection(restored.name)
+
+
+# --- Client / AsyncClient ---
+
+def test_client_query_cache_and_invalidation(client, collection):
+    client.query_cache = QueryCache()
+    client.exact = ExactMatchIndexes([collection.name])
+    client.set_cursor(collection.name)
+
+    first = client.execute_query('pago factura', n_results=2)
+    assert client.execute_query('PAGO factura', n_results=2) == first
+
+    # consultas por lotes con cache
+    batched = client.execute_query(['pago factura', 'clave fiscal'], n_results=2)
+    assert len(batched['ids']) == 2
+    assert client.execute_query(['pago factura', 'clave fiscal'], n_results=2) == batched
+    assert client.query_cache.stats()['hits'] == 2
+
+    # la escritura descarta los resultados cacheados y actualiza el indice de coincidencia exacta
+    client.insert_data({'document': 'Como pago la factura atrasada', 'metadata': {'respuesta': 'r'}, 'id': 'nuevo'})
+    assert client.query_cache.stats()['items'] == 0
+    assert client.execute_query('como pago la factura atrasada?', n_results=1)['ids'] == [['nuevo']]
+
+    client.delete_data({'id': 'nuevo'})
+    assert 'nuevo' not in client.execute_query('como pago la factura atrasada?', n_results=3)['ids'][0]
+
+
+def test_client_query_collection_errors(client, collection, monkeypatch):
+    assert client.query_collection(collection.name, 'clave fiscal', n_results=1)['ids'] == [['4']]
+
+    # la coleccion se recrea: la consulta la vuelve a resolver una vez
+    chroma = chromadb.EphemeralClient(Settings(anonymized_telemetry=False))
+    chroma.delete_collection(collection.name)
+    chroma.create_collection(collection.name, embedding_function=HashingEmbeddingBackend(dim=64)).add(ids=['otro'], documents=['Como genero la clave fiscal'])
+    assert client.query_collection(collection.name, 'clave fiscal', n_results=1)['ids'] == [['otro']]
+
+    # los demas errores se propagan sin descartar la coleccion ni sus indices
+    invalidated = []
+    monkeypatch.setattr(client.registry, 'invalidate', invalidated.append)
+
+    with pytest.raises(ValueError):
+        client.query_collection(collection.name, 'clave fiscal', where={'categoria_principal': {'$gt': 'a'}})
+
+    assert invalidated == []
+
+
+def test_async_client_query_cache_and_invalidation():
+    server = FastAPI(Settings(anonymized_telemetry=False, is_persistent=False))
+    name = f'test_{uuid.uuid4().hex[:12]}'
+
+    async def run():
+        client = AsyncClient(embedding_function='hashing', embedding_options={'dim': 64}, query_cache=QueryCache())
+        client.client = httpx.AsyncClient(transport=httpx.ASGITransport(app=server.app()), base_url=client._api_url)
+
+        await client.client.post('/collections', json={'name': name})
+        assert await client.get_collection('no_existe') is None
+
+        await client.insert_data({'document': DOCUMENTOS, 'metadata': [{'respuesta': 'r'}] * len(DOCUMENTOS), 'id': [str(i) for i in range(len(DOCUMENTOS))]}, collection_name=name)
+
+        first = await client.query_collection(name, ['clave fiscal', 'pago factura'], n_results=2)
+        assert first['ids'][0][0] == '4'
+        assert await client.query_collection(name, ['CLAVE fiscal', 'pago factura'], n_results=2) == first
+        assert client.query_cache.stats()['hits'] == 1
+
+        await client.delete_data({'id': '4'}, collection_name=name)
+        assert client.query_cache.stats()['items'] == 0
+        assert '4' not in (await client.query_collection(name, 'clave fiscal', n_results=2))['ids'][0]
+
+        await client.disconnect()
+
+    asyncio.run(run())
+
+
+# --- API de Flask ---
+
+def test_flask_request_validation_and_search(client, collection):
+    app = create_app({'EXACT_MATCH_COLLECTIONS': [], 'EMBEDDING_BACKEND': 'hashing'})
+    app.extensions['chroma_client'] = client
+
+    http = app.test_client()
+
+    assert http.post('/search', json={}).status_code == 400
+    assert http.post('/search', json={'pregunta': '  '}).status_code == 400
+    assert http.post('/search', json={'pregunta': 'clave fiscal', 'n_results': 0}).status_code == 400
+    assert http.post('/search', json={'pregunta': 'clave fiscal', 'where': {'categoria_principal': {'$foo': 1}}}).status_code == 400
+    assert http.post('/search', json={'pregunta': 'clave fiscal', 'collections': [{}]}).status_code == 400
+    assert http.post('/search', json={'pregunta': 'clave fiscal', 'collections': [collection.name]}).status_code == 400
+
+    # /search consulta las colecciones de SEARCH_COLLECTIONS
+    chroma = chromadb.EphemeralClient(Settings(anonymized_telemetry=False))
+    chroma.create_collection('abc_collection', embedding_function=HashingEmbeddingBackend(dim=64)).add(
+        ids=[str(i) for i in range(len(DOCUMENTOS))],
+        documents=DOCUMENTOS
+    )
+
+    try:
+        response = http.post('/search', json={'pregunta': 'clave fiscal', 'n_results': 2, 'collections': ['abc_collection']})
+        assert response.status_code == 200
+
+        results = response.get_json()['results']
+        assert results[0]['id'] == '4' and len(results) == 2
+        assert all(result['collection'] == 'abc_collection' for result in results)
+
+    finally:
+        chroma.delete_collection('abc_collection')
@@ -1,220 +1,451 @@
 """
 API REST en Flask
-Instrucciones para Windows:
-1. Instalar waitress: pip install waitress
-2. Ejecutar la aplicación: waitress-serve --port=3000 app:app
+
+Desarrollo (un proceso, recarga automatica):
+    python flask_app.py
+
+Produccion (varios workers, sin recarga). La aplicacion se construye con ```create_app()``` (ver wsgi.py) y cada
+worker inicializa su propio cliente de chroma en el primer pedido:
+
+    Linux:   gunicorn --workers 4 --threads 8 --bind 0.0.0.0:5500 wsgi:app
+    Windows: waitress-serve --port=5500 --threads=16 wsgi:app
+
+Configuracion por variables de entorno: CHROMA_HOST, CHROMA_PORT, QUERY_CACHE_SIZE, QUERY_CACHE_TTL, EMBEDDING_BACKEND,
+EMBEDDING_MODEL_PATH, EMBEDDING_THREADS, EXACT_MATCH_COLLECTIONS, HYBRID_SEARCH, VERSION_CHECK_INTERVAL, LOG_LEVEL y
+METRICS_LOG (ver metrics.configure_logging).
+
+El cache de consultas y los indices en memoria son propios de cada worker. Una escritura (/update_crm) registra una
+nueva version de la coleccion en chroma y los demas workers la detectan en su proxima consulta a esa coleccion,
+comparando la version a lo sumo cada VERSION_CHECK_INTERVAL segundos (por defecto 1): ese es el tiempo maximo durante
+el que otro worker puede devolver resultados anteriores a la escritura (ver collection_versions.py).
+
+Las metricas (latencias, tamaños de lote, resultados y errores) se exponen en formato Prometheus en /metrics.
 
 @autor: Martinez, Nicolas Agustin
 """
 # Importación de módulos necesarios
 
-from flask import Flask, request, jsonify, render_template
+from flask import Flask, Blueprint, Response, current_app, g, request, jsonify, render_template
 from flask_cors import CORS
-import webbrowser, chromadb
+import webbrowser, chromadb, os, sys, threading, time
+from chromadb.api.types import validate_where
 
-# Inicialización de la aplicación Flask
-app = Flask(__name__)
+# modulos de CHROMADB_APP/src (Client, caches, datasets)
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'CHROMADB_APP', 'src'))
 
+from cliente import Client
+from query_cache import QueryCache
+from category_index import build_where
+import metrics
+from metrics import logger
 
-@app.route('/')
-def index():
-    return render_template('index.html')
 
-@app.route('/crm')
-def pagina2():
-    return render_template('crm.html')
+api = Blueprint('api', __name__)
 
+# el cliente se crea una unica vez por proceso (worker), en el primer pedido
+_client_lock = threading.Lock()
 
-@app.route('/abc_consultas_frecuentes', methods=['POST'])
-def query_abc():
+# cantidad maxima de resultados y de caracteres aceptados por pedido
+MAX_N_RESULTS = 50
+MAX_PREGUNTA_LENGTH = 1000
+
+# colecciones consultadas por el endpoint de busqueda unificada
+SEARCH_COLLECTIONS = ['abc_collection', 'crm_collection', 'monotributo_collection']
+
+# colecciones de preguntas frecuentes con atajo de coincidencia exacta (ver exact_index.py)
+EXACT_MATCH_COLLECTIONS = 'abc_collection,monotributo_collection'
+
+
+def create_app(config:dict=None) -> Flask:
     """
-    Endpoint para obtener similitudes basadas en el texto proporcionado.
-    
-    Entrada: JSON con el campo 'text'
-    Salida: JSON con las similitudes encontradas o un objeto JSON vacío en caso de error
+    Construye la aplicacion Flask. ```config``` sobreescribe la configuracion tomada de las variables de entorno.
+    """
+    app = Flask(__name__)
+
+    app.config.update(
+        CHROMA_HOST=os.environ.get('CHROMA_HOST', 'localhost'),
+        CHROMA_PORT=int(os.environ.get('CHROMA_PORT', 8000)),
+        QUERY_CACHE_SIZE=int(os.environ.get('QUERY_CACHE_SIZE', 2048)),
+        QUERY_CACHE_TTL=float(os.environ.get('QUERY_CACHE_TTL', 600)),
+        # backend de embeddings de las preguntas ('default', 'onnx' o 'hashing', ver embeddings.py)
+        EMBEDDING_BACKEND=os.environ.get('EMBEDDING_BACKEND', 'default'),
+        EMBEDDING_MODEL_PATH=os.environ.get('EMBEDDING_MODEL_PATH'),
+        EMBEDDING_THREADS=int(os.environ.get('EMBEDDING_THREADS', 0)),
+        # lista separada por comas; vacia deshabilita el atajo
+        EXACT_MATCH_COLLECTIONS=[name for name in os.environ.get('EXACT_MATCH_COLLECTIONS', EXACT_MATCH_COLLECTIONS).split(',') if name],
+        # HYBRID_SEARCH=1 combina la busqueda por embeddings con BM25 (ver lexical_index.py). Cambia el orden de los
+        # resultados, que deja de ser por distancia
+        HYBRID_SEARCH=os.environ.get('HYBRID_SEARCH', '0') == '1',
+        # segundos entre controles de la version de cada coleccion (escrituras realizadas por otros workers)
+        VERSION_CHECK_INTERVAL=float(os.environ.get('VERSION_CHECK_INTERVAL', 1)),
+    )
+    app.config.update(config or {})
+
+    metrics.configure_logging()
+
+    app.register_blueprint(api)
+
+    # Habilitación de CORS para la aplicación
+    CORS(app)
+
+    return app
+
+
+@api.before_app_request
+def start_timer():
+    g.request_start = time.perf_counter()
+
+
+@api.after_app_request
+def record_request(response):
+    # la etiqueta es el nombre del endpoint y no la URL, para acotar la cantidad de series
+    start = g.pop('request_start', None)
+
+    if start is not None:
+        labels = {'endpoint': request.endpoint or 'not_found', 'method': request.method, 'status': response.status_code}
+        seconds = time.perf_counter() - start
+
+        metrics.HTTP_SECONDS.observe(seconds, **labels)
+        metrics.HTTP_REQUESTS.inc(**labels)
+        metrics.log_event('http_request', seconds=round(seconds, 6), **labels)
+
+    return response
+
+
+def get_client() -> Client:
+    """
+    Devuelve el cliente de chroma del proceso actual. Se crea en el primer pedido, luego del fork de los workers,
+    por lo que cada worker tiene sus propias conexiones.
+
+    Si el servidor de chroma no estaba disponible al crear el cliente, la conexion se reintenta en cada pedido hasta
+    lograrla. Mientras tanto se lanza ```ConnectionError``` (y '/ready' responde 503).
+    """
+    app = current_app
+    client = app.extensions.get('chroma_client')
+
+    if client is None or client.client is None:
+        with _client_lock:
+            client = app.extensions.get('chroma_client')
+
+            if client is None:
+                # cache de resultados: el trafico esta dominado por unas pocas cientos de preguntas repetidas
+                client = app.extensions['chroma_client'] = Client(
+                    host=app.config['CHROMA_HOST'],
+                    port=app.config['CHROMA_PORT'],
+                    query_cache=QueryCache(max_items=app.config['QUERY_CACHE_SIZE'], ttl=app.config['QUERY_CACHE_TTL']),
+                    embedding_function=app.config['EMBEDDING_BACKEND'],
+                    embedding_options=embedding_options(app.config),
+                    exact_match=app.config['EXACT_MATCH_COLLECTIONS'],
+                    hybrid=app.config['HYBRID_SEARCH'],
+                    version_check_interval=app.config['VERSION_CHECK_INTERVAL']
+                )
+
+                if client.client is not None:
+                    load_indexes(client)
+
+            elif client.client is None:
+                # el cliente (y su modelo de embeddings) se conserva: solo se vuelve a conectar
+                client.connect()
+                load_indexes(client)
+
+    if client.client is None:
+        raise ConnectionError(f"No se ha podido conectar al servidor de chroma en {app.config['CHROMA_HOST']}:{app.config['CHROMA_PORT']}")
+
+    return client
+
+
+def load_indexes(client:Client) -> None:
+    """
+    Construye los indices en memoria al crear el cliente, para no construirlos durante una consulta: los de preguntas
+    exactas (EXACT_MATCH_COLLECTIONS) y, con HYBRID_SEARCH, los indices BM25 de SEARCH_COLLECTIONS. Si el servidor no
+    esta disponible, cada indice se construye en la primera consulta a su coleccion.
+    """
+    indexes = [(name, client.exact) for name in sorted(client.exact.collections)] if client.exact else []
+    indexes += [(name, client.lexical) for name in SEARCH_COLLECTIONS] if client.lexical else []
+
+    for collection_name, collection_indexes in indexes:
+        try:
+            collection = client.registry.get(collection_name)
+
+            if collection:
+                # la version se registra antes de construir el indice: las escrituras posteriores lo descartan
+                client.check_version(collection_name, force=True)
+                collection_indexes.get(collection)
+
+        except Exception as e:
+            logger.warning('No se ha podido cargar el indice de %s: %s', collection_name, e)
+
+
+def embedding_options(config) -> dict:
+    """
+    Opciones del backend de embeddings. Con varios workers conviene limitar los hilos de onnxruntime por proceso
+    (EMBEDDING_THREADS) para no competir por los nucleos.
+    """
+    if config['EMBEDDING_BACKEND'] != 'onnx':
+        return {}
+
+    return {
+        'model_path': config['EMBEDDING_MODEL_PATH'],
+        'intra_op_threads': config['EMBEDDING_THREADS'],
+        'inter_op_threads': 1 if config['EMBEDDING_THREADS'] else 0,
+    }
+
+
+def parse_query_request() -> tuple[dict, str]:
+    """
+    Valida el cuerpo de un pedido de busqueda (form o JSON):
+
+    ```python
+    {'pregunta': str,        # obligatorio, no vacio
+     'n_results': int,       # opcional, entre 1 y MAX_N_RESULTS
+     'where': dict}          # opcional (solo JSON), filtro de metadata: {'categoria_principal': 'Recategorizacion', ...}
+    ```
+
+    Devuelve ```(datos, None)``` o ```(None, mensaje de error)```.
+    """
+    data = request.get_json(silent=True) if request.is_json else request.form
 
-    
-    """
-    collection_name = 'abc_collection'
-    collection = client.get_collection(collection_name)
-    
-    # Obtener datos del cuerpo de la solicitud
-    #data:dict = request.json
-    #print('DENTRO DE query_abc() EN APP.py')
-    data = request.form
-    print(data)
-    # Si no hay datos, retornar None
     if not data:
-        return None
-    
-    # Extraer el texto del JSON
-    pregunta:str = data['pregunta']
+        return None, 'El pedido no contiene datos'
+
+    pregunta = data.get('pregunta')
+
+    if not isinstance(pregunta, str) or not pregunta.strip():
+        return None, "El campo 'pregunta' es obligatorio"
+
+    if len(pregunta) > MAX_PREGUNTA_LENGTH:
+        return None, f"El campo 'pregunta' supera los {MAX_PREGUNTA_LENGTH} caracteres"
+
+    try:
+        n_results = int(data.get('n_results', 5))
+    except (TypeError, ValueError):
+        return None, "El campo 'n_results' debe ser un numero entero"
+
+    if not 1 <= n_results <= MAX_N_RESULTS:
+        return None, f"El campo 'n_results' debe estar entre 1 y {MAX_N_RESULTS}"
+
+    # varios campos se combinan con $and; el formato se valida antes de enviarlo a chroma
+    where = data.get('where') if request.is_json else None
+
+    try:
+        where = validate_where(build_where(where)) if where else None
+    except (TypeError, ValueError, AttributeError) as e:
+        return None, f"El campo 'where' no es un filtro valido: {e}"
+
+    return {'pregunta': pregunta, 'n_results': n_results, 'where': where}, None
+
+
+def query_endpoint(collection_name:str, include:list[str]):
+    """
+    Logica comun de los endpoints de busqueda: valida el pedido y consulta la coleccion indicada.
+
+    Salida: JSON con las similitudes encontradas, 400 si el pedido es invalido o un objeto JSON vacío en caso de error
+    """
+    data, error = parse_query_request()
+
+    if error:
+        return jsonify({'error': error}), 400
 
     # Intentar obtener similitudes y devolver la respuesta
     try:
-        response:chromadb.QueryResult = collection.query(
-            query_texts=pregunta, 
-            n_results=5,
-            include=['documents', 'metadatas', 'distances'])
-        
-        #return response
-        print(response)
+        client = get_client()
+
+        # las preguntas frecuentes se resuelven sin embeddings; el resto se embebe una sola vez (cache de embeddings)
+        response:chromadb.QueryResult = client.query_collection(
+            collection_name,
+            data['pregunta'],
+            n_results=data['n_results'],
+            include=include,
+            where=data['where'])
+
+        logger.debug('RESPUESTA DESDE SERVIDOR: %s', response)
         return jsonify(response)
-    
+
     except Exception as e:
-        # Imprimir el error y devolver un objeto JSON vacío
-        print('Error al obtener similitudes:', e)
+        # Registrar el error y devolver un objeto JSON vacío
+        logger.exception('Error al obtener similitudes: %s', e)
         return {}
 
-@app.route('/crm_respuestas', methods=["POST"])
-def query_crm():
+
+@api.route('/')
+def index():
+    return render_template('index.html')
+
+@api.route('/crm')
+def pagina2():
+    return render_template('crm.html')
+
+
+@api.route('/health', methods=['GET'])
+def health():
     """
-    Endpoint para obtener similitudes basadas en el texto proporcionado.
-    
-    Entrada: form con el campo 'pregunta'
-    Salida: JSON con las similitudes encontradas o un objeto JSON vacío en caso de error
-    
+    Endpoint de liveness: el proceso esta atendiendo pedidos.
     """
-    collection_name = 'crm_collection'
-    collection = client.get_collection(collection_name)
+    return jsonify({'status': 'ok'})
 
-    # Inicialización de la conexion a la base de datos
-
-    # Obtener datos del cuerpo de la solicitud
-    #data:dict = request.json
-    print('DENTRO DE query_crm() EN APP.py')
-    data = request.form
-    #print(data)
-    # Si no hay datos, retornar None
-    if not data:
-        return None
-    
-    # Extraer el texto del JSON
-    pregunta:str = data['pregunta']
 
-    # Intentar obtener similitudes y devolver la respuesta
+@api.route('/ready', methods=['GET'])
+def ready():
+    """
+    Endpoint de readiness: el worker puede alcanzar al servidor de chroma.
+    """
     try:
-        response:chromadb.QueryResult = collection.query(
-            query_texts=pregunta,
-            n_results=5,
-            include=['documents', 'metadatas'])
+        client = get_client()
+        client.client.heartbeat()
+        return jsonify({'status': 'ready'})
 
-        print('RESPUESTA DESDE SERVIDOR: ', response)
-        #return response
-        return jsonify(response)
-    
     except Exception as e:
-        # Imprimir el error y devolver un objeto JSON vacío
-        print('Error al obtener similitudes:', e)
-        return {}
+        return jsonify({'status': 'unavailable', 'error': str(e)}), 503
 
 
-@app.route('/monotributo_respuestas', methods=["POST"])
-def query_monotributo():
+@api.route('/abc_consultas_frecuentes', methods=['POST'])
+def query_abc():
     """
     Endpoint para obtener similitudes basadas en el texto proporcionado.
-    
-    Entrada: form con el campo 'pregunta'
+
+    Entrada: form o JSON con el campo 'pregunta' (y opcionalmente 'n_results')
     Salida: JSON con las similitudes encontradas o un objeto JSON vacío en caso de error
-    
     """
+    return query_endpoint('abc_collection', include=['documents', 'metadatas', 'distances'])
 
-    
-    collection_name = 'monotributo_collection'
-    collection = client.get_collection(collection_name)
 
-    
-    # Obtener datos del cuerpo de la solicitud
-    #data:dict = request.json
-    print('DENTRO DE query_crm() EN APP.py')
-    data = request.form
-    print(data)
-    # Si no hay datos, retornar None
-    if not data:
-        return None
-    
-    # Extraer el texto del JSON
-    pregunta:str = data['pregunta']
+@api.route('/crm_respuestas', methods=["POST"])
+def query_crm():
+    """
+    Endpoint para obtener similitudes basadas en el texto proporcionado.
 
-    # Intentar obtener similitudes y devolver la respuesta
-    try:
-        response:chromadb.QueryResult = collection.query(
-            query_texts=pregunta, 
-            n_results=5,
-            include=['metadatas', 'documents'])
+    Entrada: form o JSON con el campo 'pregunta' (y opcionalmente 'n_results')
+    Salida: JSON con las similitudes encontradas o un objeto JSON vacío en caso de error
+    """
+    return query_endpoint('crm_collection', include=['documents', 'metadatas'])
 
-        print('RESPUESTA DESDE SERVIDOR: ', response)
-        #return response
-        return jsonify(response)
-    
-    except Exception as e:
-        # Imprimir el error y devolver un objeto JSON vacío
-        print('Error al obtener similitudes:', e)
-        return {}
 
+@api.route('/monotributo_respuestas', methods=["POST"])
+def query_monotributo():
+    """
+    Endpoint para obtener similitudes basadas en el texto proporcionado.
+
+    Entrada: form o JSON con el campo 'pregunta' (y opcionalmente 'n_results')
+    Salida: JSON con las similitudes encontradas o un objeto JSON vacío en caso de error
+    """
+    return query_endpoint('monotributo_collection', include=['metadatas', 'documents'])
 
 
-@app.route('/get_links', methods=['POST'])
-def get_links():
+@api.route('/search', methods=['POST'])
+def search():
+    """
+    Endpoint de busqueda unificada: embebe la pregunta una sola vez, consulta en paralelo ABC, CRM y MONOTRIBUTO
+    y devuelve una unica lista de resultados ordenada por distancia, indicando la coleccion de origen.
 
-    collection_name = 'links_respuestas'
-    database_name = 'links_database'
-
-    # Inicialización de la conexion a la base de datos
-    #db = CRM_DataBase()
-    #db.connect(database_name=database_name)
-    #db.set_collection(collection_name=collection_name)
-    
-    # Obtener datos del cuerpo de la solicitud
-    #data:dict = request.json
-    print('DENTRO DE query_crm() EN APP.py')
-    data = request.json 
-    print(data)
-    # Si no hay datos, retornar None
-    if not data:
-        return None
-    
-    # Extraer el texto del JSON
-    pregunta:str = data['pregunta']
+    Entrada: form o JSON con el campo 'pregunta' (y opcionalmente 'n_results' y 'collections')
+    Salida: JSON ```{'results': [{'collection', 'id', 'document', 'metadata', 'distance'}, ...]}```
+    """
+    data, error = parse_query_request()
+
+    if error:
+        return jsonify({'error': error}), 400
+
+    collections = (request.get_json(silent=True) or {}).get('collections') or SEARCH_COLLECTIONS
+
+    # los elementos se validan antes de armar el set: valores no hashables (listas, objetos) provocarian un TypeError
+    if not isinstance(collections, list) or not all(isinstance(c, str) for c in collections) or not set(collections) <= set(SEARCH_COLLECTIONS):
+        return jsonify({'error': f"El campo 'collections' debe ser una lista con valores de {SEARCH_COLLECTIONS}"}), 400
 
-    # Intentar obtener similitudes y devolver la respuesta
     try:
-        response:dict = db.query(query=pregunta, n_results=5)
+        results = get_client().search(
+            data['pregunta'],
+            collections,
+            n_results=data['n_results'],
+            include=['documents', 'metadatas', 'distances'],
+            limit=data['n_results'],
+            where=data['where'])
+
+        return jsonify({'results': results})
 
-        print('RESPUESTA DESDE SERVIDOR: ', response)
-        #return response
-        return jsonify(response)
-    
     except Exception as e:
-        # Imprimir el error y devolver un objeto JSON vacío
-        print('Error al obtener similitudes:', e)
+        # Registrar el error y devolver un objeto JSON vacío
+        logger.exception('Error al obtener similitudes: %s', e)
         return {}
 
-@app.route('/update_crm', methods=["POST"])
+
+@api.route('/get_links', methods=['POST'])
+def get_links():
+    """
+    Endpoint con sugerencias de guias, micrositios y tutoriales para la pregunta.
+
+    Entrada: JSON con el campo 'pregunta'
+    """
+    return query_endpoint('links_respuestas', include=['documents', 'metadatas', 'distances'])
+
+
+@api.route('/update_crm', methods=["POST"])
 def update_crm():
-    data = request.get_json()
-    id = data['id']
-    metadata = data['metadata']
+    """
+    Actualiza la metadata de una respuesta del CRM.
+
+    Entrada: JSON ```{'id': str, 'metadata': dict}```
+    """
+    data = request.get_json(silent=True)
 
-    collection_name = 'crm_respuestas'
-    database_name = 'crm_database'
+    if not isinstance(data, dict) or not isinstance(data.get('id'), str) or not isinstance(data.get('metadata'), dict):
+        return jsonify({'error': "Se esperaba un JSON con los campos 'id' (str) y 'metadata' (dict)"}), 400
 
-    # Inicialización de la conexion a la base de datos
-    db = CRM_DataBase()
-    db.connect(database_name=database_name)
-    db.set_collection(collection_name=collection_name)
+    collection_name = 'crm_collection'
 
-    db.update_collection(id=id, metadata=metadata)
+    # la escritura invalida el cache y los indices de la coleccion en este worker, y en los demas al detectar la nueva version
+    get_client().update_data({'id': data['id'], 'metadata': data['metadata']}, collection_name=collection_name)
     return 'NUEVO VALOR AGREGADO A LA BASE DE DATOS'
 
 
-if __name__ == '__main__':
-    webbrowser.open('http://localhost:5500')
+@api.route('/category_stats', methods=['GET'])
+def category_stats():
+    """
+    Endpoint con la cantidad de documentos por categoria de una coleccion, para armar filtros.
 
-    client = chromadb.HttpClient()
-    # Habilitación de CORS para la aplicación
+    Entrada: parametro 'collection' (por defecto 'monotributo_collection')
+    Salida: JSON ```{'total': int, 'categoria_principal': {valor: cantidad}, ...}```
+    """
+    collection_name = request.args.get('collection', 'monotributo_collection')
 
-    CORS(app)
+    if collection_name not in SEARCH_COLLECTIONS:
+        return jsonify({'error': f"El parametro 'collection' debe ser uno de {SEARCH_COLLECTIONS}"}), 400
+
+    stats = get_client().category_stats(collection_name)
+
+    if stats is None:
+        return jsonify({'error': 'No se ha encontrado la coleccion solicitada'}), 404
+
+    return jsonify(stats)
+
+
+@api.route('/cache_stats', methods=['GET'])
+def cache_stats():
+    """
+    Endpoint con los contadores de aciertos y fallos del cache de consultas, para dimensionarlo, y los del atajo de
+    preguntas exactas ('exact_match', por coleccion).
+    """
+    client = get_client()
+    stats = client.query_cache.stats()
+
+    if client.exact:
+        stats['exact_match'] = client.exact.stats()
+
+    return jsonify(stats)
+
+
+@api.route('/metrics', methods=['GET'])
+def metrics_endpoint():
+    """
+    Endpoint de metricas en formato de texto de Prometheus. Las metricas son del worker que atiende el pedido.
+    """
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+
+if __name__ == '__main__':
+    # modo desarrollo: un unico proceso con recarga automatica
+    app = create_app()
+
+    webbrowser.open('http://localhost:5500')
 
     # (Opcional) Para montar la API en línea, descomentar la siguiente línea
     # run_with_ngrok(app)
@@ -0,0 +1,10 @@
+"""
+Punto de entrada WSGI para produccion.
+
+    Linux:   gunicorn --workers 4 --threads 8 --bind 0.0.0.0:5500 wsgi:app
+    Windows: waitress-serve --port=5500 --threads=16 wsgi:app
+"""
+
+from flask_app import create_app
+
+app = create_app()